@@ -1,49 +1,53 @@
-import gradio as gr
 import os
-import torch
-import shutil
-import datetime
-from gen_t2m import generate_motion
-from pathlib import Path
+from utils.lazy_import import timed_import, import_report
+from gen_t2m import get_eval_options, get_worker_pool, get_job_manager, arch_overrides_from_ui
+
+# torch / モデル / 可視化系は gen_t2m 内で遅延 import される (初回リクエスト時に読み込み)
+gr = timed_import('gradio', 'gradio')
 
 # 出力ディレクトリ
 OUTPUT_DIR = "web_outputs"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# 同時に進捗を表示できるリクエスト数
+JOB_STREAMS = 32
+
 
 def generate_and_preview(text_prompt, cond_drop_prob, dropout, ff_size, max_motion_length, n_heads, share_weight):
     """
-    ユーザーのテキスト入力を受け取り、モーションを生成し、GIF と BVH を返す
+    ユーザーのテキスト入力をジョブとして投入し、進捗を表示しながら完了を待って GIF と BVH を返す
     """
     if not text_prompt.strip():
-        return None, None, "エラー: テキストを入力してください"
-
-    # 現在の日時を取得し、ファイル名に適用
-    timestamp = datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S")
-    output_gif = Path(OUTPUT_DIR) / f"motion_{timestamp}.gif"
-    output_bvh = Path(OUTPUT_DIR) / f"motion_{timestamp}.bvh"
+        yield None, None, "エラー: テキストを入力してください"
+        return
 
     latent_dim = 384
     n_layers = 8
 
-    # モーションを生成
-    try:
-        generate_motion(
-            text_prompt, str(output_bvh), str(output_gif),
-            cond_drop_prob=cond_drop_prob, dropout=dropout,
-            ff_size=ff_size, latent_dim=latent_dim,
-            max_motion_length=max_motion_length, n_heads=n_heads,
-            n_layers=n_layers, share_weight=share_weight
-        )  # gen_t2m.py を呼び出す
+    # ジョブを投入 (生成は別スレッド、IK / 描画は別プロセスで実行され、成果物はジョブごとのディレクトリに保存される)
+    jobs = get_job_manager(get_eval_options(), OUTPUT_DIR)
+    job_id = jobs.submit(
+        text_prompt=text_prompt, cond_drop_prob=cond_drop_prob, dropout=dropout,
+        ff_size=ff_size, latent_dim=latent_dim,
+        max_motion_length=max_motion_length, n_heads=n_heads,
+        n_layers=n_layers, share_weight=share_weight
+    )
 
-    except Exception as e:
-        return None, None, f"エラー発生: {str(e)}"
+    # 進捗 (デコードのステップ数、IK、描画) を逐次表示する
+    for job in jobs.stream(job_id):
+        if not job.done:
+            yield None, None, f"ジョブ {job_id}: {job.describe()}"
 
-    # ファイルが正常に生成されたかチェック
-    if not output_gif.exists() or not output_bvh.exists():
-        return None, None, "エラー: モーション生成に失敗しました"
+    if job.error is not None:
+        yield None, None, f"エラー発生 (ジョブ {job_id}): {job.error}"
+        return
 
-    return str(output_gif), str(output_bvh), "✅ モーション生成完了！ダウンロードできます"
+    artifacts = job.artifacts[0]
+    # --joints_only の場合は関節位置 (.npy) のみ
+    if artifacts['gif'] is None:
+        yield None, artifacts['joints'], f"✅ ジョブ {job_id}: 関節位置を保存しました"
+        return
+    yield artifacts['gif'], artifacts['bvh'], f"✅ ジョブ {job_id}: モーション生成完了！ダウンロードできます"
 
 
 # Gradio UI 設定
@@ -79,5 +83,41 @@ with gr.Blocks() as demo:
 
 # Web サーバー起動
 if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", server_port=5000)
+    opt = get_eval_options()
+    # モデル・CLIP・可視化系は最初のリクエスト時に読み込まれる (--startup_report で各サブシステムの import 時間を表示)
+    if opt.startup_report:
+        print(import_report())
+    if opt.num_workers > 0:
+        # --num_workers: Web サーバーのスレッドを起動する前にモデルを共有メモリへ移し、ワーカーを fork しておく
+        get_worker_pool(opt, **arch_overrides_from_ui())
+    # 後処理用のプロセスもサーバー起動前に fork しておく
+    get_job_manager(opt, OUTPUT_DIR)
+    # ハンドラはジョブの進捗を待つだけなので、多くのリクエストを同時に受け付ける
+    # (--batch_window_ms / --continuous_batching / --num_workers に応じて生成側の並列数はジョブキューが決める)
+    # Gradio 4 で concurrency_count が default_concurrency_limit に置き換えられた
+    if int(gr.__version__.split('.')[0]) >= 4:
+        demo.queue(default_concurrency_limit=JOB_STREAMS)
+    else:
+        demo.queue(concurrency_count=JOB_STREAMS)
+    if opt.profile:
+        # --profile: Gradio UI と並べて /metrics (Prometheus) と /metrics.json (直近のリクエストのプロファイル) を公開する
+        import uvicorn
+        from fastapi import FastAPI
+        from fastapi.responses import JSONResponse, PlainTextResponse
+        from utils.profiling import get_metrics
+
+        server = FastAPI()
+
+        @server.get("/metrics")
+        def metrics():
+            return PlainTextResponse(get_metrics().prometheus_text(), media_type="text/plain; version=0.0.4")
+
+        @server.get("/metrics.json")
+        def metrics_json():
+            return JSONResponse(get_metrics().recent_profiles())
+
+        server = gr.mount_gradio_app(server, demo, path="/")
+        uvicorn.run(server, host="0.0.0.0", port=5000)
+    else:
+        demo.launch(server_name="0.0.0.0", server_port=5000)
 
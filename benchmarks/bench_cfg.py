@@ -0,0 +1,62 @@
+'''
+Step latency of classifier-free guidance: two sequential passes (default) vs one doubled-batch pass (batch_cfg).
+
+    python -m benchmarks.bench_cfg --device cpu --batch_sizes 1 2 4 8 16 32 64
+'''
+import argparse
+
+import torch
+
+from benchmarks.common import build_models, random_inputs, time_fn, print_table
+from models.mask_transformer.tools import lengths_to_mask
+
+
+@torch.no_grad()
+def bench(args):
+    t2m_transformer, res_model, _ = build_models(args.device)
+    res_model.process_embed_proj_weight()
+    rows = []
+    for bs in args.batch_sizes:
+        cond_vector, token_lens = random_inputs(bs, args.max_tokens, args.device)
+        padding_mask = ~lengths_to_mask(token_lens, args.max_tokens)
+        ids = torch.randint(0, t2m_transformer.mask_id, (bs, args.max_tokens), device=args.device)
+        codes = torch.randn(bs, args.max_tokens, res_model.code_dim, device=args.device)
+
+        def mask_step():
+            return t2m_transformer.forward_with_cond_scale(ids, cond_vector, padding_mask, cond_scale=args.cond_scale)
+
+        def res_step():
+            return res_model.forward_with_cond_scale(codes, 1, cond_vector, padding_mask, cond_scale=args.res_cond_scale)
+
+        row = [bs]
+        for name, step, model in (('mask', mask_step, t2m_transformer), ('res', res_step, res_model)):
+            model.batch_cfg = False
+            ref = step()
+            two_pass, _ = time_fn(step, args.repeats, device=args.device)
+            model.batch_cfg = True
+            out = step()
+            one_pass, _ = time_fn(step, args.repeats, device=args.device)
+            model.batch_cfg = False
+            row += ['%.2f' % two_pass, '%.2f' % one_pass, '%.2fx' % (two_pass / one_pass),
+                    '%.1e' % (out - ref).abs().max().item()]
+        rows.append(row)
+
+    header = ['bs']
+    for name in ('mask', 'res'):
+        header += [f'{name} 2-pass ms', f'{name} batched ms', f'{name} speedup', f'{name} max|diff|']
+    print_table(header, rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--max_tokens', type=int, default=49)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--cond_scale', type=float, default=4)
+    parser.add_argument('--res_cond_scale', type=float, default=5)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    bench(args)
@@ -0,0 +1,91 @@
+'''
+Decode latency and peak memory of ResidualVQ.get_codes_from_indices against the previous
+repeat + gather implementation, over batch sizes.
+
+    python -m benchmarks.bench_dequant --device cpu --batch_sizes 1 4 16 64 256
+'''
+import argparse
+
+import torch
+import torch.nn.functional as F
+from einops import repeat
+
+from benchmarks.common import build_models, time_fn, run_isolated, print_table
+
+
+def gather_codes_from_indices(quantizer, indices):
+    # The previous implementation, kept as the reference
+    quantize_dim = indices.shape[-1]
+    if quantize_dim < quantizer.num_quantizers:
+        indices = F.pad(indices, (0, quantizer.num_quantizers - quantize_dim), value=-1)
+    codebooks = repeat(quantizer.codebooks, 'q c d -> q b c d', b=indices.shape[0])
+    gather_indices = repeat(indices, 'b n q -> q b n d', d=codebooks.shape[-1])
+    mask = gather_indices == -1.
+    gather_indices = gather_indices.masked_fill(mask, 0)
+    all_codes = codebooks.gather(2, gather_indices)
+    return all_codes.masked_fill(mask, 0.)
+
+
+def random_indices(quantizer, bs, num_tokens, drop_from=None):
+    num_codes = quantizer.codebooks.shape[1]
+    indices = torch.randint(0, num_codes, (bs, num_tokens, quantizer.num_quantizers))
+    if drop_from is not None:
+        indices[..., drop_from:] = -1
+    return indices
+
+
+def measure(args, bs, impl):
+    _, _, vq_model = build_models(args.device)
+    quantizer = vq_model.quantizer
+    indices = random_indices(quantizer, bs, args.num_tokens).to(args.device)
+    fn = quantizer.get_codes_from_indices if impl == 'embedding' else \
+        (lambda x: gather_codes_from_indices(quantizer, x))
+    if torch.device(args.device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    with torch.no_grad():
+        latency, _ = time_fn(lambda: fn(indices), args.repeats, device=args.device)
+    cuda_peak = torch.cuda.max_memory_allocated() / 1024 ** 2 if torch.device(args.device).type == 'cuda' else None
+    return latency, cuda_peak
+
+
+@torch.no_grad()
+def check_equal(args):
+    _, _, vq_model = build_models(args.device)
+    quantizer = vq_model.quantizer
+    for layer in quantizer.layers:
+        layer.codebook.normal_()
+    for drop_from in (None, 2):
+        indices = random_indices(quantizer, 8, args.num_tokens, drop_from).to(args.device)
+        ref = gather_codes_from_indices(quantizer, indices)
+        out = quantizer.get_codes_from_indices(indices)
+        assert torch.equal(ref, out), 'dequantization mismatch'
+        # Coarse indices, with the missing layers padded as dropped
+        ref = gather_codes_from_indices(quantizer, indices[..., :3])
+        assert torch.equal(ref, quantizer.get_codes_from_indices(indices[..., :3])), 'coarse dequantization mismatch'
+    print('Outputs identical (including -1 dropout and coarse indices)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+    parser.add_argument('--num_tokens', type=int, default=49)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    cuda = torch.device(args.device).type == 'cuda'
+    check_equal(args)
+    rows = []
+    for bs in args.batch_sizes:
+        row = [bs]
+        for impl in ('gather', 'embedding'):
+            if cuda:
+                # CUDA cannot be used in a forked child, the peak memory stats are reset per measurement instead
+                latency, peak = measure(args, bs, impl)
+            else:
+                # Forked per measurement, so each peak RSS only covers its own implementation
+                (latency, _), peak = run_isolated(measure, args, bs, impl)
+            row += ['%.2f' % latency, '%.0f' % peak]
+        rows.append(row)
+    mem = 'cuda MB' if cuda else 'RSS MB'
+    print_table(['bs', 'gather ms', f'gather peak {mem}', 'embedding ms', f'embedding peak {mem}'], rows)
@@ -0,0 +1,98 @@
+'''
+Per-layer latency of ResidualTransformer.generate against the previous decoding loop
+(weights re-concatenated per call, repeat + gather embedding lookup, per-sample einsum projection).
+
+    python -m benchmarks.bench_res_decode --device cpu --batch_sizes 1 4 16 64
+'''
+import argparse
+
+import torch
+from einops import repeat
+
+from benchmarks.common import build_models, random_inputs, time_fn, print_table
+from models.mask_transformer.tools import lengths_to_mask, top_k, gumbel_sample
+
+
+def _generator_list(bs, device, seed=0):
+    generators = []
+    for i in range(bs):
+        g = torch.Generator(device=device)
+        g.manual_seed(seed + i)
+        generators.append(g)
+    return generators
+
+
+@torch.no_grad()
+def reference_generate(model, motion_ids, cond_vector, m_lens, cond_scale=5, topk_filter_thres=0.9, generators=None):
+    # The previous ResidualTransformer.generate loop, kept as the reference
+    if model.share_weight and (not model.shared_codebook):
+        output_proj_weight = torch.cat([model.embed_proj_shared_weight, model.output_proj_weight_], dim=0)
+        token_embed_weight = torch.cat([model.token_embed_weight_, model.embed_proj_shared_weight], dim=0)
+    else:
+        output_proj_weight, token_embed_weight = model.output_proj_weight, model.token_embed_weight
+    batch_size, seq_len = motion_ids.shape
+    padding_mask = ~lengths_to_mask(m_lens, seq_len)
+    motion_ids = torch.where(padding_mask, model.pad_id, motion_ids)
+    all_indices = [motion_ids]
+    history_sum = 0
+
+    def project(logits, qids):
+        weight = output_proj_weight[qids]
+        bias = None if model.output_proj_bias is None else model.output_proj_bias[qids]
+        output = torch.einsum('bnc, bcs->bns', weight, logits)
+        if bias is not None:
+            output += output + bias.unsqueeze(-1)
+        return output
+
+    for i in range(1, model.opt.num_quantizers):
+        token_embed = repeat(token_embed_weight[i-1], 'c d -> b c d', b=batch_size)
+        gathered_ids = repeat(motion_ids, 'b n -> b n d', d=token_embed.shape[-1])
+        history_sum += token_embed.gather(1, gathered_ids)
+
+        qids = torch.full((batch_size,), i, dtype=torch.long, device=motion_ids.device)
+        logits = project(model.trans_forward(history_sum, qids, cond_vector, padding_mask), qids-1)
+        aux_logits = project(model.trans_forward(history_sum, qids, cond_vector, padding_mask, force_mask=True), qids-1)
+        logits = aux_logits + (logits - aux_logits) * cond_scale
+
+        filtered_logits = top_k(logits.permute(0, 2, 1), topk_filter_thres, dim=-1)
+        pred_ids = gumbel_sample(filtered_logits, temperature=1, dim=-1, generators=generators, lengths=m_lens)
+        motion_ids = torch.where(padding_mask, model.pad_id, pred_ids)
+        all_indices.append(motion_ids)
+
+    all_indices = torch.stack(all_indices, dim=-1)
+    return torch.where(all_indices == model.pad_id, -1, all_indices)
+
+
+@torch.no_grad()
+def bench(args):
+    _, res_model, _ = build_models(args.device, share_weight=args.share_weight)
+    num_layers = res_model.opt.num_quantizers - 1
+    rows = []
+    for bs in args.batch_sizes:
+        cond_vector, token_lens = random_inputs(bs, args.max_tokens, args.device)
+        base_ids = torch.randint(0, res_model.pad_id, (bs, args.max_tokens), device=args.device)
+
+        ref = reference_generate(res_model, base_ids, cond_vector, token_lens,
+                                 generators=_generator_list(bs, args.device))
+        out = res_model.generate(base_ids, cond_vector, token_lens, temperature=1, cond_scale=5,
+                                 generators=_generator_list(bs, args.device))
+        match = (ref == out).float().mean().item()
+
+        ref_ms, _ = time_fn(lambda: reference_generate(res_model, base_ids, cond_vector, token_lens),
+                            args.repeats, device=args.device)
+        new_ms, _ = time_fn(lambda: res_model.generate(base_ids, cond_vector, token_lens, temperature=1, cond_scale=5),
+                            args.repeats, device=args.device)
+        rows.append([bs, '%.2f' % (ref_ms / num_layers), '%.2f' % (new_ms / num_layers),
+                     '%.2fx' % (ref_ms / new_ms), '%.4f' % match])
+    print_table(['bs', 'previous ms/layer', 'lean ms/layer', 'speedup', 'token match'], rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--max_tokens', type=int, default=49)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--no_share_weight', dest='share_weight', action='store_false')
+    args = parser.parse_args()
+    bench(args)
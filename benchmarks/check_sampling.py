@@ -0,0 +1,105 @@
+'''
+Equivalence check of the fused sampling step (tools.sample_top_k / lowest_k_mask) against the previous
+top_k + gumbel / multinomial sampling + full softmax gather, and the double-argsort mask selection.
+Also checks that a seeded candidate draws the same ids alone and inside a padded batch of longer samples.
+
+With fixed seeds, both samplers draw many tokens from the same logits; the empirical token distributions
+must agree up to sampling noise, and the scores must equal the unfiltered softmax probability of the sampled ids.
+
+    python -m benchmarks.check_sampling --num_draws 20000
+'''
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from models.mask_transformer.tools import top_k, gumbel_sample, categorical_sample, sample_top_k, lowest_k_mask
+
+
+def reference_sample(logits, thres, temperature, gsample, generators):
+    filtered_logits = top_k(logits, thres, dim=-1)
+    if gsample:
+        pred_ids = gumbel_sample(filtered_logits, temperature=temperature, dim=-1, generators=generators)
+    else:
+        pred_ids = categorical_sample(F.softmax(filtered_logits / temperature, dim=-1), generators)
+    scores = logits.softmax(dim=-1).gather(-1, pred_ids.unsqueeze(-1)).squeeze(-1)
+    return pred_ids, scores
+
+
+def empirical(sample_fn, logits, num_draws, seed):
+    # Row i of the repeated logits draws from its own seeded generator
+    logits = logits.expand(num_draws, -1, -1)
+    generators = [torch.Generator().manual_seed(seed + i) for i in range(num_draws)]
+    ids, scores = sample_fn(logits, generators)
+    ref_scores = logits.softmax(dim=-1).gather(-1, ids.unsqueeze(-1)).squeeze(-1)
+    assert torch.allclose(scores, ref_scores, rtol=1e-4, atol=1e-7), 'scores differ from the unfiltered softmax'
+    counts = torch.stack([torch.bincount(ids[:, j], minlength=logits.shape[-1]) for j in range(ids.shape[1])])
+    return counts.float() / num_draws
+
+
+def batch_independent(ntoken, thres, gsample, seed, steps=4):
+    '''
+    Draw a few successive steps for one seeded candidate of 5 tokens, alone and as the first sample of a batch
+    padded to 12 tokens whose other sample has another top-k threshold; its ids must be the same.
+    '''
+    torch.manual_seed(seed)
+    length, other = 5, 12
+    logits = [torch.randn(length, ntoken) * 3 for _ in range(steps)]
+    other_logits = [torch.randn(other, ntoken) * 3 for _ in range(steps)]
+    alone_gen = [torch.Generator().manual_seed(seed)]
+    batch_gen = [torch.Generator().manual_seed(seed), torch.Generator().manual_seed(seed + 1)]
+    same = True
+    for step in range(steps):
+        alone, _ = sample_top_k(logits[step][None], torch.tensor([thres]), gsample=gsample,
+                                generators=alone_gen, lengths=torch.tensor([length]))
+        padded = torch.cat([logits[step], torch.zeros(other - length, ntoken)])[None]
+        batch, _ = sample_top_k(torch.cat([padded, other_logits[step][None]]), torch.tensor([thres, thres / 2]),
+                                gsample=gsample, generators=batch_gen, lengths=torch.tensor([length, other]))
+        same &= torch.equal(alone[0], batch[0, :length])
+    return same
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    logits = torch.randn(1, args.positions, args.ntoken) * 3
+    ok = True
+    for gsample in (False, True):
+        for temperature in (1., 0.5):
+            ref = empirical(lambda l, g: reference_sample(l, args.thres, temperature, gsample, g),
+                            logits, args.num_draws, args.seed)
+            new = empirical(lambda l, g: sample_top_k(l, args.thres, temperature=temperature, gsample=gsample,
+                                                      generators=g),
+                            logits, args.num_draws, args.seed + args.num_draws)
+            # Total variation distance per position, against the sampling noise of two independent estimates
+            tv = 0.5 * (ref - new).abs().sum(dim=-1).max().item()
+            k = int(torch.ceil(torch.tensor((1 - args.thres) * args.ntoken)).item())
+            tol = 3 * (k / args.num_draws) ** 0.5
+            passed = tv < tol
+            ok &= passed
+            print(f'gsample={gsample} temperature={temperature}: max TV distance {tv:.4f} (tolerance {tol:.4f}) '
+                  f'{"OK" if passed else "FAILED"}')
+
+    scores = torch.rand(64, args.positions)
+    num_low = torch.randint(1, args.positions + 1, (64,))
+    ranks = scores.argsort(dim=1).argsort(dim=1)
+    same_mask = torch.equal(ranks < num_low.unsqueeze(-1), lowest_k_mask(scores, num_low))
+    ok &= same_mask
+    print(f'lowest_k_mask matches double argsort: {same_mask}')
+
+    for gsample in (False, True):
+        same_ids = batch_independent(args.ntoken, args.thres, gsample, args.seed)
+        ok &= same_ids
+        print(f'gsample={gsample}: seeded candidate draws the same ids alone and in a padded batch: {same_ids}')
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_draws', type=int, default=20000)
+    parser.add_argument('--positions', type=int, default=4)
+    parser.add_argument('--ntoken', type=int, default=512)
+    parser.add_argument('--thres', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,122 @@
+import multiprocessing as mp
+import resource
+import time
+import zlib
+from argparse import Namespace
+
+import numpy as np
+import torch
+
+from models.mask_transformer.transformer import MaskTransformer, ResidualTransformer
+from models.vq.model import RVQVAE
+
+
+def build_opt(device='cpu', num_tokens=512, num_quantizers=6, code_dim=512):
+    return Namespace(device=torch.device(device), num_tokens=num_tokens, num_quantizers=num_quantizers,
+                     code_dim=code_dim, nb_code=num_tokens, shared_codebook=False, quantize_dropout_prob=0.2, mu=0.99)
+
+
+def build_models(device='cpu', latent_dim=384, ff_size=1024, n_layers=8, n_heads=6, share_weight=True,
+                 num_tokens=512, num_quantizers=6, code_dim=512, dim_pose=263):
+    '''
+    Randomly initialized models with the released architecture, no checkpoints or CLIP needed.
+    Conditions have to be passed as (b, 512) tensors.
+    :return: (t2m_transformer, res_model, vq_model), in eval mode on device
+    '''
+    opt = build_opt(device, num_tokens, num_quantizers, code_dim)
+    t2m_transformer = MaskTransformer(code_dim=code_dim, cond_mode='text', latent_dim=latent_dim, ff_size=ff_size,
+                                      num_layers=n_layers, num_heads=n_heads, dropout=0.1, clip_dim=512,
+                                      cond_drop_prob=0.1, clip_version=None, opt=opt)
+    res_model = ResidualTransformer(code_dim=code_dim, cond_mode='text', latent_dim=latent_dim, ff_size=ff_size,
+                                    num_layers=n_layers, num_heads=n_heads, dropout=0.1, clip_dim=512,
+                                    shared_codebook=False, cond_drop_prob=0.1, share_weight=share_weight,
+                                    clip_version=None, opt=opt)
+    vq_model = RVQVAE(opt, dim_pose, num_tokens, code_dim, code_dim, 2, 2, 512, 3, 3, 'relu', None)
+    return tuple(m.to(device).eval() for m in (t2m_transformer, res_model, vq_model))
+
+
+class HashTextEncoder:
+    '''
+    Stand-in for the CLIP text encoder: every prompt maps to a fixed random (clip_dim,) vector seeded by its
+    crc32, so string conditions work without downloading CLIP.
+    '''
+    def __init__(self, clip_dim=512):
+        self.clip_dim = clip_dim
+
+    def encode(self, raw_text, device, use_cache=True):
+        embeddings = [torch.randn(self.clip_dim, generator=torch.Generator().manual_seed(zlib.crc32(t.encode())))
+                      for t in raw_text]
+        return torch.stack(embeddings, dim=0).to(device)
+
+
+def stub_text_encoder(*models):
+    for model in models:
+        model.text_encoder = HashTextEncoder(model.clip_dim)
+
+
+def random_inputs(bs, max_tokens=49, device='cpu', seed=0):
+    '''
+    :return: random (b, 512) condition vectors and (b,) token lengths between max_tokens // 2 and max_tokens
+    '''
+    g = torch.Generator().manual_seed(seed)
+    cond_vector = torch.randn(bs, 512, generator=g).to(device)
+    token_lens = torch.randint(max_tokens // 2, max_tokens + 1, (bs,), generator=g).to(device)
+    return cond_vector, token_lens
+
+
+def sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_fn(fn, repeats=10, warmup=2, device='cpu'):
+    '''
+    :return: median and min wall time of fn() in milliseconds
+    '''
+    for _ in range(warmup):
+        fn()
+    sync(device)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        sync(device)
+        times.append((time.perf_counter() - start) * 1000.)
+    return float(np.median(times)), float(np.min(times))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _child(fn, args, conn):
+    try:
+        result = fn(*args)
+        conn.send((result, peak_rss_mb(), None))
+    except Exception as e:
+        conn.send((None, peak_rss_mb(), repr(e)))
+    conn.close()
+
+
+def run_isolated(fn, *args):
+    '''
+    Run fn(*args) in a forked child so that its peak RSS is not hidden by earlier measurements.
+    :return: (result of fn, peak RSS of the child in MB)
+    '''
+    ctx = mp.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(fn, args, child_conn))
+    p.start()
+    result, rss, error = parent_conn.recv()
+    p.join()
+    if error is not None:
+        raise RuntimeError(f'Benchmark child failed: {error}')
+    return result, rss
+
+
+def print_table(header, rows):
+    widths = [max([len(str(h))] + [len(str(r[i])) for r in rows]) for i, h in enumerate(header)]
+    print('  '.join(str(h).rjust(w) for h, w in zip(header, widths)))
+    for r in rows:
+        print('  '.join(str(v).rjust(w) for v, w in zip(r, widths)))
@@ -0,0 +1,340 @@
+'''
+Checkpoint-free benchmark suite of the inference and training hot paths. Models are built with random weights
+and a hashing stand-in for the CLIP text encoder; the motion-side cases (recover_from_ric, IK, foot-skate removal,
+rendering, BVH save) run on example_data/000612.npy. Every case is timed over a grid of batch sizes and lengths
+(in motion tokens, 4 frames each) and written to a JSON file, which can be compared against the file of another
+commit.
+
+    python -m benchmarks.run_suite --out bench_new.json
+    python -m benchmarks.run_suite --cases generate forward_decoder --compare bench_old.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.optim as optim
+from argparse import Namespace
+
+from benchmarks.common import build_models, stub_text_encoder, time_fn, print_table
+from models.mask_transformer.transformer_trainer import MaskTransformerTrainer, ResidualTransformerTrainer
+from models.vq.vq_trainer import RVQTokenizerTrainer
+from utils.metrics import (calculate_activation_statistics, calculate_frechet_distance, calculate_R_precision,
+                           calculate_diversity, calculate_matching_score)
+from utils.motion_process import recover_from_ric
+from utils.paramUtil import t2m_kinematic_chain
+from utils.plot_script import plot_3d_motion
+from visualization import BVH_mod as BVH
+from visualization.joints2bvh import Joint2BVHConvertor
+from visualization.remove_fs import remove_fs
+
+UNIT_LENGTH = 4
+
+
+class SuiteContext:
+    '''
+    Lazily built, shared inputs of the benchmark cases.
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.device = args.device
+        self.tmp_dir = tempfile.mkdtemp(prefix='momask_bench_')
+        self._models = None
+        self._converter = None
+        self._example = None
+
+    @property
+    def models(self):
+        if self._models is None:
+            self._models = build_models(self.device)
+            stub_text_encoder(*self._models[:2])
+        return self._models
+
+    @property
+    def converter(self):
+        if self._converter is None:
+            self._converter = Joint2BVHConvertor()
+        return self._converter
+
+    def captions(self, bs):
+        return ['a person walks forward and turns around %d' % i for i in range(bs)]
+
+    def token_lens(self, bs, num_tokens):
+        return torch.full((bs,), num_tokens, dtype=torch.long, device=self.device)
+
+    def features(self, num_tokens):
+        '''
+        :return: (frames, 263) motion features of the example motion, tiled up to num_tokens * 4 frames
+        '''
+        if self._example is None:
+            self._example = np.load('example_data/000612.npy')
+        frames = num_tokens * UNIT_LENGTH
+        reps = int(np.ceil(frames / len(self._example)))
+        return np.concatenate([self._example] * reps, axis=0)[:frames]
+
+    def joints(self, num_tokens):
+        return recover_from_ric(torch.from_numpy(self.features(num_tokens)).float(), 22).numpy()
+
+
+def case_generate(ctx, bs, num_tokens):
+    t2m_transformer, res_model, vq_model = ctx.models
+    captions, token_lens = ctx.captions(bs), ctx.token_lens(bs, num_tokens)
+
+    def run():
+        with torch.no_grad():
+            mids = t2m_transformer.generate(captions, token_lens, timesteps=ctx.args.time_steps, cond_scale=4)
+            mids = res_model.generate(mids, captions, token_lens, temperature=1, cond_scale=5)
+            return vq_model.forward_decoder(mids)
+    return run
+
+
+def case_mask_generate(ctx, bs, num_tokens):
+    t2m_transformer = ctx.models[0]
+    captions, token_lens = ctx.captions(bs), ctx.token_lens(bs, num_tokens)
+    return lambda: t2m_transformer.generate(captions, token_lens, timesteps=ctx.args.time_steps, cond_scale=4)
+
+
+def case_res_generate(ctx, bs, num_tokens):
+    t2m_transformer, res_model, _ = ctx.models
+    captions, token_lens = ctx.captions(bs), ctx.token_lens(bs, num_tokens)
+    base_ids = torch.randint(0, t2m_transformer.mask_id, (bs, num_tokens), device=ctx.device)
+    return lambda: res_model.generate(base_ids, captions, token_lens, temperature=1, cond_scale=5)
+
+
+def case_forward_decoder(ctx, bs, num_tokens):
+    vq_model = ctx.models[2]
+    num_codes = vq_model.quantizer.codebooks.shape[1]
+    ids = torch.randint(0, num_codes, (bs, num_tokens, vq_model.quantizer.num_quantizers), device=ctx.device)
+
+    def run():
+        with torch.no_grad():
+            return vq_model.forward_decoder(ids)
+    return run
+
+
+def case_recover_from_ric(ctx, bs, num_tokens):
+    features = torch.from_numpy(np.stack([ctx.features(num_tokens)] * bs)).float()
+    return lambda: recover_from_ric(features, 22)
+
+
+def case_ik_convert(ctx, bs, num_tokens):
+    joints = ctx.joints(num_tokens)
+    return lambda: ctx.converter.convert(joints, filename=None, iterations=100, foot_ik=False)
+
+
+def case_ik_convert_foot_ik(ctx, bs, num_tokens):
+    joints = ctx.joints(num_tokens)
+    return lambda: ctx.converter.convert(joints, filename=None, iterations=100, foot_ik=True)
+
+
+def case_remove_fs(ctx, bs, num_tokens):
+    joints = ctx.joints(num_tokens)[:, ctx.converter.re_order]
+    return lambda: remove_fs(joints.copy(), None, fid_l=(3, 4), fid_r=(7, 8), interp_length=5, force_on_floor=True)
+
+
+def case_plot_3d_motion(ctx, bs, num_tokens):
+    joints = ctx.joints(num_tokens)
+    path = os.path.join(ctx.tmp_dir, 'bench.gif')
+    return lambda: plot_3d_motion(path, t2m_kinematic_chain, joints, title='benchmark', fps=20)
+
+
+def case_bvh_save(ctx, bs, num_tokens):
+    anim, _ = ctx.converter.convert(ctx.joints(num_tokens), filename=None, iterations=10, foot_ik=False)
+    path = os.path.join(ctx.tmp_dir, 'bench.bvh')
+    return lambda: BVH.save(path, anim, names=anim.names, frametime=1 / 20, order='zyx', quater=True)
+
+
+def _train_batch(ctx, bs, num_tokens):
+    motion = torch.from_numpy(np.stack([ctx.features(num_tokens)] * bs)).float()
+    m_lens = torch.full((bs,), num_tokens * UNIT_LENGTH, dtype=torch.long)
+    return ctx.captions(bs), motion, m_lens
+
+
+def case_mask_trainer_step(ctx, bs, num_tokens):
+    t2m_transformer, _, vq_model = ctx.models
+    trainer = MaskTransformerTrainer(Namespace(device=ctx.device, is_train=False), t2m_transformer, vq_model)
+    trainer.opt_t2m_transformer = optim.AdamW(t2m_transformer.parameters(), lr=1e-4)
+    trainer.scheduler = optim.lr_scheduler.MultiStepLR(trainer.opt_t2m_transformer, milestones=[10 ** 9])
+    batch = _train_batch(ctx, bs, num_tokens)
+
+    def run():
+        t2m_transformer.train()
+        trainer.update(batch)
+        t2m_transformer.eval()
+    return run
+
+
+def case_res_trainer_step(ctx, bs, num_tokens):
+    _, res_model, vq_model = ctx.models
+    trainer = ResidualTransformerTrainer(Namespace(device=ctx.device, is_train=False), res_model, vq_model)
+    trainer.opt_res_transformer = optim.AdamW(res_model.parameters(), lr=1e-4)
+    trainer.scheduler = optim.lr_scheduler.MultiStepLR(trainer.opt_res_transformer, milestones=[10 ** 9])
+    batch = _train_batch(ctx, bs, num_tokens)
+
+    def run():
+        res_model.train()
+        trainer.update(batch)
+        res_model.eval()
+    return run
+
+
+def case_vq_trainer_step(ctx, bs, num_tokens):
+    vq_model = ctx.models[2]
+    trainer = RVQTokenizerTrainer(Namespace(device=ctx.device, is_train=False, joints_num=22, loss_vel=0.5,
+                                            commit=0.02), vq_model)
+    trainer.l1_criterion = torch.nn.SmoothL1Loss()
+    opt_vq_model = optim.AdamW(vq_model.parameters(), lr=1e-4)
+    motion = _train_batch(ctx, bs, num_tokens)[1]
+    # The EMA codebooks initialise themselves from the first training batch, which would keep that batch's graph
+    # alive in the codebook buffers and fail the second backward. Initialise them once on detached latents.
+    with torch.no_grad():
+        residual = vq_model.encoder(vq_model.preprocess(motion.to(ctx.device)))
+        for layer in vq_model.quantizer.layers:
+            layer.train()
+            residual = residual - layer(residual)[0]
+            layer.eval()
+
+    def run():
+        vq_model.train()
+        loss = trainer.forward(motion)[0]
+        opt_vq_model.zero_grad()
+        loss.backward()
+        opt_vq_model.step()
+        vq_model.eval()
+    return run
+
+
+def case_metrics(ctx, bs, num_tokens):
+    # One evaluation batch is 32 samples, bs counts evaluation batches here
+    rng = np.random.RandomState(0)
+    num_samples = 32 * bs
+    motion_emb, text_emb = rng.randn(num_samples, 512), rng.randn(num_samples, 512)
+    gt_mu, gt_cov = calculate_activation_statistics(rng.randn(max(num_samples, 600), 512))
+
+    def run():
+        for i in range(0, num_samples, 32):
+            calculate_R_precision(text_emb[i:i + 32], motion_emb[i:i + 32], top_k=3, sum_all=True)
+            calculate_matching_score(text_emb[i:i + 32], motion_emb[i:i + 32], sum_all=True)
+        mu, cov = calculate_activation_statistics(motion_emb)
+        calculate_frechet_distance(gt_mu, gt_cov, mu, cov)
+        calculate_diversity(motion_emb, min(300, num_samples - 1))
+    return run
+
+
+# name -> (setup, batched): unbatched cases process one motion and only run at batch size 1
+CASES = {
+    'generate': (case_generate, True),
+    'mask_generate': (case_mask_generate, True),
+    'res_generate': (case_res_generate, True),
+    'forward_decoder': (case_forward_decoder, True),
+    'recover_from_ric': (case_recover_from_ric, True),
+    'ik_convert': (case_ik_convert, False),
+    'ik_convert_foot_ik': (case_ik_convert_foot_ik, False),
+    'remove_fs': (case_remove_fs, False),
+    'plot_3d_motion': (case_plot_3d_motion, False),
+    'bvh_save': (case_bvh_save, False),
+    'mask_trainer_step': (case_mask_trainer_step, True),
+    'res_trainer_step': (case_res_trainer_step, True),
+    'vq_trainer_step': (case_vq_trainer_step, True),
+    'metrics': (case_metrics, True),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    ctx = SuiteContext(args)
+    results = []
+    for name in args.cases:
+        setup, batched = CASES[name]
+        batch_sizes = args.batch_sizes if batched else [1]
+        lengths = args.lengths if name != 'metrics' else [0]
+        for bs in batch_sizes:
+            for num_tokens in lengths:
+                repeats = args.slow_repeats if not batched else args.repeats
+                try:
+                    fn = setup(ctx, bs, num_tokens)
+                    median_ms, min_ms = time_fn(fn, repeats, warmup=1, device=args.device)
+                except Exception as e:
+                    # A failing case must not throw away the timings of the others
+                    results.append({'case': name, 'batch_size': bs, 'tokens': num_tokens, 'error': repr(e)})
+                    print('%-20s bs=%-4d tokens=%-4d     FAILED %r' % (name, bs, num_tokens, e))
+                    continue
+                results.append({'case': name, 'batch_size': bs, 'tokens': num_tokens,
+                                'median_ms': round(median_ms, 3), 'min_ms': round(min_ms, 3)})
+                print('%-20s bs=%-4d tokens=%-4d %10.2f ms' % (name, bs, num_tokens, median_ms))
+    meta = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'device': args.device,
+            'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'threads': torch.get_num_threads(),
+            'time_steps': args.time_steps, 'repeats': args.repeats}
+    return {'meta': meta, 'results': results}
+
+
+def compare(report, baseline, threshold):
+    '''
+    :return: number of cases slower than the baseline by more than threshold (relative)
+    '''
+    base = {(r['case'], r['batch_size'], r['tokens']): r for r in baseline['results'] if 'error' not in r}
+    rows = []
+    regressions = 0
+    for r in report['results']:
+        key = (r['case'], r['batch_size'], r['tokens'])
+        if 'error' in r or key not in base:
+            continue
+        ratio = r['median_ms'] / max(base[key]['median_ms'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        rows.append([r['case'], r['batch_size'], r['tokens'], '%.2f' % base[key]['median_ms'],
+                     '%.2f' % r['median_ms'], '%.2fx' % ratio, flag])
+    print('Baseline commit: %s' % baseline['meta'].get('commit'))
+    print_table(['case', 'bs', 'tokens', 'baseline ms', 'current ms', 'ratio', ''], rows)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--cases', type=str, nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[16, 49], help='Motion lengths in tokens')
+    parser.add_argument('--time_steps', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--slow_repeats', type=int, default=2, help='Repeats of the single-motion cases (IK, rendering)')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default='', help='Result JSON, defaults to bench_<commit>.json')
+    parser.add_argument('--compare', type=str, default='', help='Baseline result JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    parser.add_argument('--fail_on_regression', action='store_true')
+    args = parser.parse_args()
+
+    report = run_suite(args)
+    out = args.out or 'bench_%s.json' % (report['meta']['commit'] or 'local')[:8]
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to %s' % out)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
@@ -0,0 +1,202 @@
+import json
+import math
+import os
+from os.path import join as pjoin
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from gen_t2m import get_generation_models, save_text_cache
+from models.mask_transformer.tools import GuidanceSchedule, categorical_sample
+from options.eval_option import BulkGenT2MOptions
+from utils.batching import length_bucketed_batches
+from utils.fixseed import fixseed
+from utils.lazy_import import lazy_from
+from utils.motion_process import recover_from_ric
+from utils.paramUtil import t2m_kinematic_chain
+
+# Only the export stages need the IK / BVH stack and matplotlib
+plot_3d_motion = lazy_from('utils.plot_script', 'plot_3d_motion', 'plotting')
+Joint2BVHConvertor = lazy_from('visualization.joints2bvh', 'Joint2BVHConvertor', 'visualization', ('utils.plot_script',))
+
+# Stages recorded in the checkpoint, the export stages only run over shards that finished generating
+STAGES = ('generate', 'bvh', 'animation')
+
+
+def read_prompts(path):
+    '''
+    :return: list of {"text", optional "length" (frames), optional "seed"}, sample ids are positions in this list
+    '''
+    prompts = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                prompts.append(json.loads(line))
+    return prompts
+
+
+def load_index(path, prompt_jsonl, num_prompts, shard_size):
+    '''
+    The index lists the finished shards and which stages completed on each of them; it doubles as the checkpoint.
+    '''
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if index['num_prompts'] != num_prompts or index['shard_size'] != shard_size:
+            raise ValueError(f'{path} was written for a different prompt file or shard size, use another --out_dir')
+        print(f'Resuming from {path}: {len(index["completed"]["generate"])} shards already generated')
+        return index
+    return {'prompt_jsonl': os.path.abspath(prompt_jsonl), 'num_prompts': num_prompts, 'shard_size': shard_size,
+            'shards': {}, 'completed': {stage: [] for stage in STAGES}}
+
+
+def save_index(path, index):
+    # Write-then-rename, so a crash never leaves a truncated checkpoint behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+@torch.no_grad()
+def generate_shard(opt, models, prompts, first_id, guidance):
+    '''
+    Generate one shard. Every sample draws from its own generator seeded by its "seed" (opt.seed + id if missing),
+    and only over its own length, and is decoded together with samples of the same length only (no padding), so a
+    regenerated shard is the same, up to float rounding, whatever micro-batches its samples end up in.
+    :return: dict of arrays, motions are concatenated along time and located by offsets / lengths
+    '''
+    num = len(prompts)
+    ids = np.arange(first_id, first_id + num)
+    texts = [p['text'] for p in prompts]
+    seeds = [int(p['seed']) if p.get('seed') is not None else opt.seed + int(i) for p, i in zip(prompts, ids)]
+    generators = []
+    for seed in seeds:
+        g = torch.Generator(device=opt.device)
+        g.manual_seed(seed)
+        generators.append(g)
+
+    text_embedding = torch.cat([models.t2m_transformer.encode_text(texts[i:i + opt.max_batch_size])
+                                for i in range(0, num, opt.max_batch_size)], dim=0)
+
+    token_lens = torch.zeros(num, dtype=torch.long)
+    est_ids = []
+    for j, p in enumerate(prompts):
+        if p.get('length') is None:
+            est_ids.append(j)
+        else:
+            token_lens[j] = int(p['length']) // opt.unit_length
+    if est_ids:
+        pred_dis = models.length_estimator(text_embedding[torch.LongTensor(est_ids).to(text_embedding.device)])
+        probs = F.softmax(pred_dis, dim=-1)  # (b, ntoken)
+        token_lens[est_ids] = categorical_sample(probs, [generators[j] for j in est_ids]).cpu()
+    token_lens = token_lens.to(opt.device)
+
+    if opt.token_budget > 0:
+        batches = length_bucketed_batches(token_lens.tolist(), opt.token_budget, opt.max_batch_size)
+    else:
+        batches = [list(range(i, min(i + opt.max_batch_size, num))) for i in range(0, num, opt.max_batch_size)]
+
+    features = [None] * num
+    joints = [None] * num
+    for batch_ids in batches:
+        idx = torch.LongTensor(batch_ids).to(opt.device)
+        batch_generators = [generators[j] for j in batch_ids]
+        mids = models.t2m_transformer.generate(text_embedding[idx], token_lens[idx],
+                                               timesteps=opt.time_steps,
+                                               cond_scale=opt.cond_scale,
+                                               temperature=opt.temperature,
+                                               topk_filter_thres=opt.topkr,
+                                               gsample=opt.gumbel_sample,
+                                               generators=batch_generators,
+                                               guidance=guidance)
+        mids = models.res_model.generate(mids, text_embedding[idx], token_lens[idx], temperature=1, cond_scale=5,
+                                         generators=batch_generators, guidance=guidance)
+        # Padding reaches the last frames through the decoder's convolutions: decode equal lengths together
+        batch_lens = token_lens[idx].tolist()
+        for length in sorted(set(batch_lens)):
+            rows = [k for k, n in enumerate(batch_lens) if n == length]
+            pred_motions = models.vq_model.forward_decoder(mids[rows, :length]).detach().cpu().numpy()
+            for k, motion in zip(rows, pred_motions):
+                j = batch_ids[k]
+                motion = motion[:length * opt.unit_length] * models.std + models.mean
+                features[j] = motion.astype(np.float32)
+                joints[j] = recover_from_ric(torch.from_numpy(features[j]).float(), opt.nb_joints).numpy()
+
+    lengths = np.array([len(f) for f in features])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    return dict(ids=ids, texts=np.array(texts), seeds=np.array(seeds), lengths=lengths, offsets=offsets,
+                features=np.concatenate(features, axis=0), joints=np.concatenate(joints, axis=0))
+
+
+def export_shard(out_dir, shard_path, stage, converter=None):
+    shard = np.load(shard_path)
+    stage_dir = pjoin(out_dir, 'bvh' if stage == 'bvh' else 'animations')
+    os.makedirs(stage_dir, exist_ok=True)
+    # Every shard['...'] access decompresses the whole array again, read the joints once
+    joints = shard['joints']
+    for sample_id, text, offset, length in zip(shard['ids'], shard['texts'], shard['offsets'], shard['lengths']):
+        joint = joints[offset:offset + length]
+        if stage == 'bvh':
+            converter.convert(joint, filename=pjoin(stage_dir, '%07d.bvh' % sample_id), iterations=100, foot_ik=False)
+        else:
+            plot_3d_motion(pjoin(stage_dir, '%07d.mp4' % sample_id), t2m_kinematic_chain, joint, title=str(text), fps=20)
+
+
+if __name__ == '__main__':
+    parser = BulkGenT2MOptions()
+    opt = parser.parse()
+    fixseed(opt.seed)
+
+    opt.device = torch.device("cpu" if opt.gpu_id == -1 else "cuda:" + str(opt.gpu_id))
+    opt.nb_joints = 21 if opt.dataset_name == 'kit' else 22
+
+    out_dir = opt.out_dir if opt.out_dir != '' else pjoin('./generation', opt.ext)
+    shard_dir = pjoin(out_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    prompts = read_prompts(opt.prompt_jsonl)
+    num_shards = math.ceil(len(prompts) / opt.shard_size)
+    index_path = pjoin(out_dir, 'index.json')
+    index = load_index(index_path, opt.prompt_jsonl, len(prompts), opt.shard_size)
+
+    if not opt.skip_generation:
+        models = get_generation_models(opt)
+        guidance = GuidanceSchedule.from_opt(opt)
+        for shard_id in range(num_shards):
+            if shard_id in index['completed']['generate']:
+                continue
+            first_id = shard_id * opt.shard_size
+            shard_prompts = prompts[first_id:first_id + opt.shard_size]
+            print('-->Shard %d/%d, prompts %d-%d' % (shard_id + 1, num_shards, first_id, first_id + len(shard_prompts) - 1))
+
+            shard = generate_shard(opt, models, shard_prompts, first_id, guidance)
+            shard_file = 'shard_%05d.npz' % shard_id
+            tmp_path = pjoin(shard_dir, 'shard_%05d.tmp.npz' % shard_id)
+            np.savez(tmp_path, **shard)
+            os.replace(tmp_path, pjoin(shard_dir, shard_file))
+
+            index['shards'][str(shard_id)] = {'file': pjoin('shards', shard_file), 'first_id': first_id,
+                                              'num_samples': len(shard_prompts),
+                                              'num_frames': int(shard['lengths'].sum())}
+            index['completed']['generate'].append(shard_id)
+            save_index(index_path, index)
+        save_text_cache(models.t2m_transformer, opt)
+
+    export_stages = [stage for stage, enabled in (('bvh', opt.export_bvh), ('animation', opt.export_animation))
+                     if enabled]
+    for stage in export_stages:
+        converter = Joint2BVHConvertor() if stage == 'bvh' else None
+        for shard_id in sorted(index['completed']['generate']):
+            if shard_id in index['completed'][stage]:
+                continue
+            print('-->%s export, shard %d' % (stage, shard_id))
+            export_shard(out_dir, pjoin(out_dir, index['shards'][str(shard_id)]['file']), stage, converter)
+            index['completed'][stage].append(shard_id)
+            save_index(index_path, index)
+
+    print('Done: %d/%d shards generated' % (len(index['completed']['generate']), num_shards))
+
+# python bulk_gen_t2m.py --gpu_id 0 --ext bulk_exp1 --prompt_jsonl prompts.jsonl --shard_size 1000 --token_budget 2048 --export_bvh
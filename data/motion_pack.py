@@ -0,0 +1,120 @@
+'''
+All motions and captions of a dataset packed into a few flat arrays, so the datasets open it in milliseconds
+instead of loading thousands of small .npy / .txt files, and forked DataLoader workers share its pages through
+the page cache instead of each holding a copy. A pack is a directory with
+
+    frames.npy         (total_frames, dim_pose) float32, every motion back to back, memory-mapped
+    offsets.npy        (num_motions,) int64, first frame of every motion
+    lengths.npy        (num_motions,) int64, frames of every motion
+    names.npy          (num_motions,) motion names, sorted
+    text.npy           uint8, the utf-8 caption files (caption#tokens#from#to lines) back to back, memory-mapped
+    text_offsets.npy   (num_motions + 1,) int64, byte range of the captions of every motion (empty if it has none)
+
+Build it once with prepare_motion_pack.py and pass it to the datasets with --packed_data.
+'''
+import codecs as cs
+import os
+from os.path import join as pjoin
+
+import numpy as np
+from tqdm import tqdm
+
+_packs = {}
+
+
+def pack_motions(motion_dir, text_dir, out_dir, names=None):
+    '''
+    Pack every motion of motion_dir (or only names) and its caption file in text_dir into out_dir.
+    '''
+    if names is None:
+        names = [f[:-len('.npy')] for f in os.listdir(motion_dir) if f.endswith('.npy')]
+    names = sorted(names)
+
+    # Headers only, to size the frame array
+    shapes = [np.load(pjoin(motion_dir, name + '.npy'), mmap_mode='r').shape for name in names]
+    lengths = np.array([s[0] for s in shapes], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    os.makedirs(out_dir, exist_ok=True)
+    frames = np.lib.format.open_memmap(pjoin(out_dir, 'frames.npy'), mode='w+', dtype=np.float32,
+                                       shape=(int(lengths.sum()), shapes[0][1]))
+    text, text_offsets = [], [0]
+    for i, name in enumerate(tqdm(names)):
+        frames[offsets[i]:offsets[i] + lengths[i]] = np.load(pjoin(motion_dir, name + '.npy'))
+        text_path = pjoin(text_dir, name + '.txt')
+        content = b''
+        if os.path.exists(text_path):
+            with cs.open(text_path) as f:
+                content = '\n'.join(line.strip() for line in f.readlines()).encode('utf-8')
+        text.append(content)
+        text_offsets.append(text_offsets[-1] + len(content))
+    frames.flush()
+
+    np.save(pjoin(out_dir, 'offsets.npy'), offsets)
+    np.save(pjoin(out_dir, 'lengths.npy'), lengths)
+    np.save(pjoin(out_dir, 'names.npy'), np.array(names))
+    np.save(pjoin(out_dir, 'text.npy'), np.frombuffer(b''.join(text), dtype=np.uint8))
+    np.save(pjoin(out_dir, 'text_offsets.npy'), np.array(text_offsets, dtype=np.int64))
+    return len(names)
+
+
+class MotionPack:
+    '''
+    Read-only view of a pack built by pack_motions. Motions are views into the memory-mapped frame array.
+    '''
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.frames = np.load(pjoin(pack_dir, 'frames.npy'), mmap_mode='r')
+        self.offsets = np.load(pjoin(pack_dir, 'offsets.npy'))
+        self.lengths = np.load(pjoin(pack_dir, 'lengths.npy'))
+        self.names = np.load(pjoin(pack_dir, 'names.npy'))
+        self.text = np.load(pjoin(pack_dir, 'text.npy'), mmap_mode='r')
+        self.text_offsets = np.load(pjoin(pack_dir, 'text_offsets.npy'))
+        self.ids = {name: i for i, name in enumerate(self.names.tolist())}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _id(self, name):
+        if name not in self.ids:
+            raise KeyError(f'Motion {name} is not in {self.pack_dir}')
+        return self.ids[name]
+
+    def motion(self, name):
+        i = self._id(name)
+        # Plain ndarray view of the mapping, slicing and normalizing it never copies the whole motion set
+        return np.asarray(self.frames[self.offsets[i]:self.offsets[i] + self.lengths[i]])
+
+    def text_lines(self, name):
+        i = self._id(name)
+        return bytes(self.text[self.text_offsets[i]:self.text_offsets[i + 1]]).decode('utf-8').splitlines()
+
+
+class MotionFiles:
+    '''
+    The unpacked dataset: one .npy per motion in motion_dir, one caption file per motion in text_dir.
+    '''
+    def __init__(self, motion_dir, text_dir):
+        self.motion_dir = motion_dir
+        self.text_dir = text_dir
+
+    def motion(self, name):
+        return np.load(pjoin(self.motion_dir, name + '.npy'))
+
+    def text_lines(self, name):
+        with cs.open(pjoin(self.text_dir, name + '.txt')) as f:
+            return f.readlines()
+
+
+def motion_source(opt):
+    '''
+    :return: the MotionPack of opt.packed_data if it is set (one per process, shared by all datasets),
+        otherwise the motion and caption files of opt.motion_dir / opt.text_dir
+    '''
+    pack_dir = getattr(opt, 'packed_data', '')
+    if not pack_dir:
+        return MotionFiles(opt.motion_dir, getattr(opt, 'text_dir', None))
+    if pack_dir not in _packs:
+        _packs[pack_dir] = MotionPack(pack_dir)
+        print(f'Reading motions from {pack_dir} ({len(_packs[pack_dir])} motions)')
+    return _packs[pack_dir]
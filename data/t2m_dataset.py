@@ -7,11 +7,29 @@ from torch.utils.data._utils.collate import default_collate
 import random
 import codecs as cs
 
+from data.motion_pack import motion_source
+
 
 def collate_fn(batch):
     batch.sort(key=lambda x: x[3], reverse=True)
     return default_collate(batch)
 
+
+def pad_collate_fn(batch):
+    '''
+    Collate Text2MotionDataset items of unpadded motions (pad_to_max = False): motions (or token ids) are zero
+    padded to the longest one of the batch only, not to max_motion_length.
+    '''
+    max_len = max(len(item[1]) for item in batch)
+    padded = []
+    for item in batch:
+        motion = item[1]
+        if len(motion) < max_len:
+            motion = np.concatenate([motion, np.zeros((max_len - len(motion),) + motion.shape[1:], dtype=motion.dtype)],
+                                    axis=0)
+        padded.append(item[:1] + (motion,) + item[2:])
+    return default_collate(padded)
+
 class MotionDataset(data.Dataset):
     def __init__(self, opt, mean, std, split_file):
         self.opt = opt
@@ -24,9 +42,10 @@ class MotionDataset(data.Dataset):
             for line in f.readlines():
                 id_list.append(line.strip())
 
+        source = motion_source(opt)
         for name in tqdm(id_list):
             try:
-                motion = np.load(pjoin(opt.motion_dir, name + '.npy'))
+                motion = source.motion(name)
                 if motion.shape[0] < opt.window_size:
                     continue
                 self.lengths.append(motion.shape[0] - opt.window_size)
@@ -65,6 +84,7 @@ class MotionDataset(data.Dataset):
 
         self.mean = mean
         self.std = std
+        self.frames = None
         print("Total number of motions {}, snippets {}".format(len(self.data), self.cumsum[-1]))
 
     def inv_transform(self, data):
@@ -73,7 +93,36 @@ class MotionDataset(data.Dataset):
     def __len__(self):
         return self.cumsum[-1]
 
+    def prepare_windows(self):
+        '''
+        Normalize all motions once into one contiguous float32 buffer, from which get_windows gathers whole batches.
+        Call it in the main process before creating the DataLoader, so the workers share the buffer.
+        '''
+        lengths = np.array([len(motion) for motion in self.data], dtype=np.int64)
+        self.motion_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        self.frames = np.concatenate([((motion - self.mean) / self.std).astype(np.float32)
+                                      for motion in self.data])
+        # Every window is read from the buffer from now on, drop the raw copies
+        self.data = None
+        print("Window buffer of {} frames ({:.1f} MB)".format(len(self.frames), self.frames.nbytes / 1024 ** 2))
+
+    def get_windows(self, items):
+        '''
+        :param items: (B,) snippet indices
+        :return: (B, window_size, dim_pose) float32, the same windows as __getitem__ of each item
+        '''
+        items = np.asarray(items, dtype=np.int64)
+        motion_id = np.maximum(np.searchsorted(self.cumsum, items) - 1, 0)
+        idx = np.where(items != 0, items - self.cumsum[motion_id] - 1, 0)
+        rows = (self.motion_starts[motion_id] + idx)[:, None] + np.arange(self.opt.window_size)
+        return self.frames[rows]
+
     def __getitem__(self, item):
+        if isinstance(item, np.ndarray):
+            # Batch of indices from WindowBatchSampler
+            return self.get_windows(item)
+        if self.frames is not None:
+            return self.get_windows(np.array([item]))[0]
         if item != 0:
             motion_id = np.searchsorted(self.cumsum, item) - 1
             idx = item - self.cumsum[motion_id] - 1
@@ -87,6 +136,68 @@ class MotionDataset(data.Dataset):
         return motion
 
 
+class WindowBatchSampler:
+    '''
+    Sampler of whole batches of MotionDataset snippet indices, for DataLoader(dataset, batch_size=None,
+    sampler=WindowBatchSampler(...)): the dataset then gathers a batch with one fancy-index (get_windows) instead
+    of collating batch_size single windows.
+    '''
+    def __init__(self, num_items, batch_size, shuffle=True, drop_last=True):
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_items // self.batch_size
+        return (self.num_items + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = np.random.permutation(self.num_items) if self.shuffle else np.arange(self.num_items)
+        for i in range(len(self)):
+            yield order[i * self.batch_size:(i + 1) * self.batch_size]
+
+
+class LengthBucketBatchSampler:
+    '''
+    Batches of Text2MotionDataset indices of similar motion length, to be padded per batch with pad_collate_fn.
+    Every epoch the indices are shuffled, cut into pools of bucket_size batches, each pool is sorted by length and
+    cut into batches, and the batches are shuffled: batches stay random, but each one spans a narrow length range.
+    '''
+    def __init__(self, lengths, batch_size, bucket_size=50, shuffle=True, drop_last=True):
+        '''
+        :param lengths: (num_items,) motion length of every item
+        :param bucket_size: batches per pool sorted by length
+        '''
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        # Pools hold whole batches, only the last batch of the last pool can be short
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+
 class Text2MotionDatasetEval(data.Dataset):
     def __init__(self, opt, mean, std, split_file, w_vectorizer):
         self.opt = opt
@@ -105,46 +216,46 @@ class Text2MotionDatasetEval(data.Dataset):
 
         new_name_list = []
         length_list = []
+        source = motion_source(opt)
         for name in tqdm(id_list):
             try:
-                motion = np.load(pjoin(opt.motion_dir, name + '.npy'))
+                motion = source.motion(name)
                 if (len(motion)) < min_motion_len or (len(motion) >= 200):
                     continue
                 text_data = []
                 flag = False
-                with cs.open(pjoin(opt.text_dir, name + '.txt')) as f:
-                    for line in f.readlines():
-                        text_dict = {}
-                        line_split = line.strip().split('#')
-                        caption = line_split[0]
-                        tokens = line_split[1].split(' ')
-                        f_tag = float(line_split[2])
-                        to_tag = float(line_split[3])
-                        f_tag = 0.0 if np.isnan(f_tag) else f_tag
-                        to_tag = 0.0 if np.isnan(to_tag) else to_tag
-
-                        text_dict['caption'] = caption
-                        text_dict['tokens'] = tokens
-                        if f_tag == 0.0 and to_tag == 0.0:
-                            flag = True
-                            text_data.append(text_dict)
-                        else:
-                            try:
-                                n_motion = motion[int(f_tag*20) : int(to_tag*20)]
-                                if (len(n_motion)) < min_motion_len or (len(n_motion) >= 200):
-                                    continue
+                for line in source.text_lines(name):
+                    text_dict = {}
+                    line_split = line.strip().split('#')
+                    caption = line_split[0]
+                    tokens = line_split[1].split(' ')
+                    f_tag = float(line_split[2])
+                    to_tag = float(line_split[3])
+                    f_tag = 0.0 if np.isnan(f_tag) else f_tag
+                    to_tag = 0.0 if np.isnan(to_tag) else to_tag
+
+                    text_dict['caption'] = caption
+                    text_dict['tokens'] = tokens
+                    if f_tag == 0.0 and to_tag == 0.0:
+                        flag = True
+                        text_data.append(text_dict)
+                    else:
+                        try:
+                            n_motion = motion[int(f_tag*20) : int(to_tag*20)]
+                            if (len(n_motion)) < min_motion_len or (len(n_motion) >= 200):
+                                continue
+                            new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
+                            while new_name in data_dict:
                                 new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
-                                while new_name in data_dict:
-                                    new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
-                                data_dict[new_name] = {'motion': n_motion,
-                                                       'length': len(n_motion),
-                                                       'text':[text_dict]}
-                                new_name_list.append(new_name)
-                                length_list.append(len(n_motion))
-                            except:
-                                print(line_split)
-                                print(line_split[2], line_split[3], f_tag, to_tag, name)
-                                # break
+                            data_dict[new_name] = {'motion': n_motion,
+                                                   'length': len(n_motion),
+                                                   'text':[text_dict]}
+                            new_name_list.append(new_name)
+                            length_list.append(len(n_motion))
+                        except:
+                            print(line_split)
+                            print(line_split[2], line_split[3], f_tag, to_tag, name)
+                            # break
 
                 if flag:
                     data_dict[name] = {'motion': motion,
@@ -228,8 +339,18 @@ class Text2MotionDatasetEval(data.Dataset):
 
 
 class Text2MotionDataset(data.Dataset):
-    def __init__(self, opt, mean, std, split_file):
+    def __init__(self, opt, mean, std, split_file, text_embeddings=None, token_cache=None):
+        '''
+        :param text_embeddings: optional CaptionEmbeddingStore, items then also return the caption's precomputed
+            CLIP embedding
+        :param token_cache: optional RVQTokenCache, items then hold the crop's RVQ token ids
+            ((max_motion_length // unit_length, num_quantizers) int64, padded like the motions) in place of the motion
+        '''
         self.opt = opt
+        self.text_embeddings = text_embeddings
+        self.token_cache = token_cache
+        # False: items are not padded to max_motion_length, batches are padded by pad_collate_fn
+        self.pad_to_max = True
         self.max_length = 20
         self.pointer = 0
         self.max_motion_length = opt.max_motion_length
@@ -244,52 +365,54 @@ class Text2MotionDataset(data.Dataset):
 
         new_name_list = []
         length_list = []
+        source = motion_source(opt)
         for name in tqdm(id_list):
             try:
-                motion = np.load(pjoin(opt.motion_dir, name + '.npy'))
+                motion = source.motion(name)
                 if (len(motion)) < min_motion_len or (len(motion) >= 200):
                     continue
                 text_data = []
                 flag = False
-                with cs.open(pjoin(opt.text_dir, name + '.txt')) as f:
-                    for line in f.readlines():
-                        text_dict = {}
-                        line_split = line.strip().split('#')
-                        # print(line)
-                        caption = line_split[0]
-                        tokens = line_split[1].split(' ')
-                        f_tag = float(line_split[2])
-                        to_tag = float(line_split[3])
-                        f_tag = 0.0 if np.isnan(f_tag) else f_tag
-                        to_tag = 0.0 if np.isnan(to_tag) else to_tag
-
-                        text_dict['caption'] = caption
-                        text_dict['tokens'] = tokens
-                        if f_tag == 0.0 and to_tag == 0.0:
-                            flag = True
-                            text_data.append(text_dict)
-                        else:
-                            try:
-                                n_motion = motion[int(f_tag*20) : int(to_tag*20)]
-                                if (len(n_motion)) < min_motion_len or (len(n_motion) >= 200):
-                                    continue
+                for line in source.text_lines(name):
+                    text_dict = {}
+                    line_split = line.strip().split('#')
+                    # print(line)
+                    caption = line_split[0]
+                    tokens = line_split[1].split(' ')
+                    f_tag = float(line_split[2])
+                    to_tag = float(line_split[3])
+                    f_tag = 0.0 if np.isnan(f_tag) else f_tag
+                    to_tag = 0.0 if np.isnan(to_tag) else to_tag
+
+                    text_dict['caption'] = caption
+                    text_dict['tokens'] = tokens
+                    if f_tag == 0.0 and to_tag == 0.0:
+                        flag = True
+                        text_data.append(text_dict)
+                    else:
+                        try:
+                            n_motion = motion[int(f_tag*20) : int(to_tag*20)]
+                            if (len(n_motion)) < min_motion_len or (len(n_motion) >= 200):
+                                continue
+                            new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
+                            while new_name in data_dict:
                                 new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
-                                while new_name in data_dict:
-                                    new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
-                                data_dict[new_name] = {'motion': n_motion,
-                                                       'length': len(n_motion),
-                                                       'text':[text_dict]}
-                                new_name_list.append(new_name)
-                                length_list.append(len(n_motion))
-                            except:
-                                print(line_split)
-                                print(line_split[2], line_split[3], f_tag, to_tag, name)
-                                # break
+                            data_dict[new_name] = {'motion': n_motion,
+                                                   'length': len(n_motion),
+                                                   'text':[text_dict],
+                                                   'key': '%s#%d#%d' % (name, int(f_tag*20), int(to_tag*20))}
+                            new_name_list.append(new_name)
+                            length_list.append(len(n_motion))
+                        except:
+                            print(line_split)
+                            print(line_split[2], line_split[3], f_tag, to_tag, name)
+                            # break
 
                 if flag:
                     data_dict[name] = {'motion': motion,
                                        'length': len(motion),
-                                       'text': text_data}
+                                       'text': text_data,
+                                       'key': name}
                     new_name_list.append(name)
                     length_list.append(len(motion))
             except Exception as e:
@@ -329,18 +452,27 @@ class Text2MotionDataset(data.Dataset):
         elif coin2 == 'single':
             m_length = (m_length // self.opt.unit_length) * self.opt.unit_length
         idx = random.randint(0, len(motion) - m_length)
-        motion = motion[idx:idx+m_length]
+        if self.token_cache is not None:
+            # The crop's tokens were encoded offline (prepare_token_cache.py), the trainers skip the VQ encoder
+            pad_to = self.max_motion_length if self.pad_to_max else m_length
+            motion = self.token_cache.tokens(data['key'], m_length, idx, pad_to // self.opt.unit_length)
+        else:
+            motion = self.normalize_crop(motion[idx:idx+m_length], m_length, pad=self.pad_to_max)
+        # print(word_embeddings.shape, motion.shape)
+        # print(tokens)
+        if self.text_embeddings is not None:
+            return caption, motion, m_length, self.text_embeddings.embedding(self.text_embeddings.row(caption))
+        return caption, motion, m_length
 
+    def normalize_crop(self, motion, m_length, pad=True):
         "Z Normalization"
         motion = (motion - self.mean) / self.std
 
-        if m_length < self.max_motion_length:
+        if pad and m_length < self.max_motion_length:
             motion = np.concatenate([motion,
                                      np.zeros((self.max_motion_length - m_length, motion.shape[1]))
                                      ], axis=0)
-        # print(word_embeddings.shape, motion.shape)
-        # print(tokens)
-        return caption, motion, m_length
+        return motion
 
     def reset_min_len(self, length):
         assert length <= self.max_motion_length
@@ -0,0 +1,83 @@
+'''
+Precomputed CLIP embeddings of the dataset captions, so training does not run the frozen text encoder on
+every batch. A store is a directory with
+
+    embeddings.npy   (num_captions, clip_dim) float32, opened memory-mapped
+    index.json       {'clip_version': ..., 'captions': {normalized caption: row}}
+
+Build it once with prepare_text_embeddings.py and pass it to training with --text_embeddings.
+'''
+import codecs as cs
+import json
+import os
+from os.path import join as pjoin
+
+import numpy as np
+from tqdm import tqdm
+
+from models.text_encoder import normalize_prompt
+
+
+def read_captions(text_dir):
+    '''
+    :return: every distinct (normalized) caption of the .txt files in text_dir, sorted
+    '''
+    captions = set()
+    for name in sorted(os.listdir(text_dir)):
+        if not name.endswith('.txt'):
+            continue
+        with cs.open(pjoin(text_dir, name)) as f:
+            for line in f.readlines():
+                caption = line.strip().split('#')[0]
+                if caption:
+                    captions.add(normalize_prompt(caption))
+    return sorted(captions)
+
+
+def build_caption_embeddings(text_dir, out_dir, text_encoder, clip_version, batch_size=256):
+    '''
+    Encode every caption of text_dir with text_encoder (a CLIPTextEncoder) and write the store to out_dir.
+    '''
+    captions = read_captions(text_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = None
+    for i in tqdm(range(0, len(captions), batch_size)):
+        batch = text_encoder.encode(captions[i:i + batch_size], device='cpu', use_cache=False).numpy()
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(pjoin(out_dir, 'embeddings.npy'), mode='w+', dtype=np.float32,
+                                                   shape=(len(captions), batch.shape[1]))
+        embeddings[i:i + len(batch)] = batch
+    if embeddings is not None:
+        embeddings.flush()
+    with open(pjoin(out_dir, 'index.json'), 'w') as f:
+        json.dump({'clip_version': clip_version, 'captions': {c: i for i, c in enumerate(captions)}}, f)
+    return len(captions)
+
+
+class CaptionEmbeddingStore:
+    '''
+    Read-only view of a store built by build_caption_embeddings.
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(pjoin(store_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.clip_version = index['clip_version']
+        self.rows = index['captions']
+        self.embeddings = np.load(pjoin(store_dir, 'embeddings.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row(self, caption):
+        '''
+        :return: row of caption in the embedding array
+        '''
+        key = normalize_prompt(caption)
+        if key not in self.rows:
+            raise KeyError(f'Caption "{caption}" is not in {self.store_dir}, rebuild it with prepare_text_embeddings.py')
+        return self.rows[key]
+
+    def embedding(self, row):
+        # Copy out of the memory map, so the batch does not keep the file mapped in the loader workers
+        return np.array(self.embeddings[row], dtype=np.float32)
@@ -0,0 +1,152 @@
+'''
+Precomputed RVQ token ids of every training crop, so the transformer trainers do not run the frozen VQ
+encoder on every batch. Text2MotionDataset only crops a motion to (len // unit) * unit frames (or one unit less)
+starting at one of the few offsets that leaves, so all of its crops can be encoded once. A cache is a directory
+with
+
+    tokens.npy   (num_tokens, num_quantizers) uint16, the tokens of all crops back to back, memory-mapped
+    index.json   {'meta': ..., 'crops': {motion key: {crop length: first row}}}
+
+The crops of one (motion, length) are stored by start offset, each crop_len // unit rows long. meta records
+what the tokens depend on (VQ weights, normalization, lengths); a cache whose meta does not match the training
+setup is stale and not used. Build it with prepare_token_cache.py.
+'''
+import hashlib
+import json
+import os
+from os.path import join as pjoin
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def _digest(*arrays):
+    h = hashlib.sha1()
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+def token_cache_meta(vq_model, mean, std, opt):
+    '''
+    Everything the cached token ids depend on; compared as a whole to decide if a cache is stale.
+    '''
+    vq_digest = _digest(*[t.detach().cpu().numpy() for t in vq_model.state_dict().values()])
+    return {'dataset_name': opt.dataset_name, 'vq_digest': vq_digest, 'norm_digest': _digest(mean, std),
+            'unit_length': opt.unit_length, 'max_motion_length': opt.max_motion_length}
+
+
+def crop_lengths(length, unit_length):
+    # The crop lengths Text2MotionDataset.__getitem__ can draw for a motion of length frames
+    lengths = [(length // unit_length) * unit_length]
+    if unit_length < 10:
+        lengths.append((length // unit_length - 1) * unit_length)
+    return lengths
+
+
+@torch.no_grad()
+def build_token_cache(dataset, vq_model, out_dir, meta, device, batch_size=256):
+    '''
+    Encode every crop of every motion of dataset (Text2MotionDataset, without a token cache) and write the
+    cache to out_dir. Motions shared by several datasets (splits) can be added by calling this once with all
+    of them concatenated in a list.
+    :param dataset: Text2MotionDataset or a list of them
+    '''
+    datasets = dataset if isinstance(dataset, (list, tuple)) else [dataset]
+    vq_model.to(device).eval()
+    unit_length, max_motion_length = meta['unit_length'], meta['max_motion_length']
+
+    # Every (motion key, crop length, start) to encode, in storage order
+    jobs, crops, num_rows = [], {}, 0
+    for ds in datasets:
+        for entry in ds.data_dict.values():
+            if entry['key'] in crops:
+                continue
+            crops[entry['key']] = {}
+            for crop_len in crop_lengths(entry['length'], unit_length):
+                crops[entry['key']][str(crop_len)] = num_rows
+                for start in range(entry['length'] - crop_len + 1):
+                    jobs.append((ds, entry, crop_len, start, num_rows))
+                    num_rows += crop_len // unit_length
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokens = None
+    for i in tqdm(range(0, len(jobs), batch_size)):
+        batch = jobs[i:i + batch_size]
+        motions = np.zeros((len(batch), max_motion_length, batch[0][1]['motion'].shape[1]), dtype=np.float32)
+        for j, (ds, entry, crop_len, start, _) in enumerate(batch):
+            # Same normalization and zero padding as Text2MotionDataset.__getitem__
+            motions[j] = ds.normalize_crop(entry['motion'][start:start + crop_len], crop_len)
+        code_idx, _ = vq_model.encode(torch.from_numpy(motions).to(device))
+        code_idx = code_idx.cpu().numpy()
+        if tokens is None:
+            tokens = np.lib.format.open_memmap(pjoin(out_dir, 'tokens.npy'), mode='w+', dtype=np.uint16,
+                                               shape=(num_rows, code_idx.shape[-1]))
+        for j, (_, _, crop_len, _, row) in enumerate(batch):
+            tokens[row:row + crop_len // unit_length] = code_idx[j, :crop_len // unit_length]
+    if tokens is not None:
+        tokens.flush()
+    with open(pjoin(out_dir, 'index.json'), 'w') as f:
+        json.dump({'meta': meta, 'crops': crops}, f)
+    return len(jobs)
+
+
+class RVQTokenCache:
+    '''
+    Read-only view of a cache built by build_token_cache.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(pjoin(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.meta = index['meta']
+        self.crops = index['crops']
+        self.tokens_array = np.load(pjoin(cache_dir, 'tokens.npy'), mmap_mode='r')
+
+    def stale_reason(self, meta, keys=()):
+        '''
+        :param meta: token_cache_meta of the training setup
+        :param keys: motion keys the dataset will ask for
+        :return: why the cache cannot be used, None if it is up to date
+        '''
+        for k, v in meta.items():
+            if self.meta.get(k) != v:
+                return f'{k} changed'
+        missing = sum(1 for key in keys if key not in self.crops)
+        if missing:
+            return f'{missing} motions are not cached'
+        return None
+
+    def tokens(self, key, crop_len, start, pad_to):
+        '''
+        :return: (pad_to, num_quantizers) int64 token ids of the crop, zero padded (the trainers mask padding)
+        '''
+        unit_length = self.meta['unit_length']
+        n = crop_len // unit_length
+        row = self.crops[key][str(crop_len)] + start * n
+        out = np.zeros((pad_to, self.tokens_array.shape[1]), dtype=np.int64)
+        out[:n] = self.tokens_array[row:row + n]
+        return out
+
+
+def load_token_cache(cache_dir, datasets, vq_model, mean, std, opt):
+    '''
+    Hand the token cache of cache_dir to datasets if it is up to date with the VQ model, normalization and
+    motions; otherwise they keep returning motions and the trainers encode them on the fly.
+    :return: the cache, None if it is missing or stale
+    '''
+    if not os.path.exists(pjoin(cache_dir, 'index.json')):
+        print(f'No token cache in {cache_dir}, encoding motions on the fly (build it with prepare_token_cache.py)')
+        return None
+    cache = RVQTokenCache(cache_dir)
+    keys = {entry['key'] for ds in datasets for entry in ds.data_dict.values()}
+    reason = cache.stale_reason(token_cache_meta(vq_model, mean, std, opt), keys)
+    if reason is not None:
+        print(f'Token cache {cache_dir} is stale ({reason}), encoding motions on the fly '
+              f'(rebuild it with prepare_token_cache.py)')
+        return None
+    for ds in datasets:
+        ds.token_cache = cache
+    print(f'Reading RVQ tokens from {cache_dir}')
+    return cache
@@ -5,6 +5,7 @@ import torch
 import torch.nn.functional as F
 
 from models.mask_transformer.transformer import MaskTransformer, ResidualTransformer
+from models.mask_transformer.tools import GuidanceSchedule
 from models.vq.model import RVQVAE, LengthEstimator
 
 from options.eval_option import EvalT2MOptions
@@ -136,6 +137,7 @@ if __name__ == '__main__':
         edit_mask[:, _start: _end] = 1
         print_captions = f'{print_captions} [{_start*4/20.}s - {_end*4/20.}s]'
     edit_mask = edit_mask.bool()
+    guidance = GuidanceSchedule.from_opt(opt)
     for r in range(opt.repeat_times):
         print("-->Repeat %d"%r)
         with torch.no_grad():
@@ -148,9 +150,10 @@ if __name__ == '__main__':
                                         gsample=opt.gumbel_sample,
                                         force_mask=opt.force_mask,
                                         edit_mask=edit_mask.clone(),
+                                        guidance=guidance,
                                         )
             if opt.use_res_model:
-                mids = res_model.generate(mids, captions, m_length//4, temperature=1, cond_scale=2)
+                mids = res_model.generate(mids, captions, m_length//4, temperature=1, cond_scale=2, guidance=guidance)
             else:
                 mids.unsqueeze_(-1)
 
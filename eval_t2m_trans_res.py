@@ -4,6 +4,7 @@ from os.path import join as pjoin
 import torch
 
 from models.mask_transformer.transformer import MaskTransformer, ResidualTransformer
+from models.mask_transformer.tools import GuidanceSchedule
 from models.vq.model import RVQVAE
 
 from options.eval_option import EvalT2MOptions
@@ -134,6 +135,9 @@ if __name__ == '__main__':
 
     eval_val_loader, _ = get_dataset_motion_loader(dataset_opt_path, 32, 'test', device=opt.device)
 
+    guidance = GuidanceSchedule.from_opt(opt)
+    compare_guidance = opt.cfg_compare and guidance is not None
+
     # model_dir = pjoin(opt.)
     for file in os.listdir(model_dir):
         if opt.which_epoch != "all" and opt.which_epoch not in file:
@@ -155,8 +159,13 @@ if __name__ == '__main__':
         top3 = []
         matching = []
         mm = []
+        gen_stats = {}
+        base_fid = []
+        base_top3 = []
+        base_stats = {}
 
         repeat_time = 20
+        cal_mm = True
         for i in range(repeat_time):
             with torch.no_grad():
                 best_fid, best_div, Rprecision, best_matching, best_mm = \
@@ -164,7 +173,21 @@ if __name__ == '__main__':
                                                                        i, eval_wrapper=eval_wrapper,
                                                          time_steps=opt.time_steps, cond_scale=opt.cond_scale,
                                                          temperature=opt.temperature, topkr=opt.topkr,
-                                                                       force_mask=opt.force_mask, cal_mm=True)
+                                                                       force_mask=opt.force_mask, cal_mm=cal_mm,
+                                                                       guidance=guidance, stats=gen_stats)
+                if compare_guidance:
+                    # Same evaluation (including the multimodality batches, so both time the same generate calls)
+                    # with guidance on every step and layer, as the reference for the schedule
+                    ref_fid, _, ref_Rprecision, _, _ = \
+                        eval_t2m.evaluation_mask_transformer_test_plus_res(eval_val_loader, vq_model, res_model,
+                                                                           t2m_transformer, i, eval_wrapper=eval_wrapper,
+                                                                           time_steps=opt.time_steps,
+                                                                           cond_scale=opt.cond_scale,
+                                                                           temperature=opt.temperature, topkr=opt.topkr,
+                                                                           force_mask=opt.force_mask, cal_mm=cal_mm,
+                                                                           stats=base_stats)
+                    base_fid.append(ref_fid)
+                    base_top3.append(ref_Rprecision[2])
             fid.append(best_fid)
             div.append(best_div)
             top1.append(Rprecision[0])
@@ -189,6 +212,19 @@ if __name__ == '__main__':
                     f"\tTOP1: {np.mean(top1):.3f}, conf. {np.std(top1) * 1.96 / np.sqrt(repeat_time):.3f}, TOP2. {np.mean(top2):.3f}, conf. {np.std(top2) * 1.96 / np.sqrt(repeat_time):.3f}, TOP3. {np.mean(top3):.3f}, conf. {np.std(top3) * 1.96 / np.sqrt(repeat_time):.3f}\n" \
                     f"\tMatching: {np.mean(matching):.3f}, conf. {np.std(matching) * 1.96 / np.sqrt(repeat_time):.3f}\n" \
                     f"\tMultimodality:{np.mean(mm):.3f}, conf.{np.std(mm) * 1.96 / np.sqrt(repeat_time):.3f}\n\n"
+        if guidance is not None:
+            msg_final += f"\tGuidance schedule: curve {opt.cfg_curve}, stop step {opt.cfg_stop_step}, " \
+                         f"res layers {opt.res_cfg_layers}, " \
+                         f"{guidance.num_uncond_passes(opt.time_steps, res_opt.num_quantizers - 1)}/" \
+                         f"{opt.time_steps + res_opt.num_quantizers - 1} unconditional passes, " \
+                         f"generation time {gen_stats['gen_time']:.1f}s\n"
+        if compare_guidance:
+            saved = base_stats['gen_time'] - gen_stats['gen_time']
+            msg_final += f"\tFull guidance: FID {np.mean(base_fid):.3f}, TOP3 {np.mean(base_top3):.3f}, " \
+                         f"generation time {base_stats['gen_time']:.1f}s\n" \
+                         f"\tSchedule cost: FID {np.mean(fid) - np.mean(base_fid):+.3f}, " \
+                         f"TOP3 {np.mean(top3) - np.mean(base_top3):+.3f}, " \
+                         f"time saved {saved:.1f}s ({saved / base_stats['gen_time'] * 100:.1f}%)\n\n"
         # logger.info(msg_final)
         print(msg_final)
         print(msg_final, file=f, flush=True)
@@ -0,0 +1,88 @@
+import os
+import time
+from os.path import join as pjoin
+
+import numpy as np
+import torch
+
+from gen_t2m import build_vq_model, build_trans_model, build_res_model, build_len_estimator, clip_version
+from models.text_encoder import clip_state_dict
+from options.eval_option import EvalT2MOptions
+from serving.bundle import write_bundle, options_to_dict, InferenceBundle
+from utils.get_opt import get_opt
+
+
+def _without_clip(state_dict):
+    return {k: v for k, v in state_dict.items() if not k.startswith('clip_model.')}
+
+
+def collect_sections(opt):
+    '''
+    Read the options and checkpoints the generator uses, keeping the model weights only (no optimizer or
+    scheduler state), and check that every model loads them strictly.
+    :return: (sections, arrays) for write_bundle
+    '''
+    device = torch.device('cpu')
+    dim_pose = 251 if opt.dataset_name == 'kit' else 263
+    model_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.name, 'opt.txt'), device=device)
+    vq_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'opt.txt'), device=device)
+    vq_opt.dim_pose = dim_pose
+    res_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.res_name, 'opt.txt'), device=device)
+    assert res_opt.vq_name == model_opt.vq_name
+    model_opt.num_tokens = vq_opt.nb_code
+    model_opt.num_quantizers = vq_opt.num_quantizers
+    model_opt.code_dim = vq_opt.code_dim
+
+    ckpt = torch.load(pjoin(opt.checkpoints_dir, opt.dataset_name, vq_opt.name, 'model', 'net_best_fid.tar'),
+                      map_location='cpu')
+    vq_state = ckpt['vq_model'] if 'vq_model' in ckpt else ckpt['net']
+    ckpt = torch.load(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.name, 'model', 'latest.tar'),
+                      map_location='cpu')
+    trans_state = _without_clip(ckpt['t2m_transformer'] if 't2m_transformer' in ckpt else ckpt['trans'])
+    ckpt = torch.load(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.res_name, 'model', 'net_best_fid.tar'),
+                      map_location='cpu')
+    res_state = _without_clip(ckpt['res_transformer'])
+    ckpt = torch.load(pjoin(opt.checkpoints_dir, opt.dataset_name, 'length_estimator', 'model', 'finest.tar'),
+                      map_location='cpu')
+    len_state = ckpt['estimator']
+    del ckpt
+
+    # Fails here, not in a worker, if the checkpoints do not match the resolved options
+    build_vq_model(vq_opt).load_state_dict(vq_state)
+    build_trans_model(model_opt, clip_version=None).load_state_dict(trans_state)
+    build_res_model(res_opt, vq_opt, clip_version=None).load_state_dict(res_state)
+    build_len_estimator().load_state_dict(len_state)
+
+    sections = {
+        'vq': {'options': options_to_dict(vq_opt), 'state_dict': vq_state},
+        't2m_transformer': {'options': options_to_dict(model_opt), 'state_dict': trans_state},
+        'res_transformer': {'options': options_to_dict(res_opt), 'state_dict': res_state},
+        'length_estimator': {'options': None, 'state_dict': len_state},
+    }
+    meta_dir = pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta')
+    arrays = {'mean': np.load(pjoin(meta_dir, 'mean.npy')), 'std': np.load(pjoin(meta_dir, 'std.npy'))}
+    return sections, arrays
+
+
+if __name__ == '__main__':
+    parser = EvalT2MOptions()
+    opt = parser.parse()
+    if not opt.bundle:
+        raise ValueError('Give the output path of the bundle with --bundle')
+
+    start = time.perf_counter()
+    sections, arrays = collect_sections(opt)
+    sections['clip'] = {'options': None, 'state_dict': clip_state_dict(clip_version)}
+    meta = {'dataset_name': opt.dataset_name, 'name': opt.name, 'res_name': opt.res_name,
+            'clip_version': clip_version}
+    os.makedirs(os.path.dirname(os.path.abspath(opt.bundle)), exist_ok=True)
+    nbytes = write_bundle(opt.bundle, sections, arrays, meta)
+    print('Wrote %s (%.1f MB) in %.1f s' % (opt.bundle, nbytes / 1024 ** 2, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    bundle = InferenceBundle(opt.bundle)
+    for name in bundle.sections():
+        bundle.state_dict(name)
+    print('Bundle opens and maps %d sections in %.1f ms' % (len(bundle.sections()), (time.perf_counter() - start) * 1000))
+
+# python export_bundle.py --gpu_id -1 --bundle checkpoints/t2m/t2m.bundle
@@ -1,41 +1,68 @@
 import os
+import threading
+import time
 from os.path import join as pjoin
 
-import torch
-import torch.nn.functional as F
-
-from models.mask_transformer.transformer import MaskTransformer, ResidualTransformer
-from models.vq.model import RVQVAE, LengthEstimator
+import numpy as np
+from argparse import Namespace
+from pathlib import Path
 
 from options.eval_option import EvalT2MOptions
 from utils.get_opt import get_opt
+from utils.batching import length_bucketed_batches
+from utils.lazy_import import lazy_import, lazy_from, import_report
+from utils.progress import report
+from utils.motion_result import MotionResult, get_converter
+
+# Heavy subsystems are imported on first use, so `--help`, joints-only runs and the web app start-up
+# only pay for what they touch (see --startup_report)
+torch = lazy_import('torch', 'torch')
+F = lazy_import('torch.nn.functional', 'torch')
+Categorical = lazy_from('torch.distributions.categorical', 'Categorical', 'torch')
+
+_MODELS = ('torch',)
+MaskTransformer = lazy_from('models.mask_transformer.transformer', 'MaskTransformer', 'models', _MODELS)
+ResidualTransformer = lazy_from('models.mask_transformer.transformer', 'ResidualTransformer', 'models', _MODELS)
+GuidanceSchedule = lazy_from('models.mask_transformer.tools', 'GuidanceSchedule', 'models', _MODELS)
+RVQVAE = lazy_from('models.vq.model', 'RVQVAE', 'models', _MODELS)
+LengthEstimator = lazy_from('models.vq.model', 'LengthEstimator', 'models', _MODELS)
+get_text_encoder = lazy_from('models.text_encoder', 'get_text_encoder', 'models', _MODELS)
+fixseed = lazy_from('utils.fixseed', 'fixseed', 'torch', _MODELS)
+
+
+get_model_registry = lazy_from('serving.model_registry', 'get_model_registry', 'serving', _MODELS)
+BatchingScheduler = lazy_from('serving.batching', 'BatchingScheduler', 'serving', _MODELS)
+ContinuousBatchingScheduler = lazy_from('serving.continuous_batching', 'ContinuousBatchingScheduler', 'serving',
+                                        ('torch', 'models.mask_transformer.tools'))
+InferenceBundle = lazy_from('serving.bundle', 'InferenceBundle', 'serving', _MODELS)
+_planner = lazy_import('serving.planner', 'serving', ('torch', 'utils.plot_script'))
+_worker_pool = lazy_import('serving.worker_pool', 'serving', _MODELS)
+_jobs = lazy_import('serving.jobs', 'serving')
+profile_request = lazy_from('utils.profiling', 'profile_request', 'profiling', _MODELS)
+stage = lazy_from('utils.profiling', 'stage', 'profiling', _MODELS)
+count = lazy_from('utils.profiling', 'count', 'profiling', _MODELS)
+generation_step = lazy_from('serving.instrumentation', 'generation_step', 'profiling', _MODELS)
 
-from utils.fixseed import fixseed
-from visualization.joints2bvh import Joint2BVHConvertor
-from torch.distributions.categorical import Categorical
-
-from utils.motion_process import recover_from_ric
-from utils.plot_script import plot_3d_motion
-from utils.paramUtil import t2m_kinematic_chain
-
-import numpy as np
 clip_version = 'ViT-B/32'
 
 
+def build_vq_model(vq_opt):
+    return RVQVAE(vq_opt,
+                  vq_opt.dim_pose,
+                  vq_opt.nb_code,
+                  vq_opt.code_dim,
+                  vq_opt.output_emb_width,
+                  vq_opt.down_t,
+                  vq_opt.stride_t,
+                  vq_opt.width,
+                  vq_opt.depth,
+                  vq_opt.dilation_growth_rate,
+                  vq_opt.vq_act,
+                  vq_opt.vq_norm)
+
 def load_vq_model(vq_opt):
     # opt_path = pjoin(opt.checkpoints_dir, opt.dataset_name, opt.vq_name, 'opt.txt')
-    vq_model = RVQVAE(vq_opt,
-                vq_opt.dim_pose,
-                vq_opt.nb_code,
-                vq_opt.code_dim,
-                vq_opt.output_emb_width,
-                vq_opt.down_t,
-                vq_opt.stride_t,
-                vq_opt.width,
-                vq_opt.depth,
-                vq_opt.dilation_growth_rate,
-                vq_opt.vq_act,
-                vq_opt.vq_norm)
+    vq_model = build_vq_model(vq_opt)
     ckpt = torch.load(pjoin(vq_opt.checkpoints_dir, vq_opt.dataset_name, vq_opt.name, 'model', 'net_best_fid.tar'),
                             map_location='cpu')
     model_key = 'vq_model' if 'vq_model' in ckpt else 'net'
@@ -43,18 +70,21 @@ def load_vq_model(vq_opt):
     print(f'Loading VQ Model {vq_opt.name} Completed!')
     return vq_model, vq_opt
 
+def build_trans_model(model_opt, clip_version=clip_version):
+    return MaskTransformer(code_dim=model_opt.code_dim,
+                           cond_mode='text',
+                           latent_dim=model_opt.latent_dim,
+                           ff_size=model_opt.ff_size,
+                           num_layers=model_opt.n_layers,
+                           num_heads=model_opt.n_heads,
+                           dropout=model_opt.dropout,
+                           clip_dim=512,
+                           cond_drop_prob=model_opt.cond_drop_prob,
+                           clip_version=clip_version,
+                           opt=model_opt)
+
 def load_trans_model(model_opt, opt, which_model):
-    t2m_transformer = MaskTransformer(code_dim=model_opt.code_dim,
-                                      cond_mode='text',
-                                      latent_dim=model_opt.latent_dim,
-                                      ff_size=model_opt.ff_size,
-                                      num_layers=model_opt.n_layers,
-                                      num_heads=model_opt.n_heads,
-                                      dropout=model_opt.dropout,
-                                      clip_dim=512,
-                                      cond_drop_prob=model_opt.cond_drop_prob,
-                                      clip_version=clip_version,
-                                      opt=model_opt)
+    t2m_transformer = build_trans_model(model_opt)
     ckpt = torch.load(pjoin(model_opt.checkpoints_dir, model_opt.dataset_name, model_opt.name, 'model', which_model),
                       map_location='cpu')
     model_key = 't2m_transformer' if 't2m_transformer' in ckpt else 'trans'
@@ -65,24 +95,26 @@ def load_trans_model(model_opt, opt, which_model):
     print(f'Loading Transformer {opt.name} from epoch {ckpt["ep"]}!')
     return t2m_transformer
 
-def load_res_model(res_opt, vq_opt, opt):
+def build_res_model(res_opt, vq_opt, clip_version=clip_version):
     res_opt.num_quantizers = vq_opt.num_quantizers
     res_opt.num_tokens = vq_opt.nb_code
-    res_transformer = ResidualTransformer(code_dim=vq_opt.code_dim,
-                                            cond_mode='text',
-                                            latent_dim=res_opt.latent_dim,
-                                            ff_size=res_opt.ff_size,
-                                            num_layers=res_opt.n_layers,
-                                            num_heads=res_opt.n_heads,
-                                            dropout=res_opt.dropout,
-                                            clip_dim=512,
-                                            shared_codebook=vq_opt.shared_codebook,
-                                            cond_drop_prob=res_opt.cond_drop_prob,
-                                            # codebook=vq_model.quantizer.codebooks[0] if opt.fix_token_emb else None,
-                                            share_weight=res_opt.share_weight,
-                                            clip_version=clip_version,
-                                            opt=res_opt)
+    return ResidualTransformer(code_dim=vq_opt.code_dim,
+                               cond_mode='text',
+                               latent_dim=res_opt.latent_dim,
+                               ff_size=res_opt.ff_size,
+                               num_layers=res_opt.n_layers,
+                               num_heads=res_opt.n_heads,
+                               dropout=res_opt.dropout,
+                               clip_dim=512,
+                               shared_codebook=vq_opt.shared_codebook,
+                               cond_drop_prob=res_opt.cond_drop_prob,
+                               # codebook=vq_model.quantizer.codebooks[0] if opt.fix_token_emb else None,
+                               share_weight=res_opt.share_weight,
+                               clip_version=clip_version,
+                               opt=res_opt)
 
+def load_res_model(res_opt, vq_opt, opt):
+    res_transformer = build_res_model(res_opt, vq_opt)
     ckpt = torch.load(pjoin(res_opt.checkpoints_dir, res_opt.dataset_name, res_opt.name, 'model', 'net_best_fid.tar'),
                       map_location=opt.device)
     missing_keys, unexpected_keys = res_transformer.load_state_dict(ckpt['res_transformer'], strict=False)
@@ -91,8 +123,11 @@ def load_res_model(res_opt, vq_opt, opt):
     print(f'Loading Residual Transformer {res_opt.name} from epoch {ckpt["ep"]}!')
     return res_transformer
 
+def build_len_estimator():
+    return LengthEstimator(512, 50)
+
 def load_len_estimator(opt):
-    model = LengthEstimator(512, 50)
+    model = build_len_estimator()
     ckpt = torch.load(pjoin(opt.checkpoints_dir, opt.dataset_name, 'length_estimator', 'model', 'finest.tar'),
                       map_location=opt.device)
     model.load_state_dict(ckpt['estimator'])
@@ -101,6 +136,295 @@ def load_len_estimator(opt):
 
 
 
+_eval_opt = None
+# The worker pool and the job managers hold processes and threads rather than weights: they live here, not in the
+# model registry, whose LRU eviction would drop them and start another pool
+_pool = None
+_job_managers = {}  # abspath(output_dir) -> JobManager
+_serving_lock = threading.Lock()
+
+# Overrides that change the mask transformer architecture, and so select a distinct registry entry
+ARCH_OVERRIDE_KEYS = ('latent_dim', 'ff_size', 'n_layers', 'n_heads', 'share_weight')
+
+
+def get_eval_options():
+    """
+    EvalT2MOptions をプロセス内で一度だけ解析して使い回す
+    """
+    global _eval_opt
+    if _eval_opt is None:
+        parser = EvalT2MOptions()
+        _eval_opt = parser.parse()
+        _eval_opt.device = torch.device("cpu" if _eval_opt.gpu_id == -1 else "cuda:" + str(_eval_opt.gpu_id))
+        # レジストリの上限は最初の生成時にしか反映されないので、ここで作成しておく
+        get_model_registry(max_bytes=_registry_max_bytes(_eval_opt))
+    return _eval_opt
+
+
+def _registry_max_bytes(opt):
+    return opt.model_cache_mb * 1024 ** 2 if opt.model_cache_mb > 0 else None
+
+
+def _arch_key(arch_overrides):
+    return tuple((k, arch_overrides[k]) for k in ARCH_OVERRIDE_KEYS if k in arch_overrides)
+
+
+def setup_text_cache(t2m_transformer, opt):
+    '''
+    Size the shared CLIP embedding cache and warm it from --text_cache_path if that file exists.
+    '''
+    text_encoder = t2m_transformer.text_encoder
+    if text_encoder is None:
+        return
+    text_encoder.cache.max_size = opt.text_cache_size
+    if opt.text_cache_path and os.path.exists(opt.text_cache_path):
+        text_encoder.cache.load(opt.text_cache_path)
+
+
+def save_text_cache(t2m_transformer, opt):
+    if opt.text_cache_path and t2m_transformer.text_encoder is not None:
+        t2m_transformer.text_encoder.cache.save(opt.text_cache_path)
+
+
+def get_generation_models(opt, **arch_overrides):
+    '''
+    Fetch warm, eval-mode generation models from the process-wide registry.
+    Each model is loaded once per variant; mask transformer variants are keyed by arch_overrides.
+    :param opt: parsed EvalT2MOptions (with opt.device set)
+    :param arch_overrides: overrides applied on top of the mask transformer's opt.txt, only ARCH_OVERRIDE_KEYS
+        take part in the registry key
+    :return: Namespace with vq_model, t2m_transformer, res_model, length_estimator, mean, std and the model options
+    '''
+    registry = get_model_registry(max_bytes=_registry_max_bytes(opt))
+    if opt.bundle:
+        return _get_bundle_models(opt, registry, arch_overrides)
+    dim_pose = 251 if opt.dataset_name == 'kit' else 263
+    base_key = (opt.checkpoints_dir, opt.dataset_name, str(opt.device))
+
+    model_opt_path = pjoin(opt.checkpoints_dir, opt.dataset_name, opt.name, 'opt.txt')
+    model_opt = registry.get(('model_opt', opt.name) + base_key,
+                             lambda: get_opt(model_opt_path, device=opt.device))
+    # Do not touch the cached opt.txt, apply the overrides on a copy
+    model_opt = Namespace(**vars(model_opt))
+    for k, v in arch_overrides.items():
+        setattr(model_opt, k, v)
+
+    def _load_vq():
+        vq_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'opt.txt'), device=opt.device)
+        vq_opt.dim_pose = dim_pose
+        vq_model, vq_opt = load_vq_model(vq_opt)
+        return vq_model.to(opt.device).eval(), vq_opt
+    vq_model, vq_opt = registry.get(('vq', model_opt.vq_name) + base_key, _load_vq)
+
+    model_opt.num_tokens = vq_opt.nb_code
+    model_opt.num_quantizers = vq_opt.num_quantizers
+    model_opt.code_dim = vq_opt.code_dim
+
+    def _load_res():
+        res_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.res_name, 'opt.txt'), device=opt.device)
+        assert res_opt.vq_name == model_opt.vq_name
+        res_model = load_res_model(res_opt, vq_opt, opt)
+        return res_model.to(opt.device).eval(), res_opt
+    res_model, res_opt = registry.get(('res', opt.res_name, model_opt.vq_name) + base_key, _load_res)
+
+    def _load_trans():
+        t2m_transformer = load_trans_model(model_opt, opt, 'latest.tar').to(opt.device).eval()
+        setup_text_cache(t2m_transformer, opt)
+        return t2m_transformer
+    trans_key = ('trans', opt.name, 'latest.tar', _arch_key(arch_overrides)) + base_key
+    t2m_transformer = registry.get(trans_key, _load_trans)
+
+    # Guidance mode only changes how forward passes are batched, not the weights, so it is not part of the key
+    t2m_transformer.batch_cfg = res_model.batch_cfg = opt.batch_cfg
+
+    length_estimator = registry.get(
+        ('length_estimator',) + base_key, lambda: load_len_estimator(model_opt).to(opt.device).eval())
+
+    meta_dir = pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta')
+    mean, std = registry.get(('meta', model_opt.vq_name) + base_key,
+                             lambda: (np.load(pjoin(meta_dir, 'mean.npy')), np.load(pjoin(meta_dir, 'std.npy'))))
+
+    return Namespace(vq_model=vq_model, t2m_transformer=t2m_transformer, res_model=res_model,
+                     length_estimator=length_estimator, mean=mean, std=std,
+                     model_opt=model_opt, vq_opt=vq_opt, res_opt=res_opt)
+
+
+def candidate_seed(seed, prompt_id, repeat_id):
+    # Distinct for every (prompt, repeat) pair while repeat_times < 1000003, and seed + repeat_id for the first prompt
+    return seed + prompt_id * 1000003 + repeat_id
+
+
+def candidate_generators(seed, prompt_ids, repeat_ids, device):
+    '''
+    One random stream per (prompt, repeat) candidate, in prompt-major order (the order of repeat_interleave).
+    Samplers draw from a candidate's stream only over its own token length, so its tokens do not depend on which
+    other candidates share its batch (up to float rounding of the batched forward pass).
+    '''
+    generators = []
+    for k in prompt_ids:
+        for r in repeat_ids:
+            g = torch.Generator(device=device)
+            g.manual_seed(candidate_seed(seed, k, r))
+            generators.append(g)
+    return generators
+
+
+def _bundle_text_encoder(bundle, opt):
+    # CLIP is built from the bundle's weights, once per process and shared by both transformers
+    version = bundle.meta.get('clip_version', clip_version)
+    state_dict = bundle.state_dict('clip') if 'clip' in bundle.sections() else None
+    return get_text_encoder(version, convert_fp16=str(opt.device) != "cpu", state_dict=state_dict)
+
+
+def _get_bundle_models(opt, registry, arch_overrides):
+    '''
+    get_generation_models for --bundle: options and weights come from a memory-mapped inference bundle
+    (see export_bundle.py), no opt.txt parsing or checkpoint unpickling. Each model is only built on first use.
+    '''
+    bundle_path = os.path.abspath(opt.bundle)
+    bundle = registry.get(('bundle', bundle_path), lambda: InferenceBundle(bundle_path))
+    base_key = ('bundle', bundle_path, str(opt.device))
+
+    model_opt = bundle.options('t2m_transformer', device=opt.device)
+    for k, v in arch_overrides.items():
+        setattr(model_opt, k, v)
+    vq_opt = bundle.options('vq', device=opt.device)
+    res_opt = bundle.options('res_transformer', device=opt.device)
+
+    def _load(name, model):
+        model.load_state_dict(bundle.state_dict(name))
+        return model.to(opt.device).eval()
+
+    vq_model = registry.get(('vq',) + base_key, lambda: _load('vq', build_vq_model(vq_opt)))
+
+    def _load_res():
+        res_model = _load('res_transformer', build_res_model(res_opt, vq_opt, clip_version=None))
+        res_model.text_encoder = _bundle_text_encoder(bundle, opt)
+        return res_model
+    res_model = registry.get(('res',) + base_key, _load_res)
+
+    def _load_trans():
+        t2m_transformer = _load('t2m_transformer', build_trans_model(model_opt, clip_version=None))
+        t2m_transformer.text_encoder = _bundle_text_encoder(bundle, opt)
+        setup_text_cache(t2m_transformer, opt)
+        return t2m_transformer
+    t2m_transformer = registry.get(('trans', _arch_key(arch_overrides)) + base_key, _load_trans)
+    t2m_transformer.batch_cfg = res_model.batch_cfg = opt.batch_cfg
+
+    length_estimator = registry.get(('length_estimator',) + base_key,
+                                    lambda: _load('length_estimator', build_len_estimator()))
+    mean, std = registry.get(('meta',) + base_key, lambda: (bundle.array('mean'), bundle.array('std')))
+
+    return Namespace(vq_model=vq_model, t2m_transformer=t2m_transformer, res_model=res_model,
+                     length_estimator=length_estimator, mean=mean, std=std,
+                     model_opt=model_opt, vq_opt=vq_opt, res_opt=res_opt)
+
+
+def get_batching_scheduler(opt, **arch_overrides):
+    '''
+    Process-wide BatchingScheduler (ContinuousBatchingScheduler with --continuous_batching) around the warm
+    models of get_generation_models, one per mask transformer variant.
+    Returns None when batching is disabled (--batch_window_ms 0 and no --continuous_batching).
+    '''
+    if opt.continuous_batching:
+        models = get_generation_models(opt, **arch_overrides)
+        key = ('continuous_scheduler', opt.name, _arch_key(arch_overrides), str(opt.device))
+        return get_model_registry().get(key, lambda: ContinuousBatchingScheduler(
+            models.t2m_transformer, models.res_model, models.vq_model,
+            max_batch_size=opt.max_batch_size, time_steps=opt.time_steps, gsample=opt.gumbel_sample,
+            res_cond_scale=5, guidance=GuidanceSchedule.from_opt(opt)))
+    if opt.batch_window_ms <= 0:
+        return None
+    models = get_generation_models(opt, **arch_overrides)
+    key = ('batching_scheduler', opt.name, _arch_key(arch_overrides), str(opt.device))
+    return get_model_registry().get(key, lambda: BatchingScheduler(
+        models.t2m_transformer, models.res_model, models.vq_model,
+        max_batch_size=opt.max_batch_size, max_wait_ms=opt.batch_window_ms,
+        time_steps=opt.time_steps, gsample=opt.gumbel_sample, res_cond_scale=5,
+        guidance=GuidanceSchedule.from_opt(opt)))
+
+
+def get_generation_planner(opt, **arch_overrides):
+    '''
+    Process-wide GenerationPlanner for --latency_budget_ms. The cost model is read from --cost_model_path,
+    or measured on this machine on first use (and saved there if a path is given).
+    Returns None when no latency budget is set.
+    '''
+    if opt.latency_budget_ms <= 0:
+        return None
+
+    def _load_planner():
+        models = get_generation_models(opt, **arch_overrides)
+        if opt.cost_model_path and os.path.exists(opt.cost_model_path):
+            cost_model = _planner.StageCostModel.load(opt.cost_model_path)
+        else:
+            print('Calibrating the generation cost model...')
+            cost_model = _planner.calibrate(models, opt.device, converter=get_converter())
+            if opt.cost_model_path:
+                cost_model.save(opt.cost_model_path)
+        return _planner.GenerationPlanner(cost_model, models.model_opt.num_quantizers, time_steps=opt.time_steps)
+
+    key = ('planner', opt.name, _arch_key(arch_overrides), str(opt.device))
+    return get_model_registry().get(key, _load_planner)
+
+
+def arch_overrides_from_ui(cond_drop_prob=0.2, dropout=0.2, ff_size=1024, latent_dim=384, max_motion_length=196,
+                           n_heads=6, n_layers=8, share_weight=True):
+    '''
+    Overrides of the mask transformer options from the web UI parameters (the defaults are the UI's).
+    '''
+    return dict(
+        cond_drop_prob=cond_drop_prob,
+        dropout=dropout,
+        ff_size=int(ff_size),
+        latent_dim=int(latent_dim),
+        max_motion_length=int(max_motion_length),
+        n_heads=int(n_heads),
+        n_layers=int(n_layers),
+        share_weight=bool(share_weight),
+    )
+
+
+def get_worker_pool(opt, **arch_overrides):
+    '''
+    Process-wide WorkerPool for --num_workers. The models of arch_overrides are loaded here and moved to shared
+    memory before the workers are forked, so all workers run on one copy of the weights (other variants are
+    loaded by each worker on first use).
+    Returns None when --num_workers is 0, and inside a worker.
+    '''
+    global _pool
+    if opt.num_workers <= 0 or _worker_pool.current_worker() is not None:
+        return None
+    with _serving_lock:
+        if _pool is None:
+            if opt.device.type != 'cpu':
+                raise ValueError('--num_workers is for CPU inference, use it with --gpu_id -1')
+            _worker_pool.share_models(get_generation_models(opt, **arch_overrides))
+            get_converter()
+            _pool = _worker_pool.WorkerPool(opt.num_workers, threads_per_worker=opt.worker_threads,
+                                            pin_cpus=opt.pin_workers)
+        return _pool
+
+
+def get_job_manager(opt, output_dir):
+    '''
+    Process-wide JobManager of the web app: generate_motion_samples on the generation executor,
+    export_motion_samples in --post_workers post-processing processes, artifacts under output_dir/<job id>/.
+    '''
+    key = os.path.abspath(output_dir)
+    with _serving_lock:
+        if key not in _job_managers:
+            if opt.num_workers > 0:
+                generate_workers = opt.num_workers
+            elif opt.batch_window_ms > 0 or opt.continuous_batching:
+                generate_workers = opt.max_batch_size
+            else:
+                generate_workers = 1
+            _job_managers[key] = _jobs.JobManager(generate_motion_samples, export_motion_samples, output_dir,
+                                                  generate_workers=generate_workers, post_workers=opt.post_workers)
+        return _job_managers[key]
+
+
 def generate_motion(
         text_prompt, bvh_output_path, gif_output_path,
         cond_drop_prob=0.2, dropout=0.2, ff_size=1024, latent_dim=384,
@@ -108,22 +432,38 @@ def generate_motion(
 
     """
     指定されたプロンプトから BVH & GIF を生成
+    モデルはレジストリにキャッシュされ、2 回目以降の呼び出しでは再読み込みしない
     """
 
-    # 設定の読み込み
-    parser = EvalT2MOptions()
-    opt = parser.parse()
+    # 設定の読み込み (初回のみ解析)
+    parse_start = time.perf_counter()
+    opt = get_eval_options()
+    parse_ms = (time.perf_counter() - parse_start) * 1000.
+
+    arch_overrides = arch_overrides_from_ui(cond_drop_prob, dropout, ff_size, latent_dim, max_motion_length,
+                                            n_heads, n_layers, share_weight)
+    # --num_workers: 共有メモリ上のモデルを使うワーカープロセスのいずれかで生成する
+    pool = get_worker_pool(opt, **arch_overrides)
+    if pool is not None:
+        pool.run(generate_motion, text_prompt, bvh_output_path, gif_output_path,
+                 cond_drop_prob=cond_drop_prob, dropout=dropout, ff_size=ff_size, latent_dim=latent_dim,
+                 max_motion_length=max_motion_length, n_heads=n_heads, n_layers=n_layers, share_weight=share_weight)
+        return
+
+    # --profile: ステージごとの時間・RSS・トークン数を計測し、JSON / Prometheus 形式で出力する
+    with profile_request('generate_motion', enabled=opt.profile, device=opt.device,
+                         json_dir=opt.profile_dir) as profile:
+        if profile is not None:
+            profile.add_span('options', parse_ms)
+        # **Web UI のパラメータを `model_opt` のコピーに適用 (`opt.txt` は変更しない)**
+        _generate_motion(opt, text_prompt, bvh_output_path, gif_output_path, arch_overrides)
+
+
+def _generate_motion(opt, text_prompt, bvh_output_path, gif_output_path, arch_overrides):
     fixseed(opt.seed)
 
-    # デバイス設定
-    opt.device = torch.device("cpu" if opt.gpu_id == -1 else "cuda:" + str(opt.gpu_id))
     torch.autograd.set_detect_anomaly(True)
 
-    dim_pose = 251 if opt.dataset_name == 'kit' else 263
-
-    # モデルの読み込み
-    root_dir = os.path.join(opt.checkpoints_dir, opt.dataset_name, opt.name)
-    #model_dir = os.path.join(root_dir, 'model')
     result_dir = os.path.join('./generation', opt.ext)
     joints_dir = os.path.join(result_dir, 'joints')
     animation_dir = os.path.join(result_dir, 'animations')
@@ -131,66 +471,50 @@ def generate_motion(
     os.makedirs(joints_dir, exist_ok=True)
     os.makedirs(animation_dir, exist_ok=True)
 
-    # モデルの読み込み
-    model_opt_path = os.path.join(root_dir, 'opt.txt')
-
-    # **`opt.txt` は読み込みのみで変更しない**
-    model_opt = get_opt(model_opt_path, device=opt.device)
-
-    # **Web UI のパラメータを直接 `model_opt` に適用**
-    model_opt.cond_drop_prob = cond_drop_prob
-    model_opt.dropout = dropout
-    model_opt.ff_size = ff_size
-    model_opt.latent_dim = latent_dim
-    model_opt.max_motion_length = max_motion_length
-    model_opt.n_heads = n_heads
-    model_opt.n_layers = n_layers
-    model_opt.share_weight = share_weight
-
     print("🔍 Web UI のパラメータ適用確認:")
-    print(f" - cond_drop_prob: {model_opt.cond_drop_prob}")
-    print(f" - dropout: {model_opt.dropout}")
-    print(f" - ff_size: {model_opt.ff_size}")
-    print(f" - latent_dim: {model_opt.latent_dim}")
-    print(f" - max_motion_length: {model_opt.max_motion_length}")
-    print(f" - n_heads: {model_opt.n_heads}")
-    print(f" - n_layers: {model_opt.n_layers}")
-    print(f" - share_weight: {model_opt.share_weight}")
-
-
-    vq_opt_path = os.path.join(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'opt.txt')
-    vq_opt = get_opt(vq_opt_path, device=opt.device)
-    vq_opt.dim_pose = dim_pose
-    vq_model, vq_opt = load_vq_model(vq_opt)
-
-    model_opt.num_tokens = vq_opt.nb_code
-    model_opt.num_quantizers = vq_opt.num_quantizers
-    model_opt.code_dim = vq_opt.code_dim
-
-    res_opt_path = os.path.join(opt.checkpoints_dir, opt.dataset_name, opt.res_name, 'opt.txt')
-    res_opt = get_opt(res_opt_path, device=opt.device)
-    res_model = load_res_model(res_opt, vq_opt, opt)
+    for k, v in arch_overrides.items():
+        print(f" - {k}: {v}")
 
-    print(f"🔍 opt.txt のパス: {res_opt_path}")
+    # 同時実行時に一時ファイル名が衝突しないよう、出力ファイル名を付与する
+    tag = Path(bvh_output_path).stem
 
-    assert res_opt.vq_name == model_opt.vq_name
+    # export_sample は BVH・GIF・IK 後の関節位置を書き出す
+    for rnd in generate_rounds(opt, text_prompt, arch_overrides, artifacts=('bvh', 'gif', 'joints')):
+        for sample in rnd.samples:
+            k = sample.prompt_id
+            print(f"----> Sample {k}: {sample.caption} {sample.m_length}")
+            paths = export_sample(sample, os.path.join(animation_dir, str(k)), os.path.join(joints_dir, str(k)),
+                                  tag, timer=rnd.timer)
 
-    t2m_transformer = load_trans_model(model_opt, opt, 'latest.tar')
-    length_estimator = load_len_estimator(model_opt)
-
-    t2m_transformer.eval()
-    vq_model.eval()
-    res_model.eval()
-    length_estimator.eval()
+            # 保存先を指定
+            with stage('file_writes'):
+                os.rename(paths.bvh, bvh_output_path)
+                os.rename(paths.gif, gif_output_path)
 
-    res_model.to(opt.device)
-    t2m_transformer.to(opt.device)
-    vq_model.to(opt.device)
-    length_estimator.to(opt.device)
+            print(f"✅ {bvh_output_path} と {gif_output_path} を保存しました。")
 
-    # データ変換
-    mean = np.load(os.path.join(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta', 'mean.npy'))
-    std = np.load(os.path.join(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta', 'std.npy'))
+        finish_round(rnd)
+
+    # 埋め込みキャッシュを保存 (--text_cache_path 指定時のみ)
+    save_text_cache(get_generation_models(opt, **arch_overrides).t2m_transformer, opt)
+
+
+def generate_rounds(opt, text_prompt, arch_overrides, artifacts=()):
+    '''
+    Neural half of generate_motion: CLIP encoding, length estimation, token generation and VQ decoding.
+    Yields one Namespace per repeat round, with the round's samples (MotionResult, artifacts not derived yet)
+    and what finish_round needs.
+    :param artifacts: ARTIFACTS the caller derives from the samples in this process, the latency planner only
+        budgets the IK and rendering they need
+    '''
+    # モデルの取得 (ウォーム状態のものを再利用)
+    with stage('load_models'):
+        models = get_generation_models(opt, **arch_overrides)
+    t2m_transformer = models.t2m_transformer
+    res_model = models.res_model
+    vq_model = models.vq_model
+    length_estimator = models.length_estimator
+    mean, std = models.mean, models.std
 
     def inv_transform(data):
         return data * std + mean
@@ -205,12 +529,18 @@ def generate_motion(
     else:
         length_list.append(opt.motion_length)
 
+    # CLIP エンコードは 1 回だけ行い、長さ推定と両 generate で使い回す
+    report('clip_encode')
+    with torch.no_grad(), stage('clip_encode'):
+        text_embedding = t2m_transformer.encode_text(prompt_list)
+
     if est_length:
         print("Since no motion length is specified, estimating motion length...")
-        text_embedding = t2m_transformer.encode_text(prompt_list)
-        pred_dis = length_estimator(text_embedding)
-        probs = F.softmax(pred_dis, dim=-1)
-        token_lens = Categorical(probs).sample()
+        report('length_estimation')
+        with torch.no_grad(), stage('length_estimation'):
+            pred_dis = length_estimator(text_embedding)
+            probs = F.softmax(pred_dis, dim=-1)
+            token_lens = Categorical(probs).sample()
     else:
         token_lens = torch.LongTensor(length_list) // 4
         token_lens = token_lens.to(opt.device).long()
@@ -218,50 +548,202 @@ def generate_motion(
     m_length = token_lens * 4
     captions = prompt_list
 
-    sample = 0
-    kinematic_chain = t2m_kinematic_chain
-    converter = Joint2BVHConvertor()
-
-    for r in range(opt.repeat_times):
-        print(f"--> Repeat {r}")
-        with torch.no_grad():
-            mids = t2m_transformer.generate(
-                captions, token_lens, timesteps=opt.time_steps, cond_scale=opt.cond_scale,
-                temperature=opt.temperature, topk_filter_thres=opt.topkr, gsample=opt.gumbel_sample
-            )
-            mids = res_model.generate(mids, captions, token_lens, temperature=1, cond_scale=5)
-            pred_motions = vq_model.forward_decoder(mids)
-
-            pred_motions = pred_motions.detach().cpu().numpy()
-            data = inv_transform(pred_motions)
-
-        for k, (caption, joint_data) in enumerate(zip(captions, data)):
-            print(f"----> Sample {k}: {caption} {m_length[k]}")
-            animation_path = os.path.join(animation_dir, str(k))
-            joint_path = os.path.join(joints_dir, str(k))
-
-            os.makedirs(animation_path, exist_ok=True)
-            os.makedirs(joint_path, exist_ok=True)
-
-            joint_data = joint_data[:m_length[k]]
-            joint = recover_from_ric(torch.from_numpy(joint_data).float(), 22).numpy()
-
-            # BVH 書き出し
-            bvh_path = os.path.join(animation_path, f"sample{k}_repeat{r}_len{m_length[k]}.bvh")
-            _, joint = converter.convert(joint, filename=bvh_path, iterations=100, foot_ik=False)
+    # 同時リクエストをまとめて 1 回の generate で処理する (--batch_window_ms > 0 または --continuous_batching の場合)
+    scheduler = get_batching_scheduler(opt, **arch_overrides)
+    # ガイダンススケジュール (--cfg_curve / --cfg_stop_step / --res_cfg_layers)
+    guidance = GuidanceSchedule.from_opt(opt)
+
+    # --latency_budget_ms: 予算内に収まる最も品質の高い設定 (ステップ数 / CFG / 残差層数) を選ぶ
+    planner = get_generation_planner(opt, **arch_overrides)
+    if planner is not None and scheduler is not None:
+        print("⚠️ --latency_budget_ms はバッチングスケジューラ使用時には適用されません")
+        planner = None
+
+    # --batch_repeats: 全リピートを候補として 1 回のバッチで生成 (候補ごとに独立した乱数列)
+    rounds = [list(range(opt.repeat_times))] if opt.batch_repeats else [[r] for r in range(opt.repeat_times)]
+
+    for repeat_ids in rounds:
+        print(f"--> Repeat {', '.join(map(str, repeat_ids))}")
+        num_cand = len(repeat_ids)
+        time_steps, cond_scale, res_cond_scale, num_res_layers = opt.time_steps, opt.cond_scale, 5, -1
+        plan = None
+        if planner is not None:
+            plan = planner.plan(opt.latency_budget_ms, int(token_lens.max()), batch_size=len(captions) * num_cand,
+                                ik=needs_ik(artifacts), animation=needs_animation(artifacts))
+            print(plan.report())
+            # 最も軽い設定でも予算を超える場合はリクエストを受け付けない
+            if not plan.fits:
+                raise RuntimeError(f"予測レイテンシ {plan.total_ms:.0f} ms が予算 {opt.latency_budget_ms:.0f} ms を超えています")
+            time_steps, num_res_layers = plan.time_steps, plan.num_res_layers
+            cond_scale, res_cond_scale = plan.cond_scale(opt.cond_scale), plan.cond_scale(5)
+        timer = _planner.StageTimer(opt.device)
+        count('tokens', int(token_lens.sum()) * num_cand)
+        if scheduler is not None:
+            futures = [scheduler.submit(caption, int(length), cond_scale=opt.cond_scale, temperature=opt.temperature,
+                                        topkr=opt.topkr, seed=candidate_seed(opt.seed, k, r))
+                       for k, (caption, length) in enumerate(zip(captions, m_length)) for r in repeat_ids]
+            report('batched_generate')
+            with stage('scheduler_generate'):
+                data = [inv_transform(future.result()) for future in futures]
+        else:
+            generators = candidate_generators(opt.seed, range(len(captions)), repeat_ids, opt.device) \
+                if opt.batch_repeats else None
+            cand_embedding = text_embedding.repeat_interleave(num_cand, dim=0)
+            cand_token_lens = token_lens.repeat_interleave(num_cand, dim=0)
+            with torch.no_grad():
+                with timer('mask'), stage('mask_generate'):
+                    mids = t2m_transformer.generate(
+                        cand_embedding, cand_token_lens, timesteps=time_steps, cond_scale=cond_scale,
+                        temperature=opt.temperature, topk_filter_thres=opt.topkr, gsample=opt.gumbel_sample,
+                        generators=generators, guidance=guidance, step_hook=generation_step
+                    )
+                with timer('residual'), stage('residual_generate'):
+                    mids = res_model.generate(mids, cand_embedding, cand_token_lens, temperature=1,
+                                              cond_scale=res_cond_scale, num_res_layers=num_res_layers,
+                                              generators=generators, guidance=guidance, step_hook=generation_step)
+                report('vq_decode')
+                with timer('decode'), stage('vq_decode'):
+                    pred_motions = vq_model.forward_decoder(mids)
+
+                pred_motions = pred_motions.detach().cpu().numpy()
+                data = inv_transform(pred_motions)
+
+        samples = []
+        for j, joint_data in enumerate(data):
+            k, r = j // num_cand, repeat_ids[j % num_cand]
+            samples.append(MotionResult(joint_data[:int(m_length[k])], captions[k], prompt_id=k, repeat_id=r))
+        yield Namespace(samples=samples, models=models, plan=plan, planner=planner, timer=timer,
+                        num_tokens=int(token_lens.max()), batch_size=len(captions) * num_cand)
+
+
+def export_sample(sample, animation_path, joint_path, tag, joints_only=False, timer=None):
+    '''
+    CPU half of generate_motion for one sample of generate_rounds: BVH (IK without foot IK), GIF of the IK
+    animation and its joint positions, as sample<k>_repeat<r>_len<frames>_<tag>.{bvh,gif,npy}.
+    :param joints_only: only save the recovered joint positions, without IK or rendering
+    :param timer: StageTimer the IK and rendering times are added to (for the latency planner)
+    :return: Namespace of the bvh, gif and joints paths (bvh and gif are None with joints_only)
+    '''
+    timer = timer if timer is not None else _planner.StageTimer()
+    name = f"sample{sample.prompt_id}_repeat{sample.repeat_id}_len{sample.m_length}_{tag}"
+    os.makedirs(animation_path, exist_ok=True)
+    os.makedirs(joint_path, exist_ok=True)
+
+    with stage('recover_from_ric'):
+        joint = sample.joints
+
+    bvh_path = gif_path = None
+    if not joints_only:
+        # BVH 書き出し
+        report('ik')
+        bvh_path = os.path.join(animation_path, name + '.bvh')
+        with timer('ik'), stage('bvh_convert'):
+            sample.bvh(bvh_path, foot_ik=False)
+
+        # GIF 書き出し
+        report('rendering')
+        gif_path = os.path.join(animation_path, name + '.gif')
+        with timer('animation'), stage('plot_3d_motion'):
+            sample.animation(gif_path, foot_ik=False)
+
+    joints_path = os.path.join(joint_path, name + '.npy')
+    with stage('file_writes'):
+        np.save(joints_path, joint if joints_only else sample.ik(foot_ik=False)[1])
+    count('frames', sample.m_length)
+    return Namespace(bvh=bvh_path, gif=gif_path, joints=joints_path)
+
+
+# --artifacts of the command line generator: name -> (sub folder, file suffix)
+ARTIFACTS = {
+    'record': ('joints', '.npz'),
+    'joints': ('joints', '.npy'),
+    'joints_raw': ('joints', '_raw.npy'),
+    'joints_ik': ('joints', '_ik.npy'),
+    'bvh': ('animations', '.bvh'),
+    'bvh_ik': ('animations', '_ik.bvh'),
+    'mp4': ('animations', '.mp4'),
+    'mp4_ik': ('animations', '_ik.mp4'),
+    'gif': ('animations', '.gif'),
+}
+
+
+def needs_ik(artifacts):
+    # Everything but the record and the raw joints is derived from the IK skeleton
+    return any(artifact not in ('record', 'joints_raw') for artifact in artifacts)
+
+
+def needs_animation(artifacts):
+    return any(ARTIFACTS[artifact][0] == 'animations' and not artifact.startswith('bvh') for artifact in artifacts)
+
+
+def export_artifact(result, artifact, animation_path, joint_path, name):
+    '''
+    Derive one of ARTIFACTS from a MotionResult and write it as <name><suffix>. '_ik' artifacts use foot IK;
+    joints / animations without it are those of the IK animation without foot IK, joints_raw are the recovered
+    joint positions (no IK at all). The record is the features from which every other artifact can be derived
+    later (MotionResult.load).
+    '''
+    folder, suffix = ARTIFACTS[artifact]
+    path = os.path.join(joint_path if folder == 'joints' else animation_path, name + suffix)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    foot_ik = None if artifact == 'joints_raw' else artifact.endswith('_ik')
+    if artifact == 'record':
+        result.save(path)
+    elif artifact.startswith('joints'):
+        result.save_joints(path, foot_ik=foot_ik)
+    elif artifact.startswith('bvh'):
+        result.bvh(path, foot_ik=foot_ik)
+    else:
+        result.animation(path, foot_ik=foot_ik)
+    return path
 
-            # GIF 書き出し
-            gif_path = os.path.join(animation_path, f"sample{k}_repeat{r}_len{m_length[k]}.gif")
-            plot_3d_motion(gif_path, kinematic_chain, joint, title=caption, fps=20)
 
-            np.save(os.path.join(joint_path, f"sample{k}_repeat{r}_len{m_length[k]}.npy"), joint)
+def finish_round(rnd):
+    # 予測と実測のステージ時間を表示し、実測値でコストモデルを更新する
+    if rnd.plan is not None:
+        print(rnd.plan.report(rnd.timer.stage_ms))
+        rnd.planner.observe(rnd.plan, rnd.timer.stage_ms, rnd.num_tokens, batch_size=rnd.batch_size)
 
-            # 保存先を指定
-            os.rename(bvh_path, bvh_output_path)
-            os.rename(gif_path, gif_output_path)
 
-            print(f"✅ {bvh_output_path} と {gif_output_path} を保存しました。")
+def generate_motion_samples(
+        text_prompt, cond_drop_prob=0.2, dropout=0.2, ff_size=1024, latent_dim=384,
+        max_motion_length=196, n_heads=6, n_layers=8, share_weight=True):
+    '''
+    Neural half of generate_motion for the job API (serving/jobs.py). The samples are plain numpy data, so with
+    --num_workers this runs in a worker process.
+    :return: samples of every repeat round, see generate_rounds
+    '''
+    opt = get_eval_options()
+    arch_overrides = arch_overrides_from_ui(cond_drop_prob, dropout, ff_size, latent_dim, max_motion_length,
+                                            n_heads, n_layers, share_weight)
+    pool = get_worker_pool(opt, **arch_overrides)
+    if pool is not None:
+        return pool.run(generate_motion_samples, text_prompt, cond_drop_prob=cond_drop_prob, dropout=dropout,
+                        ff_size=ff_size, latent_dim=latent_dim, max_motion_length=max_motion_length,
+                        n_heads=n_heads, n_layers=n_layers, share_weight=share_weight)
 
+    fixseed(opt.seed)
+    samples = []
+    with profile_request('generate_motion_samples', enabled=opt.profile, device=opt.device,
+                         json_dir=opt.profile_dir):
+        for rnd in generate_rounds(opt, text_prompt, arch_overrides):
+            samples.extend(rnd.samples)
+            # IK / 描画は別のエグゼキュータで行うため、予算には含めず、生成ステージの実測値だけを反映する
+            finish_round(rnd)
+        save_text_cache(get_generation_models(opt, **arch_overrides).t2m_transformer, opt)
+    return samples
+
+
+def export_motion_samples(samples, out_dir):
+    '''
+    CPU half of generate_motion for the job API: BVH, GIF (unless --joints_only) and joints of every sample,
+    written to out_dir.
+    :return: list of {'bvh', 'gif', 'joints'} paths, one per sample
+    '''
+    opt = get_eval_options()
+    with profile_request('export_motion_samples', enabled=opt.profile, json_dir=opt.profile_dir):
+        return [vars(export_sample(sample, out_dir, out_dir, 'motion', joints_only=opt.joints_only))
+                for sample in samples]
 
 
 
@@ -284,56 +766,18 @@ if __name__ == '__main__':
     os.makedirs(joints_dir, exist_ok=True)
     os.makedirs(animation_dir,exist_ok=True)
 
-    model_opt_path = pjoin(root_dir, 'opt.txt')
-    model_opt = get_opt(model_opt_path, device=opt.device)
-
-
-    #######################
-    ######Loading RVQ######
-    #######################
-    vq_opt_path = pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'opt.txt')
-    vq_opt = get_opt(vq_opt_path, device=opt.device)
-    vq_opt.dim_pose = dim_pose
-    vq_model, vq_opt = load_vq_model(vq_opt)
-
-    model_opt.num_tokens = vq_opt.nb_code
-    model_opt.num_quantizers = vq_opt.num_quantizers
-    model_opt.code_dim = vq_opt.code_dim
-
-    #################################
-    ######Loading R-Transformer######
-    #################################
-    res_opt_path = pjoin(opt.checkpoints_dir, opt.dataset_name, opt.res_name, 'opt.txt')
-    res_opt = get_opt(res_opt_path, device=opt.device)
-    res_model = load_res_model(res_opt, vq_opt, opt)
-
-    assert res_opt.vq_name == model_opt.vq_name
-
-    #################################
-    ######Loading M-Transformer######
-    #################################
-    t2m_transformer = load_trans_model(model_opt, opt, 'latest.tar')
-
-    ##################################
-    #####Loading Length Predictor#####
-    ##################################
-    length_estimator = load_len_estimator(model_opt)
-
-    t2m_transformer.eval()
-    vq_model.eval()
-    res_model.eval()
-    length_estimator.eval()
-
-    res_model.to(opt.device)
-    t2m_transformer.to(opt.device)
-    vq_model.to(opt.device)
-    length_estimator.to(opt.device)
+    models = get_generation_models(opt)
+    if opt.startup_report:
+        print(import_report())
+    t2m_transformer = models.t2m_transformer
+    res_model = models.res_model
+    vq_model = models.vq_model
+    length_estimator = models.length_estimator
 
     ##### ---- Dataloader ---- #####
     opt.nb_joints = 21 if opt.dataset_name == 'kit' else 22
 
-    mean = np.load(pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta', 'mean.npy'))
-    std = np.load(pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta', 'std.npy'))
+    mean, std = models.mean, models.std
     def inv_transform(data):
         return data * std + mean
 
@@ -362,12 +806,22 @@ if __name__ == '__main__':
         raise "A text prompt, or a file a text prompts are required!!!"
     # print('loading checkpoint {}'.format(file))
 
+    # Encode the prompts once, the embeddings are shared by the length estimator and both transformers.
+    # With a token budget, prompt files are encoded chunk by chunk to keep memory bounded
+    chunk_size = opt.max_batch_size if opt.token_budget > 0 else len(prompt_list)
+    with torch.no_grad():
+        text_embedding = torch.cat([t2m_transformer.encode_text(prompt_list[i:i + chunk_size])
+                                    for i in range(0, len(prompt_list), chunk_size)], dim=0)
+
     if est_length:
         print("Since no motion length are specified, we will use estimated motion lengthes!!")
-        text_embedding = t2m_transformer.encode_text(prompt_list)
-        pred_dis = length_estimator(text_embedding)
-        probs = F.softmax(pred_dis, dim=-1)  # (b, ntoken)
-        token_lens = Categorical(probs).sample()  # (b, seqlen)
+        token_lens = []
+        for i in range(0, len(prompt_list), chunk_size):
+            with torch.no_grad():
+                pred_dis = length_estimator(text_embedding[i:i + chunk_size])
+            probs = F.softmax(pred_dis, dim=-1)  # (b, ntoken)
+            token_lens.append(Categorical(probs).sample())  # (b, seqlen)
+        token_lens = torch.cat(token_lens, dim=0)
         # lengths = torch.multinomial()
     else:
         token_lens = torch.LongTensor(length_list) // 4
@@ -376,50 +830,69 @@ if __name__ == '__main__':
     m_length = token_lens * 4
     captions = prompt_list
 
-    sample = 0
-    kinematic_chain = t2m_kinematic_chain
-    converter = Joint2BVHConvertor()
+    # The IK / BVH stack and matplotlib are only loaded when BVH files and animations are written
+    artifacts = ['joints_raw'] if opt.joints_only else opt.artifacts
+    guidance = GuidanceSchedule.from_opt(opt)
 
-    for r in range(opt.repeat_times):
-        print("-->Repeat %d"%r)
-        with torch.no_grad():
-            mids = t2m_transformer.generate(captions, token_lens,
-                                            timesteps=opt.time_steps,
-                                            cond_scale=opt.cond_scale,
-                                            temperature=opt.temperature,
-                                            topk_filter_thres=opt.topkr,
-                                            gsample=opt.gumbel_sample)
-            # print(mids)
-            # print(mids.shape)
-            mids = res_model.generate(mids, captions, token_lens, temperature=1, cond_scale=5)
-            pred_motions = vq_model.forward_decoder(mids)
+    # With --batch_repeats, all repeats of a prompt are candidates of the same generate call,
+    # each drawing from its own (prompt, repeat) random stream
+    rounds = [list(range(opt.repeat_times))] if opt.batch_repeats else [[r] for r in range(opt.repeat_times)]
+    num_cand = len(rounds[0])
 
-            pred_motions = pred_motions.detach().cpu().numpy()
-
-            data = inv_transform(pred_motions)
-
-        for k, (caption, joint_data)  in enumerate(zip(captions, data)):
-            print("---->Sample %d: %s %d"%(k, caption, m_length[k]))
-            animation_path = pjoin(animation_dir, str(k))
-            joint_path = pjoin(joints_dir, str(k))
-
-            os.makedirs(animation_path, exist_ok=True)
-            os.makedirs(joint_path, exist_ok=True)
-
-            joint_data = joint_data[:m_length[k]]
-            joint = recover_from_ric(torch.from_numpy(joint_data).float(), 22).numpy()
-
-            bvh_path = pjoin(animation_path, "sample%d_repeat%d_len%d_ik.bvh"%(k, r, m_length[k]))
-            _, ik_joint = converter.convert(joint, filename=bvh_path, iterations=100)
-
-            bvh_path = pjoin(animation_path, "sample%d_repeat%d_len%d.bvh" % (k, r, m_length[k]))
-            _, joint = converter.convert(joint, filename=bvh_path, iterations=100, foot_ik=False)
-
-
-            save_path = pjoin(animation_path, "sample%d_repeat%d_len%d.mp4"%(k, r, m_length[k]))
-            ik_save_path = pjoin(animation_path, "sample%d_repeat%d_len%d_ik.mp4"%(k, r, m_length[k]))
-
-            plot_3d_motion(ik_save_path, kinematic_chain, ik_joint, title=caption, fps=20)
-            plot_3d_motion(save_path, kinematic_chain, joint, title=caption, fps=20)
-            np.save(pjoin(joint_path, "sample%d_repeat%d_len%d.npy"%(k, r, m_length[k])), joint)
-            np.save(pjoin(joint_path, "sample%d_repeat%d_len%d_ik.npy"%(k, r, m_length[k])), ik_joint)
\ No newline at end of file
+    if opt.token_budget > 0:
+        # Prompts of similar length share a micro-batch, so little compute is spent on padding
+        batches = length_bucketed_batches(token_lens.tolist(), max(opt.token_budget // num_cand, 1),
+                                          max(opt.max_batch_size // num_cand, 1))
+        print("%d prompts in %d length-bucketed micro-batches" % (len(captions), len(batches)))
+    else:
+        batches = [list(range(len(captions)))]
+
+    for repeat_ids in rounds:
+        print("-->Repeat %s" % ', '.join(map(str, repeat_ids)))
+        for b, batch_ids in enumerate(batches):
+            if len(batches) > 1:
+                print("--->Micro-batch %d/%d, %d prompts" % (b + 1, len(batches), len(batch_ids)))
+            batch_ids_t = torch.LongTensor(batch_ids).to(text_embedding.device)
+            batch_embedding = text_embedding[batch_ids_t].repeat_interleave(num_cand, dim=0)
+            batch_token_lens = token_lens[batch_ids_t.to(token_lens.device)].repeat_interleave(num_cand, dim=0)
+            generators = candidate_generators(opt.seed, batch_ids, repeat_ids, opt.device) \
+                if opt.batch_repeats else None
+            with torch.no_grad():
+                mids = t2m_transformer.generate(batch_embedding, batch_token_lens,
+                                                timesteps=opt.time_steps,
+                                                cond_scale=opt.cond_scale,
+                                                temperature=opt.temperature,
+                                                topk_filter_thres=opt.topkr,
+                                                gsample=opt.gumbel_sample,
+                                                generators=generators,
+                                                guidance=guidance)
+                # print(mids)
+                # print(mids.shape)
+                mids = res_model.generate(mids, batch_embedding, batch_token_lens, temperature=1, cond_scale=5,
+                                          generators=generators, guidance=guidance)
+                pred_motions = vq_model.forward_decoder(mids)
+
+                pred_motions = pred_motions.detach().cpu().numpy()
+
+                data = inv_transform(pred_motions)
+
+            # Outputs are written per micro-batch and named by the prompt's index in the input
+            for j, joint_data in enumerate(data):
+                k, r = batch_ids[j // num_cand], repeat_ids[j % num_cand]
+                caption = captions[k]
+                print("---->Sample %d: %s %d"%(k, caption, m_length[k]))
+                animation_path = pjoin(animation_dir, str(k))
+                joint_path = pjoin(joints_dir, str(k))
+
+                os.makedirs(animation_path, exist_ok=True)
+                os.makedirs(joint_path, exist_ok=True)
+
+                # Only the requested artifacts (--artifacts) are derived from the generated features
+                result = MotionResult(joint_data[:m_length[k]], caption, prompt_id=k, repeat_id=r)
+                name = "sample%d_repeat%d_len%d" % (k, r, m_length[k])
+                for artifact in artifacts:
+                    export_artifact(result, artifact, animation_path, joint_path, name)
+
+    save_text_cache(t2m_transformer, opt)
+    if opt.startup_report:
+        print(import_report())
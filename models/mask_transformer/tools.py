@@ -2,6 +2,7 @@ import torch
 import torch.nn.functional as F
 import math
 from einops import rearrange
+from torch.distributions.categorical import Categorical
 
 # return mask where padding is FALSE
 def lengths_to_mask(lengths, max_len):
@@ -34,11 +35,15 @@ def default(val, d):
     return val if exists(val) else d
 
 def eval_decorator(fn):
+    # Only flip the mode of models that are in training mode, so that concurrent calls
+    # on an eval-mode (served) model never switch it back to training halfway through.
     def inner(model, *args, **kwargs):
         was_training = model.training
-        model.eval()
+        if was_training:
+            model.eval()
         out = fn(model, *args, **kwargs)
-        model.train(was_training)
+        if was_training:
+            model.train(was_training)
         return out
     return inner
 
@@ -87,12 +92,51 @@ def prob_mask_like(shape, prob, device=None):
 def log(t, eps = 1e-20):
     return torch.log(t.clamp(min = eps))
 
-def gumbel_noise(t):
-    noise = torch.zeros_like(t).uniform_(0, 1)
+# Per-sample values (b,) -> (b, 1, ..., 1), broadcastable against t
+def per_sample(val, t):
+    return val.view(-1, *([1] * (t.dim() - 1))).to(t.device)
+
+# Uniform noise like t, row i drawn from generators[i] when given. With lengths (b,), row i only draws over its
+# first lengths[i] positions along dim 1, and with widths (b,) over its first widths[i] entries along the last dim
+# (the rest is filled with 0.5), so how much of a sample's random stream a call consumes does not depend on the
+# padded shape of its batch.
+def rand_like_rows(t, generators=None, lengths=None, widths=None):
+    if generators is None:
+        return torch.zeros_like(t).uniform_(0, 1)
+    if lengths is None and widths is None:
+        return torch.stack([torch.rand(t.shape[1:], generator=g, device=t.device, dtype=t.dtype) for g in generators])
+    rows = []
+    for i, g in enumerate(generators):
+        shape = list(t.shape[1:])
+        if lengths is not None:
+            shape[0] = min(int(lengths[i]), shape[0])
+        if widths is not None:
+            shape[-1] = min(int(widths[i]), shape[-1])
+        noise = torch.rand(shape, generator=g, device=t.device, dtype=t.dtype)
+        pad = [p for n, full in zip(reversed(shape), reversed(t.shape[1:])) for p in (0, full - n)]
+        rows.append(F.pad(noise, pad, value=0.5))
+    return torch.stack(rows)
+
+def gumbel_noise(t, generators=None, lengths=None, widths=None):
+    noise = rand_like_rows(t, generators, lengths, widths)
     return -log(-log(noise))
 
-def gumbel_sample(t, temperature = 1., dim = 1):
-    return ((t / max(temperature, 1e-10)) + gumbel_noise(t)).argmax(dim=dim)
+def gumbel_sample(t, temperature = 1., dim = 1, generators=None, lengths=None):
+    if torch.is_tensor(temperature):
+        temperature = per_sample(temperature.clamp(min=1e-10), t)
+    else:
+        temperature = max(temperature, 1e-10)
+    return ((t / temperature) + gumbel_noise(t, generators, lengths)).argmax(dim=dim)
+
+# probs: (b, ..., ntoken), sample along the last dim, row i from generators[i] when given.
+# With generators, every position takes one uniform draw and inverts the cumulative distribution, so the draws
+# do not depend on the number of (zero probability) candidates the batch pads probs to; lengths as rand_like_rows.
+def categorical_sample(probs, generators=None, lengths=None):
+    if generators is None:
+        return Categorical(probs).sample()
+    cdf = probs.cumsum(dim=-1)
+    u = rand_like_rows(probs[..., 0], generators, lengths).unsqueeze(-1) * cdf[..., -1:]
+    return torch.searchsorted(cdf, u, right=True).squeeze(-1).clamp(max=probs.shape[-1] - 1)
 
 
 # Example input:
@@ -104,8 +148,16 @@ def gumbel_sample(t, temperature = 1., dim = 1):
 #         [  -inf,   -inf, 0.6628,   -inf,   -inf,   -inf],
 #         [0.9428,   -inf,   -inf,   -inf,   -inf,   -inf]]
 def top_k(logits, thres = 0.9, dim = 1):
-    k = math.ceil((1 - thres) * logits.shape[dim])
-    val, ind = logits.topk(k, dim = dim)
+    if torch.is_tensor(thres):
+        # per-sample thresholds (b,), only along the last dim
+        assert dim in (-1, logits.dim() - 1)
+        ks = torch.ceil((1 - thres) * logits.shape[dim]).long().clamp(min=1)
+        val, ind = logits.topk(int(ks.max()), dim = dim)
+        rank = torch.arange(val.shape[dim], device=logits.device)
+        val = val.masked_fill(rank >= per_sample(ks, val), float('-inf'))
+    else:
+        k = math.ceil((1 - thres) * logits.shape[dim])
+        val, ind = logits.topk(k, dim = dim)
     probs = torch.full_like(logits, float('-inf'))
     probs.scatter_(dim, ind, val)
     # func verified
@@ -114,6 +166,57 @@ def top_k(logits, thres = 0.9, dim = 1):
     # raise
     return probs
 
+# Fused top-k filtering, sampling and confidence scoring over the last dim of logits (b, ..., ntoken).
+# Only the k candidates are sampled from, which is equivalent to sampling from top_k(logits) since the filtered
+# entries have zero probability. Returns the sampled ids (b, ...) and their probability under the unfiltered,
+# untempered softmax, i.e. logits.softmax(-1).gather(-1, ids), without building (b, ..., ntoken) intermediates.
+# With generators, pass the token lengths (b,): a sample's draws then depend neither on the padded length nor on the
+# candidates (k) of the other samples of its batch.
+def sample_top_k(logits, thres = 0.9, temperature = 1., gsample = False, generators = None, lengths = None):
+    ntoken = logits.shape[-1]
+    if torch.is_tensor(thres):
+        # per-sample thresholds (b,)
+        ks = torch.ceil((1 - thres) * ntoken).long().clamp(min=1)
+        val, ind = logits.topk(int(ks.max()), dim = -1)
+        rank = torch.arange(val.shape[-1], device=logits.device)
+        cand = val.masked_fill(rank >= per_sample(ks, val), float('-inf'))
+    else:
+        val, ind = logits.topk(math.ceil((1 - thres) * ntoken), dim = -1)
+        cand = val
+        ks = None
+
+    if gsample:
+        if generators is None:
+            choice = gumbel_sample(cand, temperature=temperature, dim=-1)
+        else:
+            # Each sample draws over its own k candidates only (ranked by logit, so the draw order is well defined)
+            noise = gumbel_noise(cand, generators, lengths, widths=ks)
+            if torch.is_tensor(temperature):
+                temperature = per_sample(temperature.clamp(min=1e-10), cand)
+            else:
+                temperature = max(temperature, 1e-10)
+            choice = (cand / temperature + noise).argmax(dim=-1)
+    else:
+        if torch.is_tensor(temperature):
+            probs = F.softmax(cand / per_sample(temperature, cand), dim=-1)
+        else:
+            probs = F.softmax(cand / temperature, dim=-1)
+        choice = categorical_sample(probs, generators, lengths)
+
+    choice = choice.unsqueeze(-1)
+    ids = ind.gather(-1, choice).squeeze(-1)
+    scores = (val.gather(-1, choice).squeeze(-1) - logits.logsumexp(dim=-1)).exp()
+    return ids, scores
+
+# Mask of the num_low[i] lowest scores of each row, scores (b, n), num_low (b,)
+def lowest_k_mask(scores, num_low):
+    num_low = num_low.long()
+    low_ind = scores.topk(min(int(num_low.max()), scores.shape[1]), dim=1, largest=False).indices  # sorted, lowest first
+    rank = torch.arange(low_ind.shape[1], device=scores.device)
+    is_mask = torch.zeros_like(scores, dtype=torch.bool)
+    is_mask.scatter_(1, low_ind, rank < num_low.unsqueeze(-1))
+    return is_mask
+
 # noise schedules
 
 # More on large value, less on small
@@ -123,6 +226,73 @@ def cosine_schedule(t):
 def scale_cosine_schedule(t, scale):
     return torch.clip(scale*torch.cos(t * math.pi * 0.5) + 1 - scale, min=0., max=1.)
 
+# guidance schedules
+
+class GuidanceSchedule:
+    '''
+    Classifier-free guidance scale per mask-decoding step and per residual layer.
+    A scale of exactly 1 skips the unconditional forward pass.
+    :param curve: 'constant', 'linear' or 'cosine' (decay from cond_scale at the first step to 1 at the last),
+        or a list of absolute per-step scales (the last one is reused for any remaining steps)
+    :param cfg_stop_step: guidance is turned off from this mask-decoding step on, None keeps it on
+    :param res_cfg_layers: only the first n residual layers use guidance, None for all
+    '''
+    def __init__(self, curve='constant', cfg_stop_step=None, res_cfg_layers=None):
+        if isinstance(curve, str):
+            assert curve in ('constant', 'linear', 'cosine'), f'Unknown guidance curve {curve}'
+        self.curve = curve
+        self.cfg_stop_step = cfg_stop_step
+        self.res_cfg_layers = res_cfg_layers
+
+    def step_scale(self, cond_scale, step, timesteps):
+        '''
+        :param cond_scale: base scale, scalar or per-sample (b,) tensor
+        :return: guidance scale of mask-decoding step (0-based) out of timesteps
+        '''
+        if self.cfg_stop_step is not None and step >= self.cfg_stop_step:
+            return 1
+        if not isinstance(self.curve, str):
+            return self.curve[min(step, len(self.curve) - 1)]
+        if self.curve == 'constant' or timesteps <= 1:
+            return cond_scale
+        progress = step / (timesteps - 1)
+        if self.curve == 'linear':
+            weight = 1. - progress
+        else:
+            weight = math.cos(progress * math.pi * 0.5)
+        return 1 + (cond_scale - 1) * weight
+
+    def res_scale(self, cond_scale, layer):
+        '''
+        :param layer: residual quantizer layer, starting from 1
+        '''
+        if self.res_cfg_layers is not None and layer > self.res_cfg_layers:
+            return 1
+        return cond_scale
+
+    def num_uncond_passes(self, timesteps, num_res_layers):
+        '''
+        Number of unconditional forward passes with this schedule, for constant cond_scale != 1.
+        '''
+        mask_passes = sum(self.step_scale(2, t, timesteps) != 1 for t in range(timesteps))
+        res_passes = sum(self.res_scale(2, q) != 1 for q in range(1, num_res_layers + 1))
+        return mask_passes + res_passes
+
+    @classmethod
+    def from_opt(cls, opt):
+        '''
+        Build from the --cfg_curve / --cfg_stop_step / --res_cfg_layers options, None when they keep the default.
+        '''
+        curve = opt.cfg_curve
+        if curve not in ('constant', 'linear', 'cosine'):
+            curve = [float(v) for v in curve.split(',')]
+        stop = opt.cfg_stop_step if opt.cfg_stop_step >= 0 else None
+        res_layers = opt.res_cfg_layers if opt.res_cfg_layers >= 0 else None
+        if curve == 'constant' and stop is None and res_layers is None:
+            return None
+        return cls(curve, stop, res_layers)
+
+
 # More on small value, less on large
 def q_schedule(bs, low, high, device):
     noise = uniform((bs,), device=device)
@@ -3,7 +3,6 @@ import torch.nn as nn
 import numpy as np
 # from networks.layers import *
 import torch.nn.functional as F
-import clip
 from einops import rearrange, repeat
 import math
 from random import random
@@ -11,7 +10,9 @@ from tqdm.auto import tqdm
 from typing import Callable, Optional, List, Dict
 from copy import deepcopy
 from functools import partial
+from contextlib import nullcontext
 from models.mask_transformer.tools import *
+from models.text_encoder import get_text_encoder
 from torch.distributions.categorical import Categorical
 
 class InputProcess(nn.Module):
@@ -143,12 +144,17 @@ class MaskTransformer(nn.Module):
         Preparing frozen weights
         '''
 
+        self.text_encoder = None
         if self.cond_mode == 'text':
-            print('Loading CLIP...')
             self.clip_version = clip_version
-            self.clip_model = self.load_and_freeze_clip(clip_version)
+            # clip_version=None leaves CLIP out, conditions then have to be given as precomputed embeddings
+            if clip_version is not None:
+                print('Loading CLIP...')
+                self.clip_model = self.load_and_freeze_clip(clip_version)
 
         self.noise_schedule = cosine_schedule
+        # Classifier-free guidance in one forward pass over a doubled (cond, uncond) batch
+        self.batch_cfg = False
 
     def load_and_freeze_token_emb(self, codebook):
         '''
@@ -176,26 +182,23 @@ class MaskTransformer(nn.Module):
         return [p for name, p in self.named_parameters() if not name.startswith('clip_model.')]
 
     def load_and_freeze_clip(self, clip_version):
-        clip_model, clip_preprocess = clip.load(clip_version, device='cpu',
-                                                jit=False)  # Must set jit=False for training
         # Added support for cpu
-        if str(self.opt.device) != "cpu":
-            clip.model.convert_weights(
-                clip_model)  # Actually this line is unnecessary since clip by default already on float16
-            # Date 0707: It's necessary, only unecessary when load directly to gpu. Disable if need to run on cpu
-
-        # Freeze CLIP weights
-        clip_model.eval()
-        for p in clip_model.parameters():
-            p.requires_grad = False
-
-        return clip_model
+        # Date 0707: fp16 conversion is necessary, only unecessary when load directly to gpu. Disable if need to run on cpu
+        # The frozen CLIP (and its text embedding cache) is shared with every other model of the process
+        self.text_encoder = get_text_encoder(clip_version, convert_fp16=str(self.opt.device) != "cpu")
+        return self.text_encoder.clip_model
 
     def encode_text(self, raw_text):
+        '''
+        :param raw_text: list of b prompts, or an already computed (b, clip_dim) condition tensor
+        :return: (b, clip_dim) float condition vectors
+        '''
         device = next(self.parameters()).device
-        text = clip.tokenize(raw_text, truncate=True).to(device)
-        feat_clip_text = self.clip_model.encode_text(text).float()
-        return feat_clip_text
+        if torch.is_tensor(raw_text):
+            return raw_text.to(device).float()
+        if self.text_encoder is None:
+            raise RuntimeError('No CLIP model loaded (clip_version=None), pass precomputed text embeddings')
+        return self.text_encoder.encode(raw_text, device, use_cache=not self.training)
 
     def mask_cond(self, cond, force_mask=False):
         bs, d =  cond.shape
@@ -314,15 +317,78 @@ class MaskTransformer(nn.Module):
         if force_mask:
             return self.trans_forward(motion_ids, cond_vector, padding_mask, force_mask=True)
 
-        logits = self.trans_forward(motion_ids, cond_vector, padding_mask)
-        if cond_scale == 1:
-            return logits
+        if not torch.is_tensor(cond_scale) and cond_scale == 1:
+            return self.trans_forward(motion_ids, cond_vector, padding_mask)
 
-        aux_logits = self.trans_forward(motion_ids, cond_vector, padding_mask, force_mask=True)
+        if self.batch_cfg:
+            # Conditional and unconditional (all-zero cond, same as force_mask) halves in one pass
+            bs = motion_ids.shape[0]
+            both_logits = self.trans_forward(torch.cat([motion_ids, motion_ids], dim=0),
+                                             torch.cat([cond_vector, torch.zeros_like(cond_vector)], dim=0),
+                                             torch.cat([padding_mask, padding_mask], dim=0))
+            logits, aux_logits = both_logits[:bs], both_logits[bs:]
+        else:
+            logits = self.trans_forward(motion_ids, cond_vector, padding_mask)
+            aux_logits = self.trans_forward(motion_ids, cond_vector, padding_mask, force_mask=True)
 
+        if torch.is_tensor(cond_scale):  # per-sample scales, (b,)
+            cond_scale = per_sample(cond_scale, logits)
         scaled_logits = aux_logits + (logits - aux_logits) * cond_scale
         return scaled_logits
 
+    @torch.no_grad()
+    def masked_decode_step(self, ids, scores, cond_vector, padding_mask, m_lens, timestep, cond_scale,
+                           temperature=1, topk_filter_thres=0.9, gsample=False, force_mask=False, generators=None):
+        '''
+        One iteration of the masked decoding loop of generate: re-mask the lowest-scored tokens and resample them.
+        :param ids: (b, seqlen) current tokens, pad_id on padding
+        :param scores: (b, seqlen) confidence of the current tokens, 1e5 for tokens that must not be re-masked
+        :param m_lens: (b,) token lengths
+        :param timestep: position in the noise schedule, 0 <= timestep <= 1, scalar or per-sample (b,) tensor
+        :return: updated ids and scores
+        '''
+        rand_mask_prob = self.noise_schedule(timestep)  # Tensor
+
+        '''
+        Maskout, and cope with variable length
+        '''
+        # fix: the ratio regarding lengths, instead of seq_len
+        num_token_masked = torch.round(rand_mask_prob * m_lens).clamp(min=1)  # (b, )
+
+        # select num_token_masked tokens with lowest scores to be masked
+        is_mask = lowest_k_mask(scores, num_token_masked)  # (b, k)
+        ids = torch.where(is_mask, self.mask_id, ids)
+
+        '''
+        Preparing input
+        '''
+        # (b, num_token, seqlen)
+        logits = self.forward_with_cond_scale(ids, cond_vector=cond_vector,
+                                              padding_mask=padding_mask,
+                                              cond_scale=cond_scale,
+                                              force_mask=force_mask)
+
+        logits = logits.permute(0, 2, 1)  # (b, seqlen, ntoken)
+
+        '''
+        Update ids
+        '''
+        # Top-k filtering, gumbel / multinomial sampling and the scores (unfiltered probability of the
+        # sampled token) in one pass over the top-k candidates
+        pred_ids, scores = sample_top_k(logits, topk_filter_thres, temperature=temperature, gsample=gsample,
+                                        generators=generators, lengths=m_lens)  # (b, seqlen), (b, seqlen)
+
+        # print(pred_ids.max(), pred_ids.min())
+        # if pred_ids.
+        ids = torch.where(is_mask, pred_ids, ids)
+
+        '''
+        Updating scores
+        '''
+        # We do not want to re-mask the previously kept tokens, or pad tokens
+        scores = scores.masked_fill(~is_mask, 1e5)
+        return ids, scores
+
     @torch.no_grad()
     @eval_decorator
     def generate(self,
@@ -333,8 +399,18 @@ class MaskTransformer(nn.Module):
                  temperature=1,
                  topk_filter_thres=0.9,
                  gsample=False,
-                 force_mask=False
+                 force_mask=False,
+                 generators=None,
+                 guidance=None,
+                 step_hook=None,
                  ):
+        '''
+        cond_scale, temperature and topk_filter_thres take either a scalar or a per-sample (b,) tensor.
+        :param generators: optional list of b torch.Generator, one random stream per sample
+        :param guidance: optional GuidanceSchedule, varies cond_scale over the decoding steps
+        :param step_hook: optional step_hook('mask_step', step, timesteps) returning a context manager that wraps
+            every decoding step (step counts from 1), e.g. for progress reports and stage timings
+        '''
         # print(self.opt.num_quantizers)
         # assert len(timesteps) >= len(cond_scales) == self.opt.num_quantizers
 
@@ -362,68 +438,16 @@ class MaskTransformer(nn.Module):
 
         for timestep, steps_until_x0 in zip(torch.linspace(0, 1, timesteps, device=device), reversed(range(timesteps))):
             # 0 < timestep < 1
-            rand_mask_prob = self.noise_schedule(timestep)  # Tensor
-
-            '''
-            Maskout, and cope with variable length
-            '''
-            # fix: the ratio regarding lengths, instead of seq_len
-            num_token_masked = torch.round(rand_mask_prob * m_lens).clamp(min=1)  # (b, )
-
-            # select num_token_masked tokens with lowest scores to be masked
-            sorted_indices = scores.argsort(
-                dim=1)  # (b, k), sorted_indices[i, j] = the index of j-th lowest element in scores on dim=1
-            ranks = sorted_indices.argsort(dim=1)  # (b, k), rank[i, j] = the rank (0: lowest) of scores[i, j] on dim=1
-            is_mask = (ranks < num_token_masked.unsqueeze(-1))
-            ids = torch.where(is_mask, self.mask_id, ids)
-
-            '''
-            Preparing input
-            '''
-            # (b, num_token, seqlen)
-            logits = self.forward_with_cond_scale(ids, cond_vector=cond_vector,
-                                                  padding_mask=padding_mask,
-                                                  cond_scale=cond_scale,
-                                                  force_mask=force_mask)
-
-            logits = logits.permute(0, 2, 1)  # (b, seqlen, ntoken)
-            # print(logits.shape, self.opt.num_tokens)
-            # clean low prob token
-            filtered_logits = top_k(logits, topk_filter_thres, dim=-1)
-
-            '''
-            Update ids
-            '''
-            # if force_mask:
-            temperature = starting_temperature
-            # else:
-            # temperature = starting_temperature * (steps_until_x0 / timesteps)
-            # temperature = max(temperature, 1e-4)
-            # print(filtered_logits.shape)
-            # temperature is annealed, gradually reducing temperature as well as randomness
-            if gsample:  # use gumbel_softmax sampling
-                # print("1111")
-                pred_ids = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)  # (b, seqlen)
-            else:  # use multinomial sampling
-                # print("2222")
-                probs = F.softmax(filtered_logits / temperature, dim=-1)  # (b, seqlen, ntoken)
-                # print(temperature, starting_temperature, steps_until_x0, timesteps)
-                # print(probs / temperature)
-                pred_ids = Categorical(probs).sample()  # (b, seqlen)
-
-            # print(pred_ids.max(), pred_ids.min())
-            # if pred_ids.
-            ids = torch.where(is_mask, pred_ids, ids)
-
-            '''
-            Updating scores
-            '''
-            probs_without_temperature = logits.softmax(dim=-1)  # (b, seqlen, ntoken)
-            scores = probs_without_temperature.gather(2, pred_ids.unsqueeze(dim=-1))  # (b, seqlen, 1)
-            scores = scores.squeeze(-1)  # (b, seqlen)
-
-            # We do not want to re-mask the previously kept tokens, or pad tokens
-            scores = scores.masked_fill(~is_mask, 1e5)
+            step_cond_scale = cond_scale if guidance is None else \
+                guidance.step_scale(cond_scale, timesteps - 1 - steps_until_x0, timesteps)
+            with step_hook('mask_step', timesteps - steps_until_x0, timesteps) if step_hook else nullcontext():
+                ids, scores = self.masked_decode_step(ids, scores, cond_vector, padding_mask, m_lens, timestep,
+                                                      cond_scale=step_cond_scale,
+                                                      temperature=starting_temperature,
+                                                      topk_filter_thres=topk_filter_thres,
+                                                      gsample=gsample,
+                                                      force_mask=force_mask,
+                                                      generators=generators)
 
         ids = torch.where(padding_mask, -1, ids)
         # print("Final", ids.max(), ids.min())
@@ -444,6 +468,7 @@ class MaskTransformer(nn.Module):
              force_mask=False,
              edit_mask=None,
              padding_mask=None,
+             guidance=None,
              ):
 
         assert edit_mask.shape == tokens.shape if edit_mask is not None else True
@@ -490,10 +515,7 @@ class MaskTransformer(nn.Module):
             num_token_masked = torch.round(rand_mask_prob * edit_len).clamp(min=1)  # (b, )
 
             # select num_token_masked tokens with lowest scores to be masked
-            sorted_indices = scores.argsort(
-                dim=1)  # (b, k), sorted_indices[i, j] = the index of j-th lowest element in scores on dim=1
-            ranks = sorted_indices.argsort(dim=1)  # (b, k), rank[i, j] = the rank (0: lowest) of scores[i, j] on dim=1
-            is_mask = (ranks < num_token_masked.unsqueeze(-1))
+            is_mask = lowest_k_mask(scores, num_token_masked)  # (b, k)
             # is_mask = (torch.rand_like(scores) < 0.8) * ~padding_mask if mask_free else is_mask
             ids = torch.where(is_mask, self.mask_id, ids)
 
@@ -501,15 +523,14 @@ class MaskTransformer(nn.Module):
             Preparing input
             '''
             # (b, num_token, seqlen)
+            step_cond_scale = cond_scale if guidance is None else \
+                guidance.step_scale(cond_scale, timesteps - 1 - steps_until_x0, timesteps)
             logits = self.forward_with_cond_scale(ids, cond_vector=cond_vector,
                                                   padding_mask=padding_mask,
-                                                  cond_scale=cond_scale,
+                                                  cond_scale=step_cond_scale,
                                                   force_mask=force_mask)
 
             logits = logits.permute(0, 2, 1)  # (b, seqlen, ntoken)
-            # print(logits.shape, self.opt.num_tokens)
-            # clean low prob token
-            filtered_logits = top_k(logits, topk_filter_thres, dim=-1)
 
             '''
             Update ids
@@ -519,17 +540,9 @@ class MaskTransformer(nn.Module):
             # else:
             # temperature = starting_temperature * (steps_until_x0 / timesteps)
             # temperature = max(temperature, 1e-4)
-            # print(filtered_logits.shape)
-            # temperature is annealed, gradually reducing temperature as well as randomness
-            if gsample:  # use gumbel_softmax sampling
-                # print("1111")
-                pred_ids = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)  # (b, seqlen)
-            else:  # use multinomial sampling
-                # print("2222")
-                probs = F.softmax(filtered_logits / temperature, dim=-1)  # (b, seqlen, ntoken)
-                # print(temperature, starting_temperature, steps_until_x0, timesteps)
-                # print(probs / temperature)
-                pred_ids = Categorical(probs).sample()  # (b, seqlen)
+            # Top-k filtering, sampling and the scores of the sampled tokens in one pass
+            pred_ids, scores = sample_top_k(logits, topk_filter_thres, temperature=temperature,
+                                            gsample=gsample)  # (b, seqlen), (b, seqlen)
 
             # print(pred_ids.max(), pred_ids.min())
             # if pred_ids.
@@ -538,10 +551,6 @@ class MaskTransformer(nn.Module):
             '''
             Updating scores
             '''
-            probs_without_temperature = logits.softmax(dim=-1)  # (b, seqlen, ntoken)
-            scores = probs_without_temperature.gather(2, pred_ids.unsqueeze(dim=-1))  # (b, seqlen, 1)
-            scores = scores.squeeze(-1)  # (b, seqlen)
-
             # We do not want to re-mask the previously kept tokens, or pad tokens
             scores = scores.masked_fill(~edit_mask, 1e5) if mask_free else scores.masked_fill(~is_mask, 1e5)
 
@@ -698,11 +707,16 @@ class ResidualTransformer(nn.Module):
         self.apply(self.__init_weights)
         self.shared_codebook = shared_codebook
         self.share_weight = share_weight
+        # Classifier-free guidance in one forward pass over a doubled (cond, uncond) batch
+        self.batch_cfg = False
 
+        self.text_encoder = None
         if self.cond_mode == 'text':
-            print('Loading CLIP...')
             self.clip_version = clip_version
-            self.clip_model = self.load_and_freeze_clip(clip_version)
+            # clip_version=None leaves CLIP out, conditions then have to be given as precomputed embeddings
+            if clip_version is not None:
+                print('Loading CLIP...')
+                self.clip_model = self.load_and_freeze_clip(clip_version)
 
     # def
 
@@ -729,26 +743,23 @@ class ResidualTransformer(nn.Module):
         return [p for name, p in self.named_parameters() if not name.startswith('clip_model.')]
 
     def load_and_freeze_clip(self, clip_version):
-        clip_model, clip_preprocess = clip.load(clip_version, device='cpu',
-                                                jit=False)  # Must set jit=False for training
         # Added support for cpu
-        if str(self.opt.device) != "cpu":
-            clip.model.convert_weights(
-                clip_model)  # Actually this line is unnecessary since clip by default already on float16
-            # Date 0707: It's necessary, only unecessary when load directly to gpu. Disable if need to run on cpu
-
-        # Freeze CLIP weights
-        clip_model.eval()
-        for p in clip_model.parameters():
-            p.requires_grad = False
-
-        return clip_model
+        # Date 0707: fp16 conversion is necessary, only unecessary when load directly to gpu. Disable if need to run on cpu
+        # The frozen CLIP (and its text embedding cache) is shared with every other model of the process
+        self.text_encoder = get_text_encoder(clip_version, convert_fp16=str(self.opt.device) != "cpu")
+        return self.text_encoder.clip_model
 
     def encode_text(self, raw_text):
+        '''
+        :param raw_text: list of b prompts, or an already computed (b, clip_dim) condition tensor
+        :return: (b, clip_dim) float condition vectors
+        '''
         device = next(self.parameters()).device
-        text = clip.tokenize(raw_text, truncate=True).to(device)
-        feat_clip_text = self.clip_model.encode_text(text).float()
-        return feat_clip_text
+        if torch.is_tensor(raw_text):
+            return raw_text.to(device).float()
+        if self.text_encoder is None:
+            raise RuntimeError('No CLIP model loaded (clip_version=None), pass precomputed text embeddings')
+        return self.text_encoder.encode(raw_text, device, use_cache=not self.training)
 
 
     def q_schedule(self, bs, low, high):
@@ -758,10 +769,16 @@ class ResidualTransformer(nn.Module):
 
     def process_embed_proj_weight(self):
         if self.share_weight and (not self.shared_codebook):
-            # if not self.registered:
-            self.output_proj_weight = torch.cat([self.embed_proj_shared_weight, self.output_proj_weight_], dim=0)
-            self.token_embed_weight = torch.cat([self.token_embed_weight_, self.embed_proj_shared_weight], dim=0)
-                # self.registered = True
+            # In inference, the combined weights are only rebuilt when a source parameter was moved or modified
+            # (data_ptr / _version change); with gradients they are rebuilt every time to stay in the graph
+            weights_key = tuple((p.data_ptr(), p._version) for p in
+                                (self.embed_proj_shared_weight, self.output_proj_weight_, self.token_embed_weight_))
+            if torch.is_grad_enabled() or weights_key != getattr(self, '_combined_weights_key', None):
+                # if not self.registered:
+                self.output_proj_weight = torch.cat([self.embed_proj_shared_weight, self.output_proj_weight_], dim=0)
+                self.token_embed_weight = torch.cat([self.token_embed_weight_, self.embed_proj_shared_weight], dim=0)
+                self._combined_weights_key = None if torch.is_grad_enabled() else weights_key
+                    # self.registered = True
 
     def output_project(self, logits, qids):
         '''
@@ -781,6 +798,22 @@ class ResidualTransformer(nn.Module):
             output += output + output_proj_bias.unsqueeze(-1)
         return output
 
+    def output_project_layer(self, logits, qid):
+        '''
+        output_project for a batch that shares one quantizer layer: a single matmul with that layer's weights.
+        :logits: (bs, code_dim, seqlen)
+        :qid: int
+
+        :return:
+            -logits (bs, ntoken, seqlen)
+        '''
+        # (ntoken, code_dim) @ (bs, code_dim, seqlen) -> (bs, ntoken, seqlen)
+        output = torch.matmul(self.output_proj_weight[qid], logits)
+        if self.output_proj_bias is not None:
+            # Same arithmetic as output_project (output += output + bias)
+            output = output + (output + self.output_proj_bias[qid].unsqueeze(-1))
+        return output
+
 
 
     def trans_forward(self, motion_codes, qids, cond, padding_mask, force_mask=False):
@@ -823,17 +856,29 @@ class ResidualTransformer(nn.Module):
         qids = torch.full((bs,), q_id, dtype=torch.long, device=motion_codes.device)
         if force_mask:
             logits = self.trans_forward(motion_codes, qids, cond_vector, padding_mask, force_mask=True)
-            logits = self.output_project(logits, qids-1)
+            logits = self.output_project_layer(logits, q_id-1)
             return logits
 
-        logits = self.trans_forward(motion_codes, qids, cond_vector, padding_mask)
-        logits = self.output_project(logits, qids-1)
-        if cond_scale == 1:
-            return logits
-
-        aux_logits = self.trans_forward(motion_codes, qids, cond_vector, padding_mask, force_mask=True)
-        aux_logits = self.output_project(aux_logits, qids-1)
+        if not torch.is_tensor(cond_scale) and cond_scale == 1:
+            logits = self.trans_forward(motion_codes, qids, cond_vector, padding_mask)
+            return self.output_project_layer(logits, q_id-1)
+
+        if self.batch_cfg:
+            # Conditional and unconditional (all-zero cond, same as force_mask) halves in one pass
+            both_qids = torch.cat([qids, qids], dim=0)
+            both_logits = self.trans_forward(torch.cat([motion_codes, motion_codes], dim=0), both_qids,
+                                             torch.cat([cond_vector, torch.zeros_like(cond_vector)], dim=0),
+                                             torch.cat([padding_mask, padding_mask], dim=0))
+            both_logits = self.output_project_layer(both_logits, q_id-1)
+            logits, aux_logits = both_logits[:bs], both_logits[bs:]
+        else:
+            logits = self.trans_forward(motion_codes, qids, cond_vector, padding_mask)
+            logits = self.output_project_layer(logits, q_id-1)
+            aux_logits = self.trans_forward(motion_codes, qids, cond_vector, padding_mask, force_mask=True)
+            aux_logits = self.output_project_layer(aux_logits, q_id-1)
 
+        if torch.is_tensor(cond_scale):  # per-sample scales, (b,)
+            cond_scale = per_sample(cond_scale, logits)
         scaled_logits = aux_logits + (logits - aux_logits) * cond_scale
         return scaled_logits
 
@@ -898,7 +943,17 @@ class ResidualTransformer(nn.Module):
                  topk_filter_thres=0.9,
                  cond_scale=2,
                  num_res_layers=-1, # If it's -1, use all.
+                 generators=None,
+                 guidance=None,
+                 step_hook=None,
                  ):
+        '''
+        cond_scale and temperature take either a scalar or a per-sample (b,) tensor.
+        :param generators: optional list of b torch.Generator, one random stream per sample
+        :param guidance: optional GuidanceSchedule, limits guidance to the first residual layers
+        :param step_hook: optional step_hook('res_layer', layer, num_layers) returning a context manager that wraps
+            every residual layer (layer counts from 1), as in MaskTransformer.generate
+        '''
 
         # print(self.opt.num_quantizers)
         # assert len(timesteps) >= len(cond_scales) == self.opt.num_quantizers
@@ -926,42 +981,41 @@ class ResidualTransformer(nn.Module):
         padding_mask = ~lengths_to_mask(m_lens, seq_len)
         # print(padding_mask.shape, motion_ids.shape)
         motion_ids = torch.where(padding_mask, self.pad_id, motion_ids)
-        all_indices = [motion_ids]
-        history_sum = 0
         num_quant_layers = self.opt.num_quantizers if num_res_layers==-1 else num_res_layers+1
+        # Buffers reused across layers: the indices of every layer and the running sum of code embeddings
+        all_indices = torch.empty(batch_size, seq_len, num_quant_layers, dtype=torch.long, device=device)
+        all_indices[..., 0] = motion_ids
+        history_sum = torch.zeros(batch_size, seq_len, self.code_dim, device=device)
 
         for i in range(1, num_quant_layers):
-            # print(f"--> Working on {i}-th quantizer")
-            # Start from all tokens being masked
-            # qids = torch.full((batch_size,), i, dtype=torch.long, device=motion_ids.device)
-            token_embed = self.token_embed_weight[i-1]
-            token_embed = repeat(token_embed, 'c d -> b c d', b=batch_size)
-            gathered_ids = repeat(motion_ids, 'b n -> b n d', d=token_embed.shape[-1])
-            history_sum += token_embed.gather(1, gathered_ids)
+            with step_hook('res_layer', i, num_quant_layers - 1) if step_hook else nullcontext():
+                # print(f"--> Working on {i}-th quantizer")
+                # Start from all tokens being masked
+                # qids = torch.full((batch_size,), i, dtype=torch.long, device=motion_ids.device)
+                history_sum += F.embedding(motion_ids, self.token_embed_weight[i-1])
 
-            logits = self.forward_with_cond_scale(history_sum, i, cond_vector, padding_mask, cond_scale=cond_scale)
-            # logits = self.trans_forward(history_sum, qids, cond_vector, padding_mask)
+                layer_cond_scale = cond_scale if guidance is None else guidance.res_scale(cond_scale, i)
+                logits = self.forward_with_cond_scale(history_sum, i, cond_vector, padding_mask, cond_scale=layer_cond_scale)
+                # logits = self.trans_forward(history_sum, qids, cond_vector, padding_mask)
 
-            logits = logits.permute(0, 2, 1)  # (b, seqlen, ntoken)
-            # clean low prob token
-            filtered_logits = top_k(logits, topk_filter_thres, dim=-1)
+                logits = logits.permute(0, 2, 1)  # (b, seqlen, ntoken)
+                # clean low prob token
+                filtered_logits = top_k(logits, topk_filter_thres, dim=-1)
 
-            pred_ids = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)  # (b, seqlen)
-
-            # probs = F.softmax(filtered_logits, dim=-1)  # (b, seqlen, ntoken)
-            # # print(temperature, starting_temperature, steps_until_x0, timesteps)
-            # # print(probs / temperature)
-            # pred_ids = Categorical(probs / temperature).sample()  # (b, seqlen)
+                pred_ids = gumbel_sample(filtered_logits, temperature=temperature, dim=-1, generators=generators,
+                                         lengths=m_lens)  # (b, seqlen)
 
-            ids = torch.where(padding_mask, self.pad_id, pred_ids)
+                # probs = F.softmax(filtered_logits, dim=-1)  # (b, seqlen, ntoken)
+                # # print(temperature, starting_temperature, steps_until_x0, timesteps)
+                # # print(probs / temperature)
+                # pred_ids = Categorical(probs / temperature).sample()  # (b, seqlen)
 
-            motion_ids = ids
-            all_indices.append(ids)
+                all_indices[..., i] = torch.where(padding_mask, self.pad_id, pred_ids)
+                motion_ids = all_indices[..., i]
 
-        all_indices = torch.stack(all_indices, dim=-1)
         # padding_mask = repeat(padding_mask, 'b n -> b n q', q=all_indices.shape[-1])
         # all_indices = torch.where(padding_mask, -1, all_indices)
-        all_indices = torch.where(all_indices==self.pad_id, -1, all_indices)
+        all_indices.masked_fill_(all_indices==self.pad_id, -1)
         # all_indices = all_indices.masked_fill()
         return all_indices
 
@@ -973,7 +1027,8 @@ class ResidualTransformer(nn.Module):
             m_lens,
             temperature=1,
             topk_filter_thres=0.9,
-            cond_scale=2
+            cond_scale=2,
+            guidance=None,
             ):
 
         # print(self.opt.num_quantizers)
@@ -1014,7 +1069,8 @@ class ResidualTransformer(nn.Module):
             gathered_ids = repeat(motion_ids, 'b n -> b n d', d=token_embed.shape[-1])
             history_sum += token_embed.gather(1, gathered_ids)
 
-            logits = self.forward_with_cond_scale(history_sum, i, cond_vector, padding_mask, cond_scale=cond_scale)
+            layer_cond_scale = cond_scale if guidance is None else guidance.res_scale(cond_scale, i)
+            logits = self.forward_with_cond_scale(history_sum, i, cond_vector, padding_mask, cond_scale=layer_cond_scale)
             # logits = self.trans_forward(history_sum, qids, cond_vector, padding_mask)
 
             logits = logits.permute(0, 2, 1)  # (b, seqlen, ntoken)
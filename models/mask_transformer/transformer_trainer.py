@@ -14,6 +14,16 @@ from einops import rearrange, repeat
 def def_value():
     return 0.0
 
+
+def batch_token_counts(batch_data):
+    '''
+    :return: (tokens of the motions, token slots the transformer runs over including padding) of a batch
+    '''
+    motion, m_lens = batch_data[1], batch_data[2]
+    # Motions are encoded to one token per 4 frames, batches of the token cache already hold tokens
+    slots = motion.shape[1] // 4 if motion.is_floating_point() else motion.shape[1]
+    return int((m_lens // 4).sum()), motion.shape[0] * slots
+
 class MaskTransformerTrainer:
     def __init__(self, args, t2m_transformer, vq_model):
         self.opt = args
@@ -37,14 +47,20 @@ class MaskTransformerTrainer:
 
     def forward(self, batch_data):
 
-        conds, motion, m_lens = batch_data
-        motion = motion.detach().float().to(self.device)
+        conds, motion, m_lens = batch_data[:3]
         m_lens = m_lens.detach().long().to(self.device)
 
         # (b, n, q)
-        code_idx, _ = self.vq_model.encode(motion)
+        if motion.is_floating_point():
+            code_idx, _ = self.vq_model.encode(motion.detach().float().to(self.device))
+        else:
+            # Token ids read from the offline token cache (--token_cache)
+            code_idx = motion.to(self.device).long()
         m_lens = m_lens // 4
 
+        # Datasets built with --text_embeddings also return the precomputed CLIP embedding of each caption
+        if len(batch_data) > 3:
+            conds = batch_data[3]
         conds = conds.to(self.device).float() if torch.is_tensor(conds) else conds
 
         # loss_dict = {}
@@ -128,9 +144,13 @@ class MaskTransformerTrainer:
         while epoch < self.opt.max_epoch:
             self.t2m_transformer.train()
             self.vq_model.eval()
+            num_tokens, num_slots = 0, 0
 
             for i, batch in enumerate(train_loader):
                 it += 1
+                batch_tokens, batch_slots = batch_token_counts(batch)
+                num_tokens += batch_tokens
+                num_slots += batch_slots
                 if it < self.opt.warm_up_iter:
                     self.update_lr_warm_up(it, self.opt.warm_up_iter, self.opt.lr)
 
@@ -155,6 +175,11 @@ class MaskTransformerTrainer:
             self.save(pjoin(self.opt.model_dir, 'latest.tar'), epoch, it)
             epoch += 1
 
+            # Share of the token slots of the epoch that held motion tokens rather than padding
+            print('Token utilization: %.1f%% (%d of %d slots)' % (100. * num_tokens / max(num_slots, 1),
+                                                                 num_tokens, num_slots))
+            self.logger.add_scalar('Train/token_utilization', num_tokens / max(num_slots, 1), epoch)
+
             print('Validation time:')
             self.vq_model.eval()
             self.t2m_transformer.eval()
@@ -209,14 +234,20 @@ class ResidualTransformerTrainer:
 
     def forward(self, batch_data):
 
-        conds, motion, m_lens = batch_data
-        motion = motion.detach().float().to(self.device)
+        conds, motion, m_lens = batch_data[:3]
         m_lens = m_lens.detach().long().to(self.device)
 
-        # (b, n, q), (q, b, n ,d)
-        code_idx, all_codes = self.vq_model.encode(motion)
+        # (b, n, q)
+        if motion.is_floating_point():
+            code_idx, _ = self.vq_model.encode(motion.detach().float().to(self.device))
+        else:
+            # Token ids read from the offline token cache (--token_cache)
+            code_idx = motion.to(self.device).long()
         m_lens = m_lens // 4
 
+        # Datasets built with --text_embeddings also return the precomputed CLIP embedding of each caption
+        if len(batch_data) > 3:
+            conds = batch_data[3]
         conds = conds.to(self.device).float() if torch.is_tensor(conds) else conds
 
         ce_loss, pred_ids, acc = self.res_transformer(code_idx, conds, m_lens)
@@ -297,9 +328,13 @@ class ResidualTransformerTrainer:
         while epoch < self.opt.max_epoch:
             self.res_transformer.train()
             self.vq_model.eval()
+            num_tokens, num_slots = 0, 0
 
             for i, batch in enumerate(train_loader):
                 it += 1
+                batch_tokens, batch_slots = batch_token_counts(batch)
+                num_tokens += batch_tokens
+                num_slots += batch_slots
                 if it < self.opt.warm_up_iter:
                     self.update_lr_warm_up(it, self.opt.warm_up_iter, self.opt.lr)
 
@@ -324,6 +359,11 @@ class ResidualTransformerTrainer:
             epoch += 1
             self.save(pjoin(self.opt.model_dir, 'latest.tar'), epoch, it)
 
+            # Share of the token slots of the epoch that held motion tokens rather than padding
+            print('Token utilization: %.1f%% (%d of %d slots)' % (100. * num_tokens / max(num_slots, 1),
+                                                                 num_tokens, num_slots))
+            self.logger.add_scalar('Train/token_utilization', num_tokens / max(num_slots, 1), epoch)
+
             print('Validation time:')
             self.vq_model.eval()
             self.res_transformer.eval()
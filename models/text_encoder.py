@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from utils.lazy_import import lazy_import
+
+# CLIP is only imported once a text encoder is actually built or used
+clip = lazy_import('clip', 'clip')
+
+
+def normalize_prompt(text):
+    # CLIP's tokenizer lower-cases and collapses whitespace, so these prompts encode identically
+    return ' '.join(text.strip().lower().split())
+
+
+class TextEmbeddingCache:
+    '''
+    LRU cache of CLIP text embeddings keyed by normalized prompt text. Embeddings are kept on cpu.
+    '''
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, embedding):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def save(self, path):
+        with self._lock:
+            keys = list(self._entries.keys())
+            embeddings = torch.stack(list(self._entries.values())) if keys else torch.zeros(0)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save({'keys': keys, 'embeddings': embeddings}, path)
+
+    def load(self, path):
+        state = torch.load(path, map_location='cpu')
+        for key, embedding in zip(state['keys'], state['embeddings']):
+            self.put(key, embedding)
+        print(f'Loaded {len(state["keys"])} cached text embeddings from {path}')
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CLIPTextEncoder:
+    '''
+    Frozen CLIP text encoder with an embedding cache, shared by every model of the process.
+    '''
+    def __init__(self, clip_model, cache_size=4096):
+        self.clip_model = clip_model
+        self.cache = TextEmbeddingCache(cache_size)
+
+    @torch.no_grad()
+    def encode(self, raw_text, device=None, use_cache=True):
+        '''
+        :param raw_text: list of b prompts
+        :param use_cache: False encodes on the CLIP device without touching the cache, as in training, where
+            nearly every caption is new and the cache would only churn and round-trip the embeddings through cpu
+        :return: (b, clip_dim) float embeddings on device
+        '''
+        device = device if device is not None else next(self.clip_model.parameters()).device
+        if not use_cache:
+            clip_device = next(self.clip_model.parameters()).device
+            text = clip.tokenize(list(raw_text), truncate=True).to(clip_device)
+            return self.clip_model.encode_text(text).float().to(device)
+        keys = [normalize_prompt(t) for t in raw_text]
+        found = {}
+        missing = []
+        for text, key in zip(raw_text, keys):
+            if key in found:
+                continue
+            embedding = self.cache.get(key)
+            if embedding is None:
+                missing.append((key, text))
+                found[key] = None
+            else:
+                found[key] = embedding
+
+        if missing:
+            clip_device = next(self.clip_model.parameters()).device
+            text = clip.tokenize([t for _, t in missing], truncate=True).to(clip_device)
+            feat_clip_text = self.clip_model.encode_text(text).float().cpu()
+            for (key, _), embedding in zip(missing, feat_clip_text):
+                found[key] = embedding
+                self.cache.put(key, embedding)
+
+        return torch.stack([found[key] for key in keys]).to(device)
+
+
+_text_encoders = {}
+_text_encoders_lock = threading.Lock()
+
+
+def get_text_encoder(clip_version, convert_fp16=False, cache_size=4096, state_dict=None):
+    '''
+    Load (once per process) the frozen CLIP model of clip_version and wrap it with an embedding cache.
+    :param convert_fp16: convert weights to half precision, as done for gpu inference
+    :param state_dict: optional CLIP weights (e.g. from an inference bundle), built directly instead of
+        loading the downloaded checkpoint of clip_version
+    '''
+    key = (clip_version, convert_fp16)
+    with _text_encoders_lock:
+        if key not in _text_encoders:
+            if state_dict is not None:
+                # build_model converts to half precision itself
+                clip_model = clip.model.build_model(state_dict)
+                if not convert_fp16:
+                    clip_model.float()
+            else:
+                clip_model, clip_preprocess = clip.load(clip_version, device='cpu',
+                                                        jit=False)  # Must set jit=False for training
+                if convert_fp16:
+                    clip.model.convert_weights(clip_model)
+
+            # Freeze CLIP weights
+            clip_model.eval()
+            for p in clip_model.parameters():
+                p.requires_grad = False
+            _text_encoders[key] = CLIPTextEncoder(clip_model, cache_size)
+        return _text_encoders[key]
+
+
+def clip_state_dict(clip_version, fp16=True):
+    '''
+    :return: the weights of clip_version, in half precision by default (as build_model expects them)
+    '''
+    clip_model, _ = clip.load(clip_version, device='cpu', jit=False)
+    if fp16:
+        clip.model.convert_weights(clip_model)
+    return clip_model.state_dict()
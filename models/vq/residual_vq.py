@@ -10,7 +10,7 @@ import torch.nn.functional as F
 # from vector_quantize_pytorch.vector_quantize_pytorch import VectorQuantize
 from models.vq.quantizer import QuantizeEMAReset, QuantizeEMA
 
-from einops import rearrange, repeat, pack, unpack
+from einops import rearrange, pack, unpack
 
 # helper functions
 
@@ -63,7 +63,7 @@ class ResidualVQ(nn.Module):
     
     def get_codes_from_indices(self, indices): #indices shape 'b n q' # dequantize
 
-        batch, quantize_dim = indices.shape[0], indices.shape[-1]
+        quantize_dim = indices.shape[-1]
 
         # because of quantize dropout, one can pass in indices that are coarse
         # and the network should be able to reconstruct
@@ -71,22 +71,25 @@ class ResidualVQ(nn.Module):
         if quantize_dim < self.num_quantizers:
             indices = F.pad(indices, (0, self.num_quantizers - quantize_dim), value = -1)
 
-        # get ready for gathering
+        # look up all layers at once in the flattened (q * c, d) codebook stack, offsetting each layer's
+        # indices by its position in the stack. Unlike expanding the codebooks per batch element for gather,
+        # this never materializes more than the codebooks themselves
 
-        codebooks = repeat(self.codebooks, 'q c d -> q b c d', b = batch)
-        gather_indices = repeat(indices, 'b n q -> q b n d', d = codebooks.shape[-1])
+        codebooks = self.codebooks
+        num_quant, num_codes = codebooks.shape[:2]
 
         # take care of quantizer dropout
 
-        mask = gather_indices == -1.
-        gather_indices = gather_indices.masked_fill(mask, 0) # have it fetch a dummy code to be masked out later
+        mask = indices == -1
+        offsets = torch.arange(num_quant, device=indices.device) * num_codes
+        flat_indices = indices.masked_fill(mask, 0) + offsets # have it fetch a dummy code to be masked out later
 
-        # print(gather_indices.max(), gather_indices.min())
-        all_codes = codebooks.gather(2, gather_indices) # gather all codes
+        all_codes = F.embedding(flat_indices, codebooks.reshape(num_quant * num_codes, -1)) # 'b n q d'
 
         # mask out any codes that were dropout-ed
 
-        all_codes = all_codes.masked_fill(mask, 0.)
+        all_codes = all_codes.masked_fill(mask.unsqueeze(-1), 0.)
+        all_codes = rearrange(all_codes, 'b n q d -> q b n d')
 
         return all_codes # 'q b n d'
 
@@ -256,9 +256,16 @@ class LengthEstTrainer(object):
         for opt in opt_list:
             opt.step()
 
+    def encode_batch(self, batch_data):
+        # Datasets built with --text_embeddings also return the precomputed CLIP embedding of each caption
+        if len(batch_data) > 3:
+            return batch_data[3].to(self.device).float()
+        return self.encode_fnc(self.text_encoder, batch_data[0], self.opt.device)
+
     def train(self, train_dataloader, val_dataloader):
         self.estimator.to(self.device)
-        self.text_encoder.to(self.device)
+        if self.text_encoder is not None:
+            self.text_encoder.to(self.device)
 
         self.opt_estimator = optim.Adam(self.estimator.parameters(), lr=self.opt.lr)
 
@@ -280,11 +287,11 @@ class LengthEstTrainer(object):
             for i, batch_data in enumerate(train_dataloader):
                 self.estimator.train()
 
-                conds, _, m_lens = batch_data
+                _, _, m_lens = batch_data[:3]
                 # word_emb = word_emb.detach().to(self.device).float()
                 # pos_ohot = pos_ohot.detach().to(self.device).float()
                 # m_lens = m_lens.to(self.device).long()
-                text_embs = self.encode_fnc(self.text_encoder, conds, self.opt.device).detach()
+                text_embs = self.encode_batch(batch_data).detach()
                 # print(text_embs.shape, text_embs.device)
 
                 pred_dis = self.estimator(text_embs)
@@ -334,11 +341,11 @@ class LengthEstTrainer(object):
                 for i, batch_data in enumerate(val_dataloader):
                     self.estimator.eval()
 
-                    conds, _, m_lens = batch_data
+                    _, _, m_lens = batch_data[:3]
                     # word_emb = word_emb.detach().to(self.device).float()
                     # pos_ohot = pos_ohot.detach().to(self.device).float()
                     # m_lens = m_lens.to(self.device).long()
-                    text_embs = self.encode_fnc(self.text_encoder, conds, self.opt.device)
+                    text_embs = self.encode_batch(batch_data)
                     pred_dis = self.estimator(text_embs)
 
                     gt_labels = m_lens // self.opt.unit_length
@@ -5,8 +5,11 @@ from os.path import join as pjoin
 from torch.utils.data import DataLoader
 from utils.get_opt import get_opt
 
-def get_dataset_motion_loader(opt_path, batch_size, fname, device):
-    opt = get_opt(opt_path, device)
+def get_dataset_motion_loader(opt_path, batch_size, fname, device, packed_data=''):
+    '''
+    :param packed_data: motion pack of prepare_motion_pack.py to read the dataset from, '' for the .npy / .txt files
+    '''
+    opt = get_opt(opt_path, device, packed_data=packed_data)
 
     # Configurations of T2M dataset and KIT dataset is almost the same
     if opt.dataset_name == 't2m' or opt.dataset_name == 'kit':
@@ -1,6 +1,5 @@
 import argparse
 import os
-import torch
 
 class BaseOptions():
     def __init__(self):
@@ -38,6 +37,8 @@ class BaseOptions():
         self.opt.is_train = self.is_train
 
         if self.opt.gpu_id != -1:
+            # Imported here, so that option parsing (and --help) does not load torch
+            import torch
             # self.opt.gpu_id = int(self.opt.gpu_id)
             torch.cuda.set_device(self.opt.gpu_id)
 
@@ -35,4 +35,68 @@ class EvalT2MOptions(BaseOptions):
         self.parser.add_argument('--source_motion', default='example_data/000612.npy', type=str, help="Source motion path for editing. (new_joint_vecs format .npy file)")
         self.parser.add_argument("--motion_length", default=0, type=int,
                                  help="Motion length for generation, only applicable with single text prompt.")
+        self.parser.add_argument("--bundle", type=str, default='',
+                                 help="Inference bundle written by export_bundle.py. Models, text encoder, mean / std and options are loaded from it instead of the checkpoints directory.")
+        self.parser.add_argument("--joints_only", action="store_true",
+                                 help="Only save joint positions (.npy), skip BVH conversion and animation rendering.")
+        self.parser.add_argument("--artifacts", nargs='+', default=['joints', 'joints_ik', 'bvh', 'bvh_ik', 'mp4', 'mp4_ik'],
+                                 choices=['record', 'joints', 'joints_raw', 'joints_ik', 'bvh', 'bvh_ik', 'mp4', 'mp4_ik', 'gif'],
+                                 help="Files gen_t2m.py derives for every sample ('_ik': with foot IK, 'record': the features to derive the others later). Only these are computed.")
+        self.parser.add_argument("--startup_report", action="store_true",
+                                 help="Print the import cost of each subsystem (torch, models, CLIP, visualization, plotting, ...).")
+        self.parser.add_argument("--model_cache_mb", default=4096, type=int,
+                                 help="Memory cap (MB) of the warm model registry, least recently used models are evicted first. 0 for no cap.")
+        self.parser.add_argument("--num_workers", default=0, type=int,
+                                 help="Web app on CPU: serve requests from this many forked worker processes sharing one copy of the weights. 0 to generate in the app process.")
+        self.parser.add_argument("--worker_threads", default=0, type=int,
+                                 help="torch threads of each worker (--num_workers), 0 for the number of cores per worker.")
+        self.parser.add_argument("--pin_workers", action="store_true",
+                                 help="Pin every worker (--num_workers) to its own set of CPU cores.")
+        self.parser.add_argument("--post_workers", default=2, type=int,
+                                 help="Web app: processes for the IK / rendering of finished jobs, separate from generation.")
+        self.parser.add_argument("--batch_repeats", action="store_true",
+                                 help="Generate all repeat_times samples of a prompt in one batched generate call, each with its own (prompt, repeat) seed.")
+        self.parser.add_argument("--batch_window_ms", default=0, type=float,
+                                 help="Time window (ms) for collecting concurrent requests into one batched generation. 0 disables batching.")
+        self.parser.add_argument("--continuous_batching", action="store_true",
+                                 help="Serve concurrent requests with iteration-level batching: requests join and leave the running mask decoding batch at every step.")
+        self.parser.add_argument("--max_batch_size", default=16, type=int,
+                                 help="Maximum number of concurrent requests (or prompt-file micro-batch prompts) batched together.")
+        self.parser.add_argument("--token_budget", default=0, type=int,
+                                 help="Prompt-file generation: run length-bucketed micro-batches of at most this many padded motion tokens. 0 runs all prompts in one batch.")
+        self.parser.add_argument("--batch_cfg", action="store_true",
+                                 help="Run classifier-free guidance as one forward pass over a doubled (cond, uncond) batch.")
+        self.parser.add_argument("--text_cache_size", default=4096, type=int,
+                                 help="Number of CLIP text embeddings kept in the in-memory LRU cache. 0 disables caching.")
+        self.parser.add_argument("--text_cache_path", type=str, default='',
+                                 help="Optional file the text embedding cache is loaded from at startup and saved to after generation.")
+        self.parser.add_argument("--cfg_curve", type=str, default='constant',
+                                 help="Guidance scale over the mask decoding steps: constant, linear, cosine, or comma separated per-step scales.")
+        self.parser.add_argument("--cfg_stop_step", default=-1, type=int,
+                                 help="Turn classifier-free guidance off from this mask decoding step on. -1 keeps it on.")
+        self.parser.add_argument("--res_cfg_layers", default=-1, type=int,
+                                 help="Only use classifier-free guidance on the first n residual layers. -1 for all.")
+        self.parser.add_argument("--latency_budget_ms", default=0, type=float,
+                                 help="Per-request latency budget (ms): pick the highest-quality time_steps / guidance / residual layers whose predicted latency fits, reject the request if none does. 0 disables planning.")
+        self.parser.add_argument("--cost_model_path", type=str, default='',
+                                 help="JSON file of the measured stage cost model used by --latency_budget_ms. Calibrated on this machine and saved there if it does not exist.")
+        self.parser.add_argument("--profile", action="store_true",
+                                 help="Instrument generate_motion: nested stage timers, peak RSS and token / frame counters, exported as JSON and Prometheus metrics.")
+        self.parser.add_argument("--profile_dir", type=str, default='',
+                                 help="With --profile, also write every request's profile as a JSON file into this directory.")
+        self.parser.add_argument("--cfg_compare", action="store_true",
+                                 help="In evaluation, also run without the guidance schedule and report its FID / R-precision cost and time saved.")
         self.is_train = False
+
+
+class BulkGenT2MOptions(EvalT2MOptions):
+    def initialize(self):
+        EvalT2MOptions.initialize(self)
+        self.parser.add_argument('--prompt_jsonl', type=str, required=True,
+                                 help='JSONL file, one {"text": ..., "length": frames, "seed": int} per line. length and seed are optional.')
+        self.parser.add_argument('--out_dir', type=str, default='',
+                                 help='Output directory of shards, index and checkpoint. Defaults to ./generation/<ext>.')
+        self.parser.add_argument('--shard_size', type=int, default=1000, help='Number of prompts per shard file.')
+        self.parser.add_argument('--export_bvh', action="store_true", help='Also run the BVH export stage over finished shards.')
+        self.parser.add_argument('--export_animation', action="store_true", help='Also run the mp4 animation export stage over finished shards.')
+        self.parser.add_argument('--skip_generation', action="store_true", help='Only run the export stages over already generated shards.')
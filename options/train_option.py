@@ -27,6 +27,16 @@ class TrainT2MOptions(BaseOptions):
         # self.parser.add_argument('--save_every_e', type=int, default=100, help='Frequency of printing training progress')
         self.parser.add_argument('--eval_every_e', type=int, default=10, help='Frequency of animating eval results, (epoch)')
         self.parser.add_argument('--save_latest', type=int, default=500, help='Frequency of saving checkpoint, (iteration)')
+        self.parser.add_argument('--text_embeddings', type=str, default='',
+                                 help='Caption embedding store of prepare_text_embeddings.py; training then reads the CLIP embeddings from it instead of encoding every batch')
+        self.parser.add_argument('--token_cache', type=str, default='',
+                                 help='RVQ token cache of prepare_token_cache.py; training then reads token ids from it instead of running the VQ encoder on every batch (unless it is stale)')
+        self.parser.add_argument('--packed_data', type=str, default='',
+                                 help='Motion pack of prepare_motion_pack.py; datasets then read motions and captions from it instead of the .npy / .txt files')
+        self.parser.add_argument('--bucket_batches', action="store_true",
+                                 help='Batch motions of similar length and pad each batch to its longest motion instead of max_motion_length')
+        self.parser.add_argument('--bucket_size', type=int, default=50,
+                                 help='Batches per pool sorted by length for --bucket_batches; larger pools give tighter lengths but less random batches')
 
 
         self.is_train = True
@@ -64,6 +64,10 @@ def arg_parse(is_train=False):
     # parser.add_argument('--n_res', type=int, default=2, help='Name of this trial')
     # parser.add_argument('--do_vq_res', action="store_true")
     parser.add_argument("--seed", default=3407, type=int)
+    parser.add_argument('--packed_data', type=str, default='',
+                        help='Motion pack of prepare_motion_pack.py; datasets then read motions from it instead of the .npy files')
+    parser.add_argument('--batch_windows', action="store_true",
+                        help='Gather every training batch with one vectorized index from a pre-normalized buffer instead of collating single windows')
 
     opt = parser.parse_args()
     torch.cuda.set_device(opt.gpu_id)
@@ -0,0 +1,35 @@
+import argparse
+import time
+from os.path import join as pjoin
+
+from data.motion_pack import pack_motions, MotionPack
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--dataset_name', type=str, default='t2m', help='Dataset Name, {t2m} for humanml3d, {kit} for kit-ml')
+    parser.add_argument('--packed_data', type=str, default='', help='Output directory, ./dataset/<dataset>/packed if empty')
+    opt = parser.parse_args()
+
+    if opt.dataset_name == 't2m':
+        data_root = './dataset/HumanML3D'
+    elif opt.dataset_name == 'kit':
+        data_root = './dataset/KIT-ML'
+    else:
+        raise KeyError('Dataset Does Not Exist')
+    motion_dir = pjoin(data_root, 'new_joint_vecs')
+    text_dir = pjoin(data_root, 'texts')
+    out_dir = opt.packed_data or pjoin(data_root, 'packed')
+
+    # Every motion of the dataset, the split files select from the pack when it is read
+    start = time.perf_counter()
+    num_motions = pack_motions(motion_dir, text_dir, out_dir)
+    print('Packed %d motions of %s into %s in %.1f s' % (num_motions, motion_dir, out_dir,
+                                                         time.perf_counter() - start))
+
+    start = time.perf_counter()
+    pack = MotionPack(out_dir)
+    print('Pack has %d motions, %d frames (%.1f MB), opened in %.1f ms' % (
+        len(pack), len(pack.frames), pack.frames.nbytes / 1024 ** 2, (time.perf_counter() - start) * 1000))
+
+# python prepare_motion_pack.py --dataset_name t2m
+# python train_t2m_transformer.py ... --packed_data ./dataset/HumanML3D/packed
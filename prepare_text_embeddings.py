@@ -0,0 +1,37 @@
+import time
+from os.path import join as pjoin
+
+import torch
+
+from data.text_embeddings import build_caption_embeddings, CaptionEmbeddingStore
+from models.text_encoder import get_text_encoder
+from options.train_option import TrainT2MOptions
+
+if __name__ == '__main__':
+    parser = TrainT2MOptions()
+    opt = parser.parse()
+    opt.device = torch.device("cpu" if opt.gpu_id == -1 else "cuda:" + str(opt.gpu_id))
+
+    if opt.dataset_name == 't2m':
+        opt.data_root = './dataset/HumanML3D'
+    elif opt.dataset_name == 'kit':
+        opt.data_root = './dataset/KIT-ML'
+    else:
+        raise KeyError('Dataset Does Not Exist')
+    opt.text_dir = pjoin(opt.data_root, 'texts')
+    out_dir = opt.text_embeddings or pjoin(opt.data_root, 'text_embeddings')
+
+    clip_version = 'ViT-B/32'
+    # Same encoder as training: fp16 CLIP on gpu, fp32 on cpu, embeddings returned as float
+    text_encoder = get_text_encoder(clip_version, convert_fp16=opt.device.type != 'cpu', cache_size=0)
+    text_encoder.clip_model.to(opt.device)
+
+    start = time.perf_counter()
+    num_captions = build_caption_embeddings(opt.text_dir, out_dir, text_encoder, clip_version,
+                                            batch_size=opt.batch_size)
+    print('Encoded %d captions of %s into %s in %.1f s' % (num_captions, opt.text_dir, out_dir,
+                                                            time.perf_counter() - start))
+    print('Store has %d captions' % len(CaptionEmbeddingStore(out_dir)))
+
+# python prepare_text_embeddings.py --dataset_name t2m --gpu_id 0 --batch_size 256
+# python train_t2m_transformer.py ... --text_embeddings ./dataset/HumanML3D/text_embeddings
@@ -0,0 +1,47 @@
+import time
+from os.path import join as pjoin
+
+import numpy as np
+import torch
+
+from data.t2m_dataset import Text2MotionDataset
+from data.token_cache import build_token_cache, token_cache_meta, RVQTokenCache
+from gen_t2m import load_vq_model
+from options.train_option import TrainT2MOptions
+from utils.get_opt import get_opt
+
+if __name__ == '__main__':
+    parser = TrainT2MOptions()
+    opt = parser.parse()
+    opt.device = torch.device("cpu" if opt.gpu_id == -1 else "cuda:" + str(opt.gpu_id))
+
+    if opt.dataset_name == 't2m':
+        opt.data_root = './dataset/HumanML3D'
+        dim_pose = 263
+    elif opt.dataset_name == 'kit':
+        opt.data_root = './dataset/KIT-ML'
+        dim_pose = 251
+    else:
+        raise KeyError('Dataset Does Not Exist')
+    opt.motion_dir = pjoin(opt.data_root, 'new_joint_vecs')
+    opt.text_dir = pjoin(opt.data_root, 'texts')
+    out_dir = opt.token_cache or pjoin(opt.checkpoints_dir, opt.dataset_name, opt.vq_name, 'token_cache')
+
+    # Same VQ checkpoint and normalization as train_t2m_transformer.py / train_res_transformer.py
+    vq_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.vq_name, 'opt.txt'), opt.device)
+    vq_opt.dim_pose = dim_pose
+    vq_model, vq_opt = load_vq_model(vq_opt)
+    mean = np.load(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.vq_name, 'meta', 'mean.npy'))
+    std = np.load(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.vq_name, 'meta', 'std.npy'))
+
+    datasets = [Text2MotionDataset(opt, mean, std, pjoin(opt.data_root, split + '.txt')) for split in ('train', 'val')]
+
+    start = time.perf_counter()
+    meta = token_cache_meta(vq_model, mean, std, opt)
+    num_crops = build_token_cache(datasets, vq_model, out_dir, meta, opt.device, batch_size=opt.batch_size)
+    cache = RVQTokenCache(out_dir)
+    print('Encoded %d crops of %d motions into %s (%.1f MB) in %.1f s' % (
+        num_crops, len(cache.crops), out_dir, cache.tokens_array.nbytes / 1024 ** 2, time.perf_counter() - start))
+
+# python prepare_token_cache.py --dataset_name t2m --vq_name rvq_name --gpu_id 0 --batch_size 256
+# python train_t2m_transformer.py ... --vq_name rvq_name --token_cache ./checkpoints/t2m/rvq_name/token_cache
@@ -0,0 +1,148 @@
+import contextvars
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from serving.instrumentation import BatchStepHook
+
+
+class GenerationRequest:
+    def __init__(self, caption, m_length, cond_scale, temperature, topkr, seed):
+        self.caption = caption
+        self.m_length = m_length
+        self.cond_scale = cond_scale
+        self.temperature = temperature
+        self.topkr = topkr
+        self.seed = seed
+        self.future = Future()
+        # The submitter's progress reporter and request profile, for the scheduler thread to report into
+        self.context = contextvars.copy_context()
+
+
+def _batch_param(values, device):
+    # Uniform values stay a python scalar, so the model takes exactly the single-request path
+    if all(v == values[0] for v in values):
+        return values[0]
+    return torch.tensor(values, dtype=torch.float, device=device)
+
+
+class BatchingScheduler:
+    '''
+    Collects concurrent generation requests for up to max_wait_ms (or until max_batch_size of them
+    are waiting) and runs them through one batched MaskTransformer.generate / ResidualTransformer.generate /
+    RVQVAE.forward_decoder call. All model calls happen on the scheduler's own worker thread, so the
+    models are never used from two threads at once.
+    '''
+    def __init__(self, t2m_transformer, res_model, vq_model, max_batch_size=16, max_wait_ms=10.,
+                 time_steps=18, gsample=False, res_cond_scale=5, unit_length=4, guidance=None):
+        self.t2m_transformer = t2m_transformer
+        self.res_model = res_model
+        self.vq_model = vq_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.time_steps = time_steps
+        self.gsample = gsample
+        self.res_cond_scale = res_cond_scale
+        self.unit_length = unit_length
+        self.guidance = guidance
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._loop, name='batching-scheduler', daemon=True)
+        self._worker.start()
+
+    def submit(self, caption, m_length, cond_scale=4, temperature=1., topkr=0.9, seed=None):
+        '''
+        :param caption: text prompt
+        :param m_length: motion length in frames
+        :param seed: seed of this request's own random stream, None for a random one
+        :return: Future resolving to the normalized motion features, (m_length, dim_pose) ndarray
+        '''
+        if self._closed:
+            raise RuntimeError('BatchingScheduler is closed')
+        request = GenerationRequest(caption, int(m_length), cond_scale, temperature, topkr, seed)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                results = self._run_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    @torch.no_grad()
+    def _run_batch(self, batch):
+        device = next(self.t2m_transformer.parameters()).device
+        captions = [r.caption for r in batch]
+        token_lens = torch.LongTensor([r.m_length // self.unit_length for r in batch]).to(device)
+
+        cond_scale = _batch_param([r.cond_scale for r in batch], device)
+        temperature = _batch_param([r.temperature for r in batch], device)
+        topkr = _batch_param([r.topkr for r in batch], device)
+
+        generators = None
+        if any(r.seed is not None for r in batch):
+            generators = []
+            for r in batch:
+                g = torch.Generator(device=device)
+                g.manual_seed(r.seed if r.seed is not None else random.randrange(2 ** 63))
+                generators.append(g)
+
+        # One CLIP pass (cache misses only) for the whole batch, shared by both transformers
+        cond_vector = self.t2m_transformer.encode_text(captions)
+        step_hook = BatchStepHook([r.context for r in batch], device)
+        mids = self.t2m_transformer.generate(cond_vector, token_lens,
+                                             timesteps=self.time_steps,
+                                             cond_scale=cond_scale,
+                                             temperature=temperature,
+                                             topk_filter_thres=topkr,
+                                             gsample=self.gsample,
+                                             generators=generators,
+                                             guidance=self.guidance,
+                                             step_hook=step_hook)
+        mids = self.res_model.generate(mids, cond_vector, token_lens, temperature=1, cond_scale=self.res_cond_scale,
+                                       generators=generators, guidance=self.guidance, step_hook=step_hook)
+        pred_motions = self.vq_model.forward_decoder(mids).detach().cpu().numpy()
+
+        m_lengths = token_lens * self.unit_length
+        return [pred_motions[i, :m_lengths[i]] for i in range(len(batch))]
@@ -0,0 +1,119 @@
+'''
+Inference bundle: every weight, array and resolved option a generation worker needs, in one file.
+
+    magic (8 bytes) | format version (uint32) | header length (uint64) | JSON header | tensor data
+
+The header lists the sections (one per model) with their options and, for every tensor, its dtype, shape and
+byte offset into the data region. Tensors start on ALIGNMENT byte boundaries, so the loader can memory-map
+the file and hand out zero-copy views; a section's tensors are only touched when that model is built.
+'''
+import json
+import os
+import struct
+import time
+from argparse import Namespace
+
+import numpy as np
+import torch
+
+BUNDLE_MAGIC = b'MOMASKB\x00'
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sIQ')
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def options_to_dict(opt):
+    # Resolved options are plain str / number / bool values, the device is chosen again at load time
+    return {k: v for k, v in vars(opt).items()
+            if k != 'device' and (v is None or isinstance(v, (str, int, float, bool, list, tuple)))}
+
+
+def write_bundle(path, sections, arrays=None, meta=None):
+    '''
+    :param sections: name -> {'options': dict or None, 'state_dict': name -> tensor}
+    :param arrays: name -> ndarray (e.g. mean / std)
+    :param meta: extra JSON-serializable header entries
+    '''
+    entries = []  # (ndarray, record)
+    offset = 0
+
+    def _add(array):
+        nonlocal offset
+        # np.ascontiguousarray would turn 0-d tensors (e.g. num_batches_tracked) into 1-d arrays
+        array = np.require(array, requirements='C')
+        record = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset, 'nbytes': array.nbytes}
+        entries.append((array, record))
+        offset = _align(offset + array.nbytes)
+        return record
+
+    header = {'version': BUNDLE_VERSION, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'meta': meta or {},
+              'sections': {}, 'arrays': {}}
+    for name, section in sections.items():
+        tensors = {k: _add(v.detach().cpu().numpy()) for k, v in section['state_dict'].items()}
+        header['sections'][name] = {'options': section.get('options'), 'tensors': tensors}
+    for name, array in (arrays or {}).items():
+        header['arrays'][name] = _add(np.asarray(array))
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header_bytes))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for array, record in entries:
+            f.seek(data_start + record['offset'])
+            array.tofile(f)
+        f.truncate(data_start + offset)
+    # Write-then-rename, so a running worker never maps a half-written bundle
+    os.replace(tmp_path, path)
+    return data_start + offset
+
+
+class InferenceBundle:
+    '''
+    Read-only view of a bundle file. Opening only parses the header; tensors are views into a
+    copy-on-write memory map of the file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != BUNDLE_MAGIC:
+                raise ValueError(f'{path} is not an inference bundle')
+            if version > BUNDLE_VERSION:
+                raise ValueError(f'{path} has bundle format version {version}, this loader reads up to {BUNDLE_VERSION}')
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self._data_start = _align(_PREFIX.size + header_len)
+        self._mmap = np.memmap(path, dtype=np.uint8, mode='c')
+
+    @property
+    def meta(self):
+        return self.header['meta']
+
+    def sections(self):
+        return list(self.header['sections'])
+
+    def _view(self, record):
+        start = self._data_start + record['offset']
+        array = self._mmap[start:start + record['nbytes']].view(np.dtype(record['dtype']))
+        return array.reshape(record['shape'])
+
+    def options(self, name, **kwargs):
+        '''
+        :return: Namespace of the section's resolved options, updated with kwargs (e.g. device)
+        '''
+        opt = Namespace(**self.header['sections'][name]['options'])
+        for k, v in kwargs.items():
+            setattr(opt, k, v)
+        return opt
+
+    def state_dict(self, name):
+        return {k: torch.from_numpy(self._view(record))
+                for k, record in self.header['sections'][name]['tensors'].items()}
+
+    def array(self, name):
+        return np.array(self._view(self.header['arrays'][name]))
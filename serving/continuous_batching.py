@@ -0,0 +1,231 @@
+import queue
+import random
+import threading
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from models.mask_transformer.tools import lengths_to_mask
+from serving.batching import GenerationRequest, _batch_param
+from serving.instrumentation import BatchStepHook
+
+
+class _DecodeSlot:
+    '''
+    One request in the running decode batch: its unpadded tokens and scores, and how many
+    mask-decoding steps it has done so far.
+    '''
+    def __init__(self, request, token_len, cond_vector, mask_id, generator):
+        self.request = request
+        self.token_len = token_len
+        self.cond_vector = cond_vector
+        self.ids = torch.full((token_len,), mask_id, dtype=torch.long, device=cond_vector.device)
+        self.scores = torch.zeros(token_len, device=cond_vector.device)
+        self.step = 0
+        self.generator = generator
+
+
+def _slot_generators(slots, device):
+    # Unseeded slots only get a random stream once they share a step with a seeded one
+    if all(s.generator is None for s in slots):
+        return None
+    for s in slots:
+        if s.generator is None:
+            s.generator = torch.Generator(device=device)
+            s.generator.manual_seed(random.randrange(2 ** 63))
+    return [s.generator for s in slots]
+
+
+class ContinuousBatchingScheduler:
+    '''
+    Iteration-level batching of the mask-decoding loop. The decode thread keeps a running batch of up
+    to max_batch_size requests and advances all of them by one MaskTransformer.masked_decode_step per
+    iteration; every request carries its own step counter, so new requests join at the next step boundary
+    and finished ones leave right away. Finished requests are handed to a second thread that runs
+    ResidualTransformer.generate / RVQVAE.forward_decoder over whatever has finished in the meantime.
+    The mask transformer is only used by the decode thread, the residual transformer and the decoder
+    only by the finishing thread. Same submit / generate / close interface as BatchingScheduler.
+    '''
+    def __init__(self, t2m_transformer, res_model, vq_model, max_batch_size=16,
+                 time_steps=18, gsample=False, res_cond_scale=5, unit_length=4, guidance=None):
+        self.t2m_transformer = t2m_transformer
+        self.res_model = res_model
+        self.vq_model = vq_model
+        self.max_batch_size = max_batch_size
+        self.time_steps = time_steps
+        self.gsample = gsample
+        self.res_cond_scale = res_cond_scale
+        self.unit_length = unit_length
+        self.guidance = guidance
+        self.device = next(t2m_transformer.parameters()).device
+
+        self._queue = queue.Queue()
+        self._finished = queue.Queue()
+        self._closed = False
+        self._decode_worker = threading.Thread(target=self._decode_loop, name='continuous-decode', daemon=True)
+        self._finish_worker = threading.Thread(target=self._finish_loop, name='continuous-finish', daemon=True)
+        self._decode_worker.start()
+        self._finish_worker.start()
+
+    def submit(self, caption, m_length, cond_scale=4, temperature=1., topkr=0.9, seed=None):
+        '''
+        :param caption: text prompt
+        :param m_length: motion length in frames
+        :param seed: seed of this request's own random stream, None for a random one
+        :return: Future resolving to the normalized motion features, (m_length, dim_pose) ndarray
+        '''
+        if self._closed:
+            raise RuntimeError('ContinuousBatchingScheduler is closed')
+        request = GenerationRequest(caption, int(m_length), cond_scale, temperature, topkr, seed)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
+
+    def close(self):
+        '''
+        Stop accepting requests, finish the running and queued ones, then stop both threads.
+        '''
+        self._closed = True
+        self._queue.put(None)
+        self._decode_worker.join()
+        self._finish_worker.join()
+
+    def _admit(self, num_running, block):
+        '''
+        Take queued requests up to the free batch slots, waiting for one only when nothing is running.
+        :return: (requests, closing)
+        '''
+        requests = []
+        while num_running + len(requests) < self.max_batch_size:
+            try:
+                request = self._queue.get(block=block and not requests and num_running == 0)
+            except queue.Empty:
+                break
+            if request is None:
+                return requests, True
+            requests.append(request)
+        return requests, False
+
+    @torch.no_grad()
+    def _new_slots(self, requests):
+        # One CLIP pass (cache misses only) for everything joining at this step boundary
+        cond_vector = self.t2m_transformer.encode_text([r.caption for r in requests])
+        slots = []
+        for r, cond in zip(requests, cond_vector):
+            generator = None
+            if r.seed is not None:
+                generator = torch.Generator(device=self.device)
+                generator.manual_seed(r.seed)
+            slots.append(_DecodeSlot(r, r.m_length // self.unit_length, cond, self.t2m_transformer.mask_id,
+                                     generator))
+        return slots
+
+    def _decode_loop(self):
+        self.t2m_transformer.eval()
+        running = []
+        closing = False
+        while True:
+            if not closing:
+                requests, closing = self._admit(len(running), block=True)
+                if requests:
+                    try:
+                        running += self._new_slots(requests)
+                    except Exception as e:
+                        for request in requests:
+                            request.future.set_exception(e)
+            if not running:
+                if closing:
+                    self._finished.put(None)
+                    return
+                continue
+
+            try:
+                self._step(running)
+            except Exception as e:
+                for slot in running:
+                    slot.request.future.set_exception(e)
+                running = []
+                continue
+
+            done = [s for s in running if s.step >= self.time_steps]
+            if done:
+                running = [s for s in running if s.step < self.time_steps]
+                self._finished.put(done)
+
+    @torch.no_grad()
+    def _step(self, slots):
+        '''
+        Advance every running request by one mask-decoding step, each at its own schedule position.
+        '''
+        device = self.device
+        m_lens = torch.LongTensor([s.token_len for s in slots]).to(device)
+        padding_mask = ~lengths_to_mask(m_lens, int(m_lens.max()))
+        ids = pad_sequence([s.ids for s in slots], batch_first=True, padding_value=self.t2m_transformer.pad_id)
+        scores = pad_sequence([s.scores for s in slots], batch_first=True, padding_value=1e5)
+        cond_vector = torch.stack([s.cond_vector for s in slots], dim=0)
+
+        steps = torch.LongTensor([s.step for s in slots]).to(device)
+        timestep = torch.linspace(0, 1, self.time_steps, device=device)[steps]
+        cond_scale = [s.request.cond_scale for s in slots]
+        if self.guidance is not None:
+            cond_scale = [self.guidance.step_scale(c, s.step, self.time_steps) for c, s in zip(cond_scale, slots)]
+
+        step_hook = BatchStepHook([s.request.context for s in slots], device)
+        with step_hook('mask_step', [s.step + 1 for s in slots], self.time_steps):
+            ids, scores = self.t2m_transformer.masked_decode_step(
+                ids, scores, cond_vector, padding_mask, m_lens, timestep,
+                cond_scale=_batch_param(cond_scale, device),
+                temperature=_batch_param([s.request.temperature for s in slots], device),
+                topk_filter_thres=_batch_param([s.request.topkr for s in slots], device),
+                gsample=self.gsample,
+                generators=_slot_generators(slots, device))
+
+        for i, s in enumerate(slots):
+            s.ids = ids[i, :s.token_len]
+            s.scores = scores[i, :s.token_len]
+            s.step += 1
+
+    def _finish_loop(self):
+        self.res_model.eval()
+        self.vq_model.eval()
+        while True:
+            slots = self._finished.get()
+            if slots is None:
+                return
+            # Take everything else that finished while the previous group was decoding
+            stop = False
+            while True:
+                try:
+                    more = self._finished.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    stop = True
+                    break
+                slots = slots + more
+            try:
+                results = self._finish(slots)
+            except Exception as e:
+                for slot in slots:
+                    slot.request.future.set_exception(e)
+            else:
+                for slot, result in zip(slots, results):
+                    slot.request.future.set_result(result)
+            if stop:
+                return
+
+    @torch.no_grad()
+    def _finish(self, slots):
+        device = self.device
+        token_lens = torch.LongTensor([s.token_len for s in slots]).to(device)
+        mids = pad_sequence([s.ids for s in slots], batch_first=True, padding_value=-1)
+        cond_vector = torch.stack([s.cond_vector for s in slots], dim=0)
+        mids = self.res_model.generate(mids, cond_vector, token_lens, temperature=1, cond_scale=self.res_cond_scale,
+                                       generators=_slot_generators(slots, device), guidance=self.guidance,
+                                       step_hook=BatchStepHook([s.request.context for s in slots], device))
+        pred_motions = self.vq_model.forward_decoder(mids).detach().cpu().numpy()
+
+        m_lengths = token_lens * self.unit_length
+        return [pred_motions[i, :m_lengths[i]] for i in range(len(slots))]
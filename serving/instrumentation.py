@@ -0,0 +1,60 @@
+'''
+Progress reports (utils.progress) and stage timings (utils.profiling) of the generation steps. The models only
+take a step_hook, so the network code does not depend on the serving instrumentation:
+
+    t2m_transformer.generate(..., step_hook=generation_step)
+
+Both are held in context variables. The batching schedulers run generate on their own threads, so they pass a
+BatchStepHook over the contexts their requests were submitted from instead.
+'''
+import time
+from contextlib import contextmanager
+
+import torch
+
+from utils.profiling import stage, record_stage
+from utils.progress import report
+
+# Stage of a generate step -> stage name of its progress reports
+STEP_PROGRESS = {'mask_step': 'mask_decode', 'res_layer': 'residual'}
+
+
+@contextmanager
+def generation_step(stage_name, step, total):
+    '''
+    Step hook for a generate call run in the thread of the request it serves.
+    '''
+    report(STEP_PROGRESS[stage_name], step, total)
+    with stage(stage_name):
+        yield
+
+
+class BatchStepHook:
+    '''
+    Step hook for a generate call run on a scheduler thread for several requests at once: every step is reported
+    and timed in the context each request was submitted from (contextvars.copy_context() in submit), so it reaches
+    that request's reporting() callback and request profile.
+    '''
+    def __init__(self, contexts, device=None):
+        self.contexts = contexts
+        self.device = torch.device(device) if device is not None else None
+
+    def _sync(self):
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def __call__(self, stage_name, step, total):
+        '''
+        :param step: step of the batch, or a list with the step of every request
+        '''
+        steps = step if isinstance(step, list) else [step] * len(self.contexts)
+        for context, request_step in zip(self.contexts, steps):
+            context.run(report, STEP_PROGRESS[stage_name], request_step, total)
+        self._sync()
+        start = time.perf_counter()
+        yield
+        self._sync()
+        ms = (time.perf_counter() - start) * 1000.
+        for context in self.contexts:
+            context.run(record_stage, stage_name, ms)
@@ -0,0 +1,249 @@
+'''
+Asynchronous generation jobs for the web app. submit() returns a job id at once; the job then goes through
+
+    queued -> generating -> post_processing -> done (or failed)
+
+Neural generation runs on a thread executor and CPU post-processing (IK, rendering, file writes) on a pool of
+forked processes, so the transformers never wait for matplotlib and a slow render only holds up its own job.
+Every job writes its artifacts into its own directory, output_dir/<job id>/. Stages report their progress
+through utils.progress, which is forwarded to the job from both executors, and the request profiles
+(utils.profiling) of the post-processing processes are recorded in this process's metrics.
+'''
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.lazy_import import lazy_from
+from utils.progress import reporting
+
+collecting_profiles = lazy_from('utils.profiling', 'collecting_profiles', 'profiling', ('torch',))
+record_profiles = lazy_from('utils.profiling', 'record_profiles', 'profiling', ('torch',))
+
+QUEUED, GENERATING, POST_PROCESSING, DONE, FAILED = 'queued', 'generating', 'post_processing', 'done', 'failed'
+
+_progress_queue = None
+
+
+class Job:
+    '''
+    State of one request, updated by the executors and read by the UI.
+    '''
+    def __init__(self, job_id, params, out_dir):
+        self.id = job_id
+        self.params = params
+        self.out_dir = out_dir
+        self.status = QUEUED
+        self.stage = None
+        self.step = None
+        self.total = None
+        self.artifacts = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED)
+
+    def update(self, status=None, stage=None, step=None, total=None, artifacts=None, error=None):
+        with self._changed:
+            if status is not None:
+                self.status = status
+                if self.done:
+                    self.finished = time.time()
+            self.stage, self.step, self.total = stage, step, total
+            if artifacts is not None:
+                self.artifacts = artifacts
+            if error is not None:
+                self.error = error
+            self.version += 1
+            self._changed.notify_all()
+
+    def progress(self, stage, step=None, total=None):
+        # utils.progress callback, a progress report never changes the status
+        self.update(stage=stage, step=step, total=total)
+
+    def wait(self, version, timeout=None):
+        '''
+        Block until the job changes after version (or it is done, or timeout).
+        :return: the current version
+        '''
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or self.done, timeout)
+            return self.version
+
+    def describe(self):
+        text = self.status
+        if self.stage is not None:
+            text += ': ' + self.stage
+            if self.step is not None:
+                text += ' %d/%d' % (self.step, self.total) if self.total else ' %d' % self.step
+        return text
+
+    def snapshot(self):
+        with self._changed:
+            return {'id': self.id, 'status': self.status, 'stage': self.stage, 'step': self.step,
+                    'total': self.total, 'artifacts': self.artifacts, 'error': self.error,
+                    'elapsed': (self.finished or time.time()) - self.created}
+
+
+def _init_post_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _run_post(job_id, fn, args):
+    def _forward(stage, step, total):
+        _progress_queue.put((job_id, stage, step, total))
+    # The profiles go back with the result, get_metrics() of this process is not the one /metrics serves
+    with collecting_profiles() as profiles, reporting(_forward):
+        return fn(*args), profiles
+
+
+def _noop():
+    return None
+
+
+class JobManager:
+    '''
+    Job queue behind the web UI.
+    :param generate_fn: generate_fn(**params) -> samples, run on the generation executor
+    :param export_fn: export_fn(samples, out_dir) -> artifacts, run in a post-processing process; both must be
+        module-level functions
+    '''
+    def __init__(self, generate_fn, export_fn, output_dir, generate_workers=1, post_workers=2, keep_jobs=256):
+        self.generate_fn = generate_fn
+        self.export_fn = export_fn
+        self.output_dir = output_dir
+        self.keep_jobs = keep_jobs
+        self.post_workers = post_workers
+        os.makedirs(output_dir, exist_ok=True)
+
+        self._jobs = OrderedDict()  # job_id -> Job, oldest first
+        self._lock = threading.Lock()
+        self._generate = ThreadPoolExecutor(max_workers=generate_workers, thread_name_prefix='job-generate')
+
+        self._ctx = multiprocessing.get_context('fork')
+        self._progress = self._ctx.Queue()
+        self._post_lock = threading.Lock()
+        self._start_post()
+        self._forwarder = threading.Thread(target=self._forward_progress, name='job-progress', daemon=True)
+        self._forwarder.start()
+
+    def _start_post(self):
+        self._post = ProcessPoolExecutor(max_workers=self.post_workers, mp_context=self._ctx,
+                                         initializer=_init_post_worker, initargs=(self._progress,))
+        # The post-processing processes are forked on the first submit, do it now, before the web server's threads
+        self._post.submit(_noop).result()
+
+    def _restart_post(self, broken):
+        # A post-processing process died (e.g. killed for memory): the executor is broken for good, replace it
+        with self._post_lock:
+            if self._post is not broken:
+                return
+            print('Post-processing pool is broken, restarting it')
+            broken.shutdown(wait=False)
+            self._start_post()
+
+    def _submit_post(self, job, samples):
+        post = self._post
+        try:
+            future = post.submit(_run_post, job.id, self.export_fn, (samples, job.out_dir))
+        except BrokenProcessPool:
+            self._restart_post(post)
+            post = self._post
+            future = post.submit(_run_post, job.id, self.export_fn, (samples, job.out_dir))
+        future.add_done_callback(lambda f: self._finish(job, f, post))
+
+    def submit(self, **params):
+        '''
+        :param params: keyword arguments of generate_fn
+        :return: id of the new job
+        '''
+        job_id = time.strftime('%Y%m%d_%H%M%S_') + uuid.uuid4().hex[:8]
+        job = Job(job_id, params, os.path.join(self.output_dir, job_id))
+        os.makedirs(job.out_dir, exist_ok=True)
+        with self._lock:
+            self._jobs[job_id] = job
+            self._evict()
+        self._generate.submit(self._run_generate, job)
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stream(self, job_id, timeout=None):
+        '''
+        Yield the job now and again after every change (changes in between are coalesced), until it is done.
+        '''
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(f'Unknown job {job_id}')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        version = -1
+        while True:
+            version = job.wait(version, None if deadline is None else max(0., deadline - time.monotonic()))
+            yield job
+            if job.done or (deadline is not None and time.monotonic() >= deadline):
+                return
+
+    def _evict(self):
+        # Only finished jobs are dropped (their artifacts stay on disk)
+        while len(self._jobs) > self.keep_jobs:
+            oldest = next((j for j in self._jobs.values() if j.done), None)
+            if oldest is None:
+                return
+            del self._jobs[oldest.id]
+
+    def _run_generate(self, job):
+        job.update(status=GENERATING)
+        try:
+            with reporting(job.progress):
+                samples = self.generate_fn(**job.params)
+        except Exception as e:
+            traceback.print_exc()
+            job.update(status=FAILED, error=f'{type(e).__name__}: {e}')
+            return
+        job.update(status=POST_PROCESSING, stage='queued')
+        try:
+            self._submit_post(job, samples)
+        except Exception as e:
+            traceback.print_exc()
+            job.update(status=FAILED, error=f'{type(e).__name__}: {e}')
+
+    def _finish(self, job, future, post):
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # This job's process (or another one of the pool) crashed; later jobs get a fresh pool
+            self._restart_post(post)
+        if error is not None:
+            job.update(status=FAILED, error=f'{type(error).__name__}: {error}')
+        else:
+            artifacts, profiles = future.result()
+            record_profiles(profiles)
+            job.update(status=DONE, artifacts=artifacts)
+
+    def _forward_progress(self):
+        while True:
+            message = self._progress.get()
+            if message is None:
+                return
+            job_id, stage, step, total = message
+            job = self.get(job_id)
+            if job is not None and job.status == POST_PROCESSING:
+                job.progress(stage, step, total)
+
+    def close(self):
+        self._generate.shutdown()
+        self._post.shutdown()
+        self._progress.put(None)
+        self._forwarder.join()
@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def estimate_nbytes(obj):
+    '''
+    Rough memory footprint of a cached object.
+    :param obj: nn.Module, tensor, ndarray, or a tuple/list/dict of them
+    :return: number of bytes (shared storages are only counted once)
+    '''
+    seen = set()
+
+    def _tensor_bytes(t):
+        if t.data_ptr() in seen:
+            return 0
+        seen.add(t.data_ptr())
+        return t.numel() * t.element_size()
+
+    def _nbytes(o):
+        if isinstance(o, torch.nn.Module):
+            return sum(_tensor_bytes(t) for t in list(o.parameters()) + list(o.buffers()))
+        if torch.is_tensor(o):
+            return _tensor_bytes(o)
+        if isinstance(o, np.ndarray):
+            return o.nbytes
+        if isinstance(o, (tuple, list)):
+            return sum(_nbytes(e) for e in o)
+        if isinstance(o, dict):
+            return sum(_nbytes(e) for e in o.values())
+        return 0
+
+    return _nbytes(obj)
+
+
+class ModelRegistry:
+    '''
+    Process-wide cache of loaded models, keyed by whatever uniquely identifies a variant
+    (checkpoint name, architecture overrides, device). Entries are evicted in LRU order
+    once the total estimated size goes over max_bytes.
+    '''
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.RLock()
+
+    def get(self, key, loader):
+        '''
+        :param key: hashable key of the variant
+        :param loader: callable without arguments, called once on a cache miss
+        :return: the cached (or freshly loaded) value
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+            value = loader()
+            if isinstance(value, torch.nn.Module):
+                value.eval()
+            self._entries[key] = (value, estimate_nbytes(value))
+            self._evict(keep=key)
+            return value
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            print(f'Evicting {oldest} from model registry')
+            del self._entries[oldest]
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry(max_bytes=None):
+    '''
+    Return the process-wide registry, creating it on first use.
+    :param max_bytes: memory cap, only applied when the registry gets created
+    '''
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry(max_bytes)
+        return _registry
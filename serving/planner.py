@@ -0,0 +1,263 @@
+import json
+import math
+import os
+import tempfile
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+from utils.motion_process import recover_from_ric
+from utils.paramUtil import t2m_kinematic_chain
+from utils.plot_script import plot_3d_motion
+
+# Stages of one generation, the *_cfg variants run with classifier-free guidance (two transformer passes)
+STAGES = ('mask_step', 'mask_step_cfg', 'res_layer', 'res_layer_cfg', 'decode', 'ik', 'animation')
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class StageTimer:
+    '''
+    Wall-clock timer of the generation stages, synchronizing the device so asynchronous kernels are counted.
+        with timer('decode'): ...
+    '''
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.stage_ms = {}
+        self._stage = None
+        self._start = None
+
+    def __call__(self, stage):
+        self._stage = stage
+        return self
+
+    def __enter__(self):
+        _sync(self.device)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _sync(self.device)
+        self.stage_ms[self._stage] = self.stage_ms.get(self._stage, 0.) + (time.perf_counter() - self._start) * 1000.
+        return False
+
+
+class StageCostModel:
+    '''
+    Latency of each stage as a + b * tokens (ms), least-squares fitted to timings measured on this machine.
+    tokens is the number of motion tokens in the batch (batch size * token length). Observed timings of real
+    requests are added to a bounded window of samples, so the model keeps following the machine's load.
+    '''
+    def __init__(self, coefs=None, max_samples=256):
+        self.coefs = {stage: tuple(c) for stage, c in (coefs or {}).items()}  # stage -> (a, b)
+        self.max_samples = max_samples
+        self._samples = {}  # stage -> deque of (tokens, ms)
+
+    def add_sample(self, stage, tokens, ms):
+        self._samples.setdefault(stage, deque(maxlen=self.max_samples)).append((float(tokens), float(ms)))
+
+    def fit(self):
+        for stage, samples in self._samples.items():
+            tokens, ms = np.array(samples).T
+            if len(set(tokens)) > 1:
+                b, a = np.polyfit(tokens, ms, 1)
+                self.coefs[stage] = (max(float(a), 0.), max(float(b), 0.))
+            else:
+                # A single length only pins down the per-token cost through the origin
+                self.coefs[stage] = (0., float(ms.mean() / max(tokens[0], 1.)))
+
+    def observe(self, stage, tokens, ms):
+        self.add_sample(stage, tokens, ms)
+        self.fit()
+
+    def predict(self, stage, tokens):
+        if stage not in self.coefs:
+            raise KeyError(f'Stage {stage} has not been calibrated')
+        a, b = self.coefs[stage]
+        return a + b * tokens
+
+    def save(self, path):
+        state = {'coefs': self.coefs, 'samples': {stage: list(s) for stage, s in self._samples.items()}}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            state = json.load(f)
+        model = cls(state['coefs'])
+        for stage, samples in state.get('samples', {}).items():
+            for tokens, ms in samples:
+                model.add_sample(stage, tokens, ms)
+        return model
+
+
+class GenerationPlan:
+    '''
+    A generation configuration with its predicted per-stage latency.
+    num_res_layers follows ResidualTransformer.generate: -1 for all layers.
+    '''
+    def __init__(self, time_steps, cfg, num_res_layers, ik, animation, stage_ms, fits):
+        self.time_steps = time_steps
+        self.cfg = cfg
+        self.num_res_layers = num_res_layers
+        self.ik = ik
+        self.animation = animation
+        self.stage_ms = stage_ms
+        self.fits = fits
+
+    @property
+    def total_ms(self):
+        return sum(self.stage_ms.values())
+
+    def cond_scale(self, cond_scale):
+        # Guidance off is a scale of 1, which forward_with_cond_scale runs as a single pass
+        return cond_scale if self.cfg else 1
+
+    def report(self, actual_ms=None):
+        '''
+        :param actual_ms: optional dict of measured stage timings (StageTimer.stage_ms)
+        :return: printable table of predicted (and actual) stage timings
+        '''
+        lines = ['Plan: time_steps=%d cfg=%s num_res_layers=%d ik=%s animation=%s fits=%s' %
+                 (self.time_steps, self.cfg, self.num_res_layers, self.ik, self.animation, self.fits)]
+        actual_ms = actual_ms or {}
+        for stage, ms in self.stage_ms.items():
+            actual = actual_ms.get(stage)
+            lines.append('  %-10s predicted %8.1f ms' % (stage, ms) +
+                         ('   actual %8.1f ms' % actual if actual is not None else ''))
+        total = '  %-10s predicted %8.1f ms' % ('total', self.total_ms)
+        if actual_ms:
+            total += '   actual %8.1f ms' % sum(actual_ms.values())
+        lines.append(total)
+        return '\n'.join(lines)
+
+
+class GenerationPlanner:
+    '''
+    Picks the highest-quality generation configuration whose predicted latency fits a per-request budget.
+    Configurations are tried in the order of the quality ladder, a list of (time_steps, cfg, num_res_layers)
+    from best to cheapest.
+    '''
+    def __init__(self, cost_model, num_quantizers, time_steps=18, ladder=None):
+        self.cost_model = cost_model
+        self.num_res_layers = num_quantizers - 1
+        self.ladder = ladder if ladder is not None else self.default_ladder(time_steps, self.num_res_layers)
+
+    @staticmethod
+    def default_ladder(time_steps, num_res_layers):
+        half_res = max(num_res_layers // 2, 1)
+        return [
+            (time_steps, True, -1),
+            (time_steps, True, half_res),
+            (math.ceil(time_steps * 2 / 3), True, half_res),
+            (math.ceil(time_steps / 2), True, 1),
+            (math.ceil(time_steps / 2), False, 1),
+            (math.ceil(time_steps / 3), False, 0),
+        ]
+
+    def predict(self, time_steps, cfg, num_res_layers, num_tokens, batch_size=1, ik=True, animation=True):
+        '''
+        :return: dict of predicted stage latencies (ms)
+        '''
+        tokens = num_tokens * batch_size
+        res_layers = self.num_res_layers if num_res_layers == -1 else num_res_layers
+        suffix = '_cfg' if cfg else ''
+        stage_ms = {
+            'mask': time_steps * self.cost_model.predict('mask_step' + suffix, tokens),
+            'residual': res_layers * self.cost_model.predict('res_layer' + suffix, tokens),
+            'decode': self.cost_model.predict('decode', tokens),
+        }
+        if ik:
+            stage_ms['ik'] = self.cost_model.predict('ik', tokens)
+        if animation:
+            stage_ms['animation'] = self.cost_model.predict('animation', tokens)
+        return stage_ms
+
+    def plan(self, budget_ms, num_tokens, batch_size=1, ik=True, animation=True, queue_ms=0.):
+        '''
+        :param budget_ms: end-to-end latency budget of the request
+        :param num_tokens: motion length in tokens
+        :param queue_ms: expected wait before the request starts, taken off the budget
+        :return: GenerationPlan of the best configuration that fits, or of the cheapest one with fits=False,
+            which callers can use to reject the request
+        '''
+        plan = None
+        for time_steps, cfg, num_res_layers in self.ladder:
+            stage_ms = self.predict(time_steps, cfg, num_res_layers, num_tokens, batch_size, ik, animation)
+            fits = sum(stage_ms.values()) + queue_ms <= budget_ms
+            plan = GenerationPlan(time_steps, cfg, num_res_layers, ik, animation, stage_ms, fits)
+            if fits:
+                return plan
+        return plan
+
+    def observe(self, plan, actual_ms, num_tokens, batch_size=1):
+        '''
+        Feed the measured stage timings of an executed plan back into the cost model.
+        '''
+        tokens = num_tokens * batch_size
+        res_layers = self.num_res_layers if plan.num_res_layers == -1 else plan.num_res_layers
+        suffix = '_cfg' if plan.cfg else ''
+        if 'mask' in actual_ms and plan.time_steps > 0:
+            self.cost_model.add_sample('mask_step' + suffix, tokens, actual_ms['mask'] / plan.time_steps)
+        if 'residual' in actual_ms and res_layers > 0:
+            self.cost_model.add_sample('res_layer' + suffix, tokens, actual_ms['residual'] / res_layers)
+        for stage in ('decode', 'ik', 'animation'):
+            if stage in actual_ms:
+                self.cost_model.add_sample(stage, tokens, actual_ms[stage])
+        self.cost_model.fit()
+
+
+@torch.no_grad()
+def calibrate(models, device, token_lens=(12, 24, 49), repeats=3, converter=None, nb_joints=22):
+    '''
+    Measure every stage on this machine with random conditions at a few motion lengths.
+    :param models: Namespace of get_generation_models
+    :param converter: Joint2BVHConvertor, the ik stage is only calibrated when given
+    :return: fitted StageCostModel
+    '''
+    t2m_transformer, res_model, vq_model = models.t2m_transformer, models.res_model, models.vq_model
+    cost_model = StageCostModel()
+    timer = StageTimer(device)
+    with tempfile.TemporaryDirectory(prefix='planner_') as tmp_dir:
+        for n in token_lens:
+            cond_vector = torch.randn(1, t2m_transformer.clip_dim, device=device)
+            m_lens = torch.LongTensor([n]).to(device)
+            padding_mask = torch.zeros(1, n, dtype=torch.bool, device=device)
+            for r in range(repeats + 1):
+                timer.stage_ms = {}
+                ids = torch.full((1, n), t2m_transformer.mask_id, dtype=torch.long, device=device)
+                scores = torch.zeros(1, n, device=device)
+                for stage, cond_scale in (('mask_step', 1), ('mask_step_cfg', 4)):
+                    with timer(stage):
+                        t2m_transformer.masked_decode_step(ids, scores, cond_vector, padding_mask, m_lens,
+                                                           torch.tensor(0.5, device=device), cond_scale=cond_scale)
+                base_ids = torch.randint(0, t2m_transformer.mask_id, (1, n), device=device)
+                for stage, cond_scale in (('res_layer', 1), ('res_layer_cfg', 5)):
+                    with timer(stage):
+                        mids = res_model.generate(base_ids, cond_vector, m_lens, cond_scale=cond_scale,
+                                                  num_res_layers=1)
+                mids = res_model.generate(base_ids, cond_vector, m_lens, cond_scale=5)
+                with timer('decode'):
+                    motion = vq_model.forward_decoder(mids)
+                joint = motion[0].cpu().numpy() * models.std + models.mean
+                joint = recover_from_ric(torch.from_numpy(joint).float(), nb_joints).numpy()
+                if converter is not None:
+                    with timer('ik'):
+                        converter.convert(joint, filename=os.path.join(tmp_dir, 'calib.bvh'), iterations=100,
+                                          foot_ik=False)
+                with timer('animation'):
+                    plot_3d_motion(os.path.join(tmp_dir, 'calib.gif'), t2m_kinematic_chain, joint, title='', fps=20)
+                # The first round only warms up
+                if r > 0:
+                    for stage, ms in timer.stage_ms.items():
+                        cost_model.add_sample(stage, n, ms)
+    cost_model.fit()
+    return cost_model
@@ -0,0 +1,225 @@
+'''
+Multi-process CPU inference. The parent loads the models once and moves their weights into shared memory,
+then forks the workers: every worker sees the same physical copy of the weights, runs with its own torch
+thread count and (optionally) its own set of CPU cores, and takes jobs from one shared queue.
+
+    pool = WorkerPool(num_workers=4, threads_per_worker=0, pin_cpus=True)
+    pool.submit(fn, *args).result()
+
+fn must be a module-level function (it is sent to the worker by reference), and fn, its arguments and its
+result must be picklable; submit raises if the job is not. Anything in the parent's
+model registry when the pool is created is inherited by the workers, so fn finds the warm, shared models there.
+The progress reports (utils.progress) and request profiles (utils.profiling) of a job come back to the parent:
+reports go to the reporting() callback active where the job was submitted, profiles into the parent's metrics.
+'''
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+
+import torch
+
+from utils.profiling import collecting_profiles, record_profiles
+from utils.progress import reporting, current_reporter
+
+_worker_id = None
+
+
+def current_worker():
+    '''
+    :return: index of the pool worker this code runs in, None in the parent process
+    '''
+    return _worker_id
+
+
+def share_module(module):
+    # Parameters and buffers move to shared memory in place, forked workers then never copy them on write
+    if isinstance(module, torch.nn.Module):
+        module.share_memory()
+        text_encoder = getattr(module, 'text_encoder', None)
+        if text_encoder is not None and isinstance(getattr(text_encoder, 'clip_model', None), torch.nn.Module):
+            text_encoder.clip_model.share_memory()
+    return module
+
+
+def share_models(models):
+    '''
+    :param models: Namespace of get_generation_models
+    '''
+    for value in vars(models).values():
+        share_module(value)
+    return models
+
+
+def split_cpus(num_workers, cpus=None):
+    '''
+    Split the CPUs this process may run on into num_workers contiguous, disjoint sets (as even as possible).
+    '''
+    cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+    if num_workers > len(cpus):
+        # More workers than cores: workers share cores round-robin
+        return [{cpus[i % len(cpus)]} for i in range(num_workers)]
+    size, extra = divmod(len(cpus), num_workers)
+    sets, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(set(cpus[start:end]))
+        start = end
+    return sets
+
+
+def _worker_main(worker_id, jobs, results, running, cpus, num_threads):
+    global _worker_id
+    _worker_id = worker_id
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, payload = job
+        # Shared value rather than a message: it is visible to the parent even if this process dies mid-job
+        running.value = job_id
+
+        def _forward(stage, step, total, job_id=job_id):
+            results.put(('progress', job_id, (stage, step, total), None))
+
+        with collecting_profiles() as profiles, reporting(_forward):
+            try:
+                # Unpickled only once the job id is recorded, so a job that fails to load still resolves
+                fn, args, kwargs = pickle.loads(payload)
+                value = fn(*args, **kwargs)
+                pickle.dumps(value)  # an unpicklable result is reported here, not dropped by the queue
+            except Exception as e:
+                message = ('error', job_id, '%s: %s\n%s' % (type(e).__name__, e, traceback.format_exc()))
+            else:
+                message = ('done', job_id, value)
+        results.put(message + (profiles,))
+        running.value = -1
+
+
+class WorkerPool:
+    '''
+    Forked worker processes fed from one job queue. Results and exceptions come back to the parent as
+    Futures. A worker that dies fails the job it was running and is replaced.
+    Workers are forked, so create the pool before starting threads in the parent (e.g. before the web server),
+    and only for CPU inference: CUDA cannot be used across fork.
+    '''
+    def __init__(self, num_workers, threads_per_worker=0, pin_cpus=False):
+        '''
+        :param threads_per_worker: torch intra-op threads of each worker, 0 for the size of its CPU set
+        :param pin_cpus: pin every worker to a disjoint set of cores
+        '''
+        if num_workers <= 0:
+            raise ValueError('WorkerPool needs at least one worker')
+        self.num_workers = num_workers
+        self.cpu_sets = split_cpus(num_workers)
+        self.threads = [threads_per_worker or len(cpus) for cpus in self.cpu_sets]
+        self.pin_cpus = pin_cpus
+
+        self._ctx = multiprocessing.get_context('fork')
+        self._jobs = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._futures = {}  # job_id -> (Future, progress callback of the submitter)
+        self._running = [self._ctx.Value('q', -1, lock=False) for _ in range(num_workers)]  # job of each worker
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._workers = [self._spawn(i) for i in range(num_workers)]
+        self._collector = threading.Thread(target=self._collect, name='worker-pool-results', daemon=True)
+        self._collector.start()
+        print('Started %d inference workers (%s threads%s)' % (
+            num_workers, ', '.join(map(str, self.threads)), ', pinned' if pin_cpus else ''))
+
+    def _spawn(self, worker_id):
+        process = self._ctx.Process(
+            target=_worker_main, name='inference-worker-%d' % worker_id, daemon=True,
+            args=(worker_id, self._jobs, self._results, self._running[worker_id],
+                  self.cpu_sets[worker_id] if self.pin_cpus else None, self.threads[worker_id]))
+        process.start()
+        return process
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        :return: Future resolving to fn(*args, **kwargs) as computed in a worker
+        '''
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('WorkerPool is closed')
+            job_id = self._next_id
+            self._next_id += 1
+            future = Future()
+            self._futures[job_id] = (future, current_reporter())
+        try:
+            payload = pickle.dumps((fn, args, kwargs))
+        except Exception:
+            with self._lock:
+                self._futures.pop(job_id, None)
+            raise
+        self._jobs.put((job_id, payload))
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _resolve(self, job_id, value=None, error=None):
+        with self._lock:
+            future, _ = self._futures.pop(job_id, (None, None))
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(value)
+
+    def _reap(self):
+        for worker_id, process in enumerate(self._workers):
+            if process.is_alive() or self._closed:
+                continue
+            job_id = self._running[worker_id].value
+            self._running[worker_id].value = -1
+            if job_id >= 0:
+                self._resolve(job_id, error='inference worker %d exited with code %s' % (worker_id, process.exitcode))
+            print('Restarting inference worker %d (exit code %s)' % (worker_id, process.exitcode))
+            self._workers[worker_id] = self._spawn(worker_id)
+
+    def _collect(self):
+        while True:
+            try:
+                message = self._results.get(timeout=1.)
+            except queue.Empty:
+                if self._closed:
+                    return
+                self._reap()
+                continue
+            self._reap()
+            kind, job_id, payload, profiles = message
+            if kind == 'progress':
+                with self._lock:
+                    callback = self._futures.get(job_id, (None, None))[1]
+                if callback is not None:
+                    callback(*payload)
+                continue
+            record_profiles(profiles)
+            if kind == 'done':
+                self._resolve(job_id, value=payload)
+            else:
+                self._resolve(job_id, error=payload)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        for _ in self._workers:
+            self._jobs.put(None)
+        for process in self._workers:
+            process.join()
+        self._collector.join()
+        with self._lock:
+            futures, self._futures = [f for f, _ in self._futures.values()], {}
+        for future in futures:
+            future.set_exception(RuntimeError('WorkerPool was closed'))
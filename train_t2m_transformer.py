@@ -17,7 +17,9 @@ from utils.get_opt import get_opt
 from utils.fixseed import fixseed
 from utils.paramUtil import t2m_kinematic_chain, kit_kinematic_chain
 
-from data.t2m_dataset import Text2MotionDataset
+from data.t2m_dataset import Text2MotionDataset, LengthBucketBatchSampler, pad_collate_fn
+from data.text_embeddings import CaptionEmbeddingStore
+from data.token_cache import load_token_cache
 from motion_loaders.dataset_motion_loader import get_dataset_motion_loader
 from models.t2m_eval_wrapper import EvaluatorModelWrapper
 
@@ -137,13 +139,32 @@ if __name__ == '__main__':
     train_split_file = pjoin(opt.data_root, 'train.txt')
     val_split_file = pjoin(opt.data_root, 'val.txt')
 
-    train_dataset = Text2MotionDataset(opt, mean, std, train_split_file)
-    val_dataset = Text2MotionDataset(opt, mean, std, val_split_file)
-
-    train_loader = DataLoader(train_dataset, batch_size=opt.batch_size, num_workers=4, shuffle=True, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=opt.batch_size, num_workers=4, shuffle=True, drop_last=True)
+    # --text_embeddings: captions come with their precomputed CLIP embeddings, CLIP is not run per batch
+    text_embeddings = None
+    if opt.text_embeddings:
+        text_embeddings = CaptionEmbeddingStore(opt.text_embeddings)
+        assert text_embeddings.clip_version == clip_version, 'Text embeddings were computed with another CLIP model'
+    train_dataset = Text2MotionDataset(opt, mean, std, train_split_file, text_embeddings)
+    val_dataset = Text2MotionDataset(opt, mean, std, val_split_file, text_embeddings)
+    # --token_cache: read the RVQ tokens of every crop instead of encoding each batch (skipped if stale)
+    if opt.token_cache:
+        load_token_cache(opt.token_cache, [train_dataset, val_dataset], vq_model, mean, std, opt)
+
+    if opt.bucket_batches:
+        # --bucket_batches: batches of similar lengths, padded to their longest motion instead of max_motion_length
+        train_dataset.pad_to_max = val_dataset.pad_to_max = False
+        train_loader = DataLoader(train_dataset, num_workers=4, collate_fn=pad_collate_fn,
+                                  batch_sampler=LengthBucketBatchSampler(train_dataset.length_arr[train_dataset.pointer:],
+                                                                         opt.batch_size, opt.bucket_size))
+        val_loader = DataLoader(val_dataset, num_workers=4, collate_fn=pad_collate_fn,
+                                batch_sampler=LengthBucketBatchSampler(val_dataset.length_arr[val_dataset.pointer:],
+                                                                       opt.batch_size, opt.bucket_size))
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=opt.batch_size, num_workers=4, shuffle=True, drop_last=True)
+        val_loader = DataLoader(val_dataset, batch_size=opt.batch_size, num_workers=4, shuffle=True, drop_last=True)
 
-    eval_val_loader, _ = get_dataset_motion_loader(dataset_opt_path, 32, 'val', device=opt.device)
+    eval_val_loader, _ = get_dataset_motion_loader(dataset_opt_path, 32, 'val', device=opt.device,
+                                                   packed_data=opt.packed_data)
 
     wrapper_opt = get_opt(dataset_opt_path, torch.device('cuda'))
     eval_wrapper = EvaluatorModelWrapper(wrapper_opt)
@@ -7,7 +7,7 @@ from torch.utils.data import DataLoader
 from models.vq.model import RVQVAE
 from models.vq.vq_trainer import RVQTokenizerTrainer
 from options.vq_option import arg_parse
-from data.t2m_dataset import MotionDataset
+from data.t2m_dataset import MotionDataset, WindowBatchSampler
 from utils import paramUtil
 import numpy as np
 
@@ -109,11 +109,21 @@ if __name__ == "__main__":
     train_dataset = MotionDataset(opt, mean, std, train_split_file)
     val_dataset = MotionDataset(opt, mean, std, val_split_file)
 
-    train_loader = DataLoader(train_dataset, batch_size=opt.batch_size, drop_last=True, num_workers=4,
-                              shuffle=True, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=opt.batch_size, drop_last=True, num_workers=4,
-                            shuffle=True, pin_memory=True)
-    eval_val_loader, _ = get_dataset_motion_loader(dataset_opt_path, 32, 'val', device=opt.device)
+    if opt.batch_windows:
+        # Whole batches gathered from one normalized buffer per dataset, built here so the workers share it
+        train_dataset.prepare_windows()
+        val_dataset.prepare_windows()
+        train_loader = DataLoader(train_dataset, batch_size=None, num_workers=4, pin_memory=True,
+                                  sampler=WindowBatchSampler(len(train_dataset), opt.batch_size))
+        val_loader = DataLoader(val_dataset, batch_size=None, num_workers=4, pin_memory=True,
+                                sampler=WindowBatchSampler(len(val_dataset), opt.batch_size))
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=opt.batch_size, drop_last=True, num_workers=4,
+                                  shuffle=True, pin_memory=True)
+        val_loader = DataLoader(val_dataset, batch_size=opt.batch_size, drop_last=True, num_workers=4,
+                                shuffle=True, pin_memory=True)
+    eval_val_loader, _ = get_dataset_motion_loader(dataset_opt_path, 32, 'val', device=opt.device,
+                                                   packed_data=opt.packed_data)
     trainer.train(train_loader, val_loader, eval_val_loader, eval_wrapper, plot_t2m)
 
 ## train_vq.py --dataset_name kit --batch_size 512 --name VQVAE_dp2 --gpu_id 3
@@ -0,0 +1,29 @@
+import numpy as np
+
+
+def length_bucketed_batches(lengths, token_budget, max_batch_size=None):
+    '''
+    Group samples of similar length into micro-batches whose padded size stays under a token budget.
+    :param lengths: (n,) sequence lengths, in tokens
+    :param token_budget: maximum of batch_size * max(length in batch) per micro-batch; a sample longer than
+        the budget still gets a batch of its own
+    :param max_batch_size: optional cap on the number of samples per micro-batch
+    :return: list of micro-batches, each a list of indices into lengths, longest first
+    '''
+    lengths = np.asarray(lengths)
+    # Stable sort, so equal lengths keep their input order
+    order = np.argsort(-lengths, kind='stable')
+
+    batches = []
+    batch = []
+    for i in order:
+        # Sorted longest first, so the first sample of a batch fixes its padded length
+        padded_len = lengths[batch[0]] if batch else lengths[i]
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or (len(batch) + 1) * padded_len > token_budget):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
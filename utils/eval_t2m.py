@@ -1,4 +1,5 @@
 import os
+import time
 
 import clip
 import numpy as np
@@ -897,10 +898,25 @@ def evaluation_mask_transformer_test(val_loader, vq_model, trans, repeat_id, eva
     return fid, diversity, R_precision, matching_score_pred, multimodality
 
 
+def _gen_clock():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+def _add_gen_time(stats, start):
+    if stats is not None:
+        stats['gen_time'] = stats.get('gen_time', 0.) + _gen_clock() - start
+
+
 @torch.no_grad()
 def evaluation_mask_transformer_test_plus_res(val_loader, vq_model, res_model, trans, repeat_id, eval_wrapper,
                                 time_steps, cond_scale, temperature, topkr, gsample=True, force_mask=False,
-                                              cal_mm=True, res_cond_scale=5):
+                                              cal_mm=True, res_cond_scale=5, guidance=None, stats=None):
+    '''
+    :param guidance: optional GuidanceSchedule used by both transformers
+    :param stats: optional dict, 'gen_time' (seconds spent in the two generate calls) is accumulated into it
+    '''
     trans.eval()
     vq_model.eval()
     res_model.eval()
@@ -932,13 +948,16 @@ def evaluation_mask_transformer_test_plus_res(val_loader, vq_model, res_model, t
         # (b, seqlen, c)
             motion_multimodality_batch = []
             for _ in range(30):
+                start = _gen_clock()
                 mids = trans.generate(clip_text, m_length // 4, time_steps, cond_scale,
                                       temperature=temperature, topk_filter_thres=topkr,
-                                      gsample=gsample, force_mask=force_mask)
+                                      gsample=gsample, force_mask=force_mask, guidance=guidance)
 
                 # motion_codes = motion_codes.permute(0, 2, 1)
                 # mids.unsqueeze_(-1)
-                pred_ids = res_model.generate(mids, clip_text, m_length // 4, temperature=1, cond_scale=res_cond_scale)
+                pred_ids = res_model.generate(mids, clip_text, m_length // 4, temperature=1, cond_scale=res_cond_scale,
+                                              guidance=guidance)
+                _add_gen_time(stats, start)
                 # pred_codes = trans(code_indices[..., 0], clip_text, m_length//4, force_mask=force_mask)
                 # pred_ids = torch.where(pred_ids==-1, 0, pred_ids)
 
@@ -954,13 +973,16 @@ def evaluation_mask_transformer_test_plus_res(val_loader, vq_model, res_model, t
             motion_multimodality_batch = torch.cat(motion_multimodality_batch, dim=1) #(bs, 30, d)
             motion_multimodality.append(motion_multimodality_batch)
         else:
+            start = _gen_clock()
             mids = trans.generate(clip_text, m_length // 4, time_steps, cond_scale,
                                   temperature=temperature, topk_filter_thres=topkr,
-                                  force_mask=force_mask)
+                                  force_mask=force_mask, guidance=guidance)
 
             # motion_codes = motion_codes.permute(0, 2, 1)
             # mids.unsqueeze_(-1)
-            pred_ids = res_model.generate(mids, clip_text, m_length // 4, temperature=1, cond_scale=res_cond_scale)
+            pred_ids = res_model.generate(mids, clip_text, m_length // 4, temperature=1, cond_scale=res_cond_scale,
+                                          guidance=guidance)
+            _add_gen_time(stats, start)
             # pred_codes = trans(code_indices[..., 0], clip_text, m_length//4, force_mask=force_mask)
             # pred_ids = torch.where(pred_ids == -1, 0, pred_ids)
 
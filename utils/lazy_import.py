@@ -0,0 +1,108 @@
+'''
+Deferred imports for the entry points. Heavy subsystems (torch, the models, CLIP, the IK / BVH stack,
+matplotlib) are bound to proxies at import time and only imported when first used:
+
+    torch = lazy_import('torch', 'torch')
+    plot_3d_motion = lazy_from('utils.plot_script', 'plot_3d_motion', 'plotting', requires=('torch',))
+
+Every deferred import is timed and charged to its subsystem (self time: nested timed imports are charged
+to their own subsystem), so import_report() shows what start-up actually paid for.
+'''
+import importlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_import_ms = OrderedDict()  # subsystem -> ms
+_stack = []  # [start, nested ms] of the timed imports in progress
+_lock = threading.RLock()
+
+
+def timed_import(module_name, subsystem=None, requires=()):
+    '''
+    Import module_name now, charging the time to subsystem unless it was already imported.
+    :param requires: modules imported (and timed under their own name) first, so that their cost is not
+        charged to this subsystem
+    '''
+    for dependency in requires:
+        timed_import(dependency, dependency)
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    with _lock:
+        _stack.append([time.perf_counter(), 0.])
+        try:
+            module = importlib.import_module(module_name)
+        finally:
+            start, nested = _stack.pop()
+            elapsed = (time.perf_counter() - start) * 1000.
+            if _stack:
+                _stack[-1][1] += elapsed
+            key = subsystem or module_name
+            _import_ms[key] = _import_ms.get(key, 0.) + elapsed - nested
+    return module
+
+
+class LazyModule:
+    '''
+    Stand-in for a module, imported on first attribute access.
+    '''
+    def __init__(self, module_name, subsystem=None, requires=()):
+        self.__dict__['_lazy_args'] = (module_name, subsystem, requires)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = timed_import(*self.__dict__['_lazy_args'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<lazy module %s>' % self.__dict__['_lazy_args'][0]
+
+
+class LazyAttr:
+    '''
+    Stand-in for a function or class of a lazily imported module; calls and attribute accesses go to the
+    real object.
+    '''
+    def __init__(self, module, name):
+        self._lazy_module = module
+        self._lazy_name = name
+
+    def resolve(self):
+        return getattr(self._lazy_module, self._lazy_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_lazy_'):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+
+def lazy_import(module_name, subsystem=None, requires=()):
+    return LazyModule(module_name, subsystem, requires)
+
+
+def lazy_from(module_name, name, subsystem=None, requires=()):
+    return LazyAttr(LazyModule(module_name, subsystem, requires), name)
+
+
+def import_report():
+    '''
+    :return: printable import cost of every subsystem loaded so far, most expensive first
+    '''
+    with _lock:
+        items = sorted(_import_ms.items(), key=lambda kv: -kv[1])
+    lines = ['Startup import cost:']
+    for subsystem, ms in items:
+        lines.append('  %-14s %8.1f ms' % (subsystem, ms))
+    lines.append('  %-14s %8.1f ms' % ('total', sum(ms for _, ms in items)))
+    return '\n'.join(lines)
@@ -0,0 +1,129 @@
+'''
+Generation results as a compact record (the de-normalized motion features and the caption) from which every
+exported artifact is derived on request:
+
+    result = MotionResult(features, caption)
+    result.joints                            # (frames, 22, 3) joint positions
+    result.bvh('a_ik.bvh', foot_ik=True)     # IK runs once per foot_ik setting
+    result.animation('a.mp4')                # rendered from the IK joints, like the BVH
+    result.save('a.npz'); MotionResult.load('a.npz')
+
+Joint recovery and IK results are cached on the object, and asking again for an artifact that was
+already written copies the file instead of rendering it again. Nothing is computed for artifacts that are
+never asked for, and the IK / BVH and plotting stack is only imported once one is.
+'''
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from utils.lazy_import import lazy_import, lazy_from
+from utils.paramUtil import t2m_kinematic_chain
+
+torch = lazy_import('torch', 'torch')
+recover_from_ric = lazy_from('utils.motion_process', 'recover_from_ric', 'models', ('torch',))
+plot_3d_motion = lazy_from('utils.plot_script', 'plot_3d_motion', 'plotting', ('torch',))
+Joint2BVHConvertor = lazy_from('visualization.joints2bvh', 'Joint2BVHConvertor', 'visualization',
+                               ('torch', 'utils.plot_script'))
+BVH = lazy_import('visualization.BVH_mod', 'visualization', ('torch', 'utils.plot_script'))
+
+_converter = None
+_converter_lock = threading.Lock()
+
+
+def get_converter():
+    '''
+    Process-wide Joint2BVHConvertor (it only holds the read-only BVH template).
+    '''
+    global _converter
+    with _converter_lock:
+        if _converter is None:
+            _converter = Joint2BVHConvertor()
+        return _converter
+
+
+class MotionResult:
+    def __init__(self, features, caption='', joints_num=22, fps=20, prompt_id=0, repeat_id=0):
+        '''
+        :param features: (frames, dim_pose) de-normalized motion features, already cut to the motion length
+        '''
+        self.features = np.asarray(features, dtype=np.float32)
+        self.caption = caption
+        self.joints_num = joints_num
+        self.fps = fps
+        self.prompt_id = prompt_id
+        self.repeat_id = repeat_id
+        self._joints = None
+        self._ik = {}  # foot_ik -> (animation, joint positions after IK)
+        self._files = {}  # (kind, variant) -> path of the last written file
+
+    @property
+    def m_length(self):
+        return len(self.features)
+
+    @property
+    def joints(self):
+        if self._joints is None:
+            self._joints = recover_from_ric(torch.from_numpy(self.features).float(), self.joints_num).numpy()
+        return self._joints
+
+    def ik(self, foot_ik=False, iterations=100):
+        '''
+        :return: (BVH animation, (frames, 22, 3) joint positions of that animation)
+        '''
+        if foot_ik not in self._ik:
+            self._ik[foot_ik] = get_converter().convert(self.joints, filename=None, iterations=iterations,
+                                                        foot_ik=foot_ik)
+        return self._ik[foot_ik]
+
+    def _cached_file(self, key, path):
+        # Written before: copy it rather than deriving it again
+        previous = self._files.get(key)
+        if previous is None or not os.path.exists(previous):
+            return False
+        if os.path.abspath(previous) != os.path.abspath(path):
+            shutil.copyfile(previous, path)
+        return True
+
+    def bvh(self, path, foot_ik=False):
+        key = ('bvh', foot_ik)
+        if not self._cached_file(key, path):
+            animation, _ = self.ik(foot_ik)
+            BVH.save(path, animation, names=animation.names, frametime=1 / self.fps, order='zyx', quater=True)
+            self._files[key] = path
+        return path
+
+    def animation(self, path, foot_ik=False, ik=True):
+        '''
+        Render a GIF / MP4 (by the extension of path).
+        :param ik: render the joints of the IK animation (what the BVH shows), False for the raw joints
+        '''
+        key = ('animation', foot_ik if ik else None, os.path.splitext(path)[1])
+        if not self._cached_file(key, path):
+            joints = self.ik(foot_ik)[1] if ik else self.joints
+            plot_3d_motion(path, t2m_kinematic_chain, joints, title=self.caption, fps=self.fps)
+            self._files[key] = path
+        return path
+
+    def save_joints(self, path, foot_ik=None):
+        '''
+        :param foot_ik: None for the recovered joint positions, True / False for those of the IK animation
+        '''
+        np.save(path, self.joints if foot_ik is None else self.ik(foot_ik)[1])
+        return path
+
+    def save(self, path):
+        '''
+        Write the compact record (features and caption); artifacts can be derived from it later with load().
+        '''
+        np.savez(path, features=self.features, caption=self.caption, joints_num=self.joints_num, fps=self.fps,
+                 prompt_id=self.prompt_id, repeat_id=self.repeat_id)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        record = np.load(path)
+        return cls(record['features'], str(record['caption']), joints_num=int(record['joints_num']),
+                   fps=int(record['fps']), prompt_id=int(record['prompt_id']), repeat_id=int(record['repeat_id']))
+
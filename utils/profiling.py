@@ -0,0 +1,283 @@
+'''
+Opt-in instrumentation of the generation pipeline: nested stage timers, peak-RSS sampling and token / frame
+counters, collected per request and aggregated into process-wide Prometheus metrics.
+
+    with profile_request('generate_motion', enabled=opt.profile, device=opt.device) as profile:
+        with stage('vq_decode'):
+            ...
+        count('frames', n)
+
+stage() and count() are no-ops outside of an active profile_request, so library code can be instrumented
+unconditionally. The active profile is held in a context variable, so concurrent requests on different
+threads never mix their timings. Requests run in worker processes collect their profiles with
+collecting_profiles() and hand them to the parent, which records them in its metrics.
+'''
+import contextvars
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+
+_current_profile = contextvars.ContextVar('current_profile', default=None)
+_profile_sink = contextvars.ContextVar('profile_sink', default=None)
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024. ** 2
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class _Span:
+    def __init__(self, name):
+        self.name = name
+        self.ms = 0.
+        self.rss_mb = None
+        self.peak_rss_mb = None
+        self.children = []
+
+    def to_dict(self):
+        span = {'name': self.name, 'ms': round(self.ms, 3), 'rss_mb': self.rss_mb, 'peak_rss_mb': self.peak_rss_mb}
+        if self.children:
+            span['children'] = [c.to_dict() for c in self.children]
+        return span
+
+    def walk(self, prefix=''):
+        path = prefix + self.name
+        yield path, self
+        for c in self.children:
+            yield from c.walk(path + '/')
+
+
+class RequestProfile:
+    '''
+    Stage tree, counters and memory samples of one request. Repeated stages (every masked timestep,
+    every residual layer) are kept as separate children in call order.
+    '''
+    def __init__(self, name, device=None):
+        self.device = torch.device(device) if device is not None else None
+        self.root = _Span(name)
+        self.counters = {}
+        self._stack = [self.root]
+        self._start = None
+
+    def _sync(self):
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def stage(self, name):
+        span = _Span(name)
+        self._stack[-1].children.append(span)
+        self._stack.append(span)
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self._sync()
+            span.ms = (time.perf_counter() - start) * 1000.
+            span.rss_mb = round(current_rss_mb(), 1)
+            span.peak_rss_mb = round(peak_rss_mb(), 1)
+            self._stack.pop()
+
+    def add_span(self, name, ms):
+        '''
+        Record a stage that was timed outside of the profile (e.g. option parsing, before it existed).
+        '''
+        span = _Span(name)
+        span.ms = ms
+        self._stack[-1].children.append(span)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {'request': self.root.name, 'total_ms': round(self.root.ms, 3), 'counters': dict(self.counters),
+                'peak_rss_mb': self.root.peak_rss_mb, 'stages': self.root.to_dict()}
+
+
+@contextmanager
+def stage(name):
+    profile = _current_profile.get()
+    if profile is None:
+        yield None
+        return
+    with profile.stage(name) as span:
+        yield span
+
+
+def count(name, n=1):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.count(name, n)
+
+
+def current_profile():
+    return _current_profile.get()
+
+
+def record_stage(name, ms):
+    '''
+    Record a stage timed elsewhere (e.g. by a scheduler thread serving this request) in the current profile.
+    '''
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_span(name, ms)
+
+
+@contextmanager
+def collecting_profiles():
+    '''
+    Collect the profiles of the requests finished inside the block into the returned list instead of recording
+    them in this process's metrics; a worker process sends them to the parent, which calls record_profiles.
+    '''
+    profiles = []
+    token = _profile_sink.set(profiles)
+    try:
+        yield profiles
+    finally:
+        _profile_sink.reset(token)
+
+
+def record_profiles(profiles):
+    for profile in profiles:
+        get_metrics().record(profile)
+
+
+@contextmanager
+def profile_request(name, enabled=True, device=None, json_dir=''):
+    '''
+    Profile everything run inside the block as one request.
+    :param json_dir: if given, the request's profile is also written there as <name>_<timestamp>_<id>.json
+    :return: the RequestProfile (None when disabled)
+    '''
+    if not enabled:
+        yield None
+        return
+    profile = RequestProfile(name, device)
+    token = _current_profile.set(profile)
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile._sync()
+        profile.root.ms = (time.perf_counter() - start) * 1000.
+        profile.root.rss_mb = round(current_rss_mb(), 1)
+        profile.root.peak_rss_mb = round(peak_rss_mb(), 1)
+        _current_profile.reset(token)
+        sink = _profile_sink.get()
+        if sink is not None:
+            sink.append(profile)
+        else:
+            get_metrics().record(profile)
+        if json_dir:
+            os.makedirs(json_dir, exist_ok=True)
+            # Concurrent requests (threads or pool workers) finish within the same millisecond
+            path = os.path.join(json_dir, '%s_%d_%s.json' % (name, time.time() * 1000, uuid.uuid4().hex[:8]))
+            with open(path, 'w') as f:
+                json.dump(profile.to_dict(), f, indent=2)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class MetricsRegistry:
+    '''
+    Process-wide counters, gauges and stage latency histograms, exported in the Prometheus text format.
+    Also keeps the last few request profiles for the JSON endpoint.
+    '''
+    def __init__(self, prefix='momask', keep_profiles=100):
+        self.prefix = prefix
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._profiles = deque(maxlen=keep_profiles)
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=()):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def set_gauge(self, name, value, labels=()):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            hist = self._histograms.setdefault((name, labels), [[0] * len(HISTOGRAM_BUCKETS), 0., 0])
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def record(self, profile):
+        request = (('request', profile.root.name),)
+        self.inc('requests_total', labels=request)
+        for path, span in profile.root.walk():
+            self.observe('stage_seconds', span.ms / 1000., labels=(('stage', path),))
+        for name, value in profile.counters.items():
+            self.inc(name + '_total', value, labels=request)
+        if profile.root.peak_rss_mb is not None:
+            self.set_gauge('peak_rss_bytes', profile.root.peak_rss_mb * 1024 ** 2)
+        with self._lock:
+            self._profiles.append(profile.to_dict())
+
+    def recent_profiles(self):
+        with self._lock:
+            return list(self._profiles)
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    full_name = '%s_%s' % (self.prefix, name)
+                    lines.append('# TYPE %s %s' % (full_name, kind))
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append('%s%s %s' % (full_name, _format_labels(labels), value))
+            for name in sorted({n for n, _ in self._histograms}):
+                full_name = '%s_%s' % (self.prefix, name)
+                lines.append('# TYPE %s histogram' % full_name)
+                for (n, labels), (buckets, total, num) in sorted(self._histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, bucket in zip(HISTOGRAM_BUCKETS, buckets):
+                        lines.append('%s_bucket%s %d' % (full_name, _format_labels(labels + (('le', bound),)), bucket))
+                    lines.append('%s_bucket%s %d' % (full_name, _format_labels(labels + (('le', '+Inf'),)), num))
+                    lines.append('%s_sum%s %f' % (full_name, _format_labels(labels), total))
+                    lines.append('%s_count%s %d' % (full_name, _format_labels(labels), num))
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
@@ -0,0 +1,41 @@
+'''
+Progress of long-running generation stages, for the job API to show which step a request is at.
+
+    with reporting(callback):
+        ...
+        report('mask_decode', step, total)
+
+report() is a no-op outside of an active reporting() block, so library code can report unconditionally.
+Like the profiler, the callback is held in a context variable, so concurrent requests never see each other's
+progress.
+'''
+import contextvars
+from contextlib import contextmanager
+
+_current_reporter = contextvars.ContextVar('current_reporter', default=None)
+
+
+@contextmanager
+def reporting(callback):
+    '''
+    :param callback: called as callback(stage, step, total) for every report() inside the block
+    '''
+    token = _current_reporter.set(callback)
+    try:
+        yield
+    finally:
+        _current_reporter.reset(token)
+
+
+def current_reporter():
+    '''
+    :return: the callback of the active reporting() block, None outside of one (e.g. to forward it to the
+        process that runs the work)
+    '''
+    return _current_reporter.get()
+
+
+def report(stage, step=None, total=None):
+    callback = _current_reporter.get()
+    if callback is not None:
+        callback(stage, step, total)